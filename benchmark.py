@@ -0,0 +1,334 @@
+"""
+Нагрузочный бенчмарк слоя хранения.
+
+Засевает синтетические данные нужного размера, затем конкурентно гоняет
+горячие операции и печатает JSON с пропускной способностью и p50/p95/p99.
+Фоновый сброс отложенной записи работает как в боте: в отчёт попадают
+пиковая глубина буферов по сценариям, время финального сброса и метрики буферов.
+
+    python benchmark.py --backend memory --chats 10000 --players-per-chat 50
+    MONGODB_URI=... python benchmark.py --backend mongo --db-name bot_bench -o result.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+from datetime import timedelta
+from typing import Awaitable, Callable
+
+from utils import DIG_COOLDOWN_HOURS
+from storage import Storage, player_key, box_key, utcnow, cooldown_expiry
+
+
+def _percentile(sorted_values: list, pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = max(int(round(pct / 100 * len(sorted_values))) - 1, 0)
+    return sorted_values[min(index, len(sorted_values) - 1)]
+
+
+def _pending_writes(storage: Storage) -> int:
+    return sum(metrics["pending"] for metrics in storage.get_write_behind_metrics())
+
+
+async def _sample_pending(storage: Storage, peak: dict, interval: float = 0.01):
+    """Пиковая суммарная глубина буферов отложенной записи, пока идёт сценарий"""
+    while True:
+        peak["pending"] = max(peak["pending"], _pending_writes(storage))
+        await asyncio.sleep(interval)
+
+
+def _player_doc(chat_id: int, user_id: str, now, rng: random.Random) -> dict:
+    doc = {
+        '_id': player_key(chat_id, user_id),
+        'chat_id': chat_id,
+        'user_id': user_id,
+        'gp5': rng.randint(-50, 5000),
+        'username': f"user{user_id}",
+        'last_loot': rng.randint(-5, 10),
+        'last_loot_type': rng.choice(['normal', 'fail'])
+    }
+    # Примерно половина игроков ещё на кулдауне
+    if rng.random() < 0.5:
+        doc['dig_at'] = now - timedelta(hours=rng.uniform(0, DIG_COOLDOWN_HOURS * 2))
+    return doc
+
+
+def _seed_documents(args, rng: random.Random):
+    """Генераторы синтетических документов: игроки по чатам и кулдауны ящиков"""
+    now = utcnow()
+    users_total = max(args.chats * args.players_per_chat // args.chats_per_user, 1)
+
+    def players():
+        for chat_index in range(args.chats):
+            chat_id = -1000000000000 - chat_index
+            for _ in range(args.players_per_chat):
+                yield _player_doc(chat_id, str(rng.randrange(users_total)), now, rng)
+
+    def cooldowns():
+        for index in range(args.cooldowns):
+            user_id = str(index)
+            yield {
+                '_id': box_key(user_id),
+                'user_id': user_id,
+                'chat_id': None,
+                'kind': 'box',
+                'time': now - timedelta(hours=rng.uniform(0, 24)),
+                'claimed': True,
+                'expires_at': cooldown_expiry(now)
+            }
+
+    return users_total, players(), cooldowns()
+
+
+async def _seed_memory(storage, args, rng: random.Random) -> int:
+    users_total, players, cooldowns = _seed_documents(args, rng)
+    for doc in players:
+        stored = storage._upsert_player(doc['chat_id'], doc['user_id'], count=False)
+        stored.update(doc)
+    for doc in cooldowns:
+        storage.cooldowns[doc['_id']] = {
+            k: v for k, v in doc.items() if k in ('user_id', 'time', 'claimed')
+        }
+    await storage.recalculate_global_stats()
+    return users_total
+
+
+async def _seed_mongo(storage, args, rng: random.Random) -> int:
+    from pymongo.errors import BulkWriteError
+    from utils import PLAYERS_COLLECTION, COOLDOWNS_COLLECTION
+
+    users_total, players, cooldowns = _seed_documents(args, rng)
+
+    async def insert(collection: str, docs):
+        batch = []
+        for doc in docs:
+            batch.append(doc)
+            if len(batch) >= args.seed_batch:
+                await _insert_batch(collection, batch)
+                batch = []
+        if batch:
+            await _insert_batch(collection, batch)
+
+    async def _insert_batch(collection: str, batch: list):
+        try:
+            await storage.db[collection].insert_many(batch, ordered=False)
+        except BulkWriteError:
+            pass  # Повторные (chat_id, user_id) из генератора просто пропускаются
+
+    await insert(PLAYERS_COLLECTION, players)
+    await insert(COOLDOWNS_COLLECTION, cooldowns)
+    await storage.recalculate_global_stats()
+    return users_total
+
+
+async def _run_scenario(
+        operation: Callable[[random.Random], Awaitable],
+        ops: int,
+        concurrency: int,
+        seed: int
+) -> dict:
+    latencies = []
+    errors = 0
+    issued = 0
+
+    async def worker(worker_index: int):
+        nonlocal errors, issued
+        rng = random.Random(seed * 1000 + worker_index)
+        while issued < ops:
+            issued += 1
+            started = time.perf_counter()
+            try:
+                await operation(rng)
+            except Exception:
+                errors += 1
+            latencies.append((time.perf_counter() - started) * 1000)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(i) for i in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "ops": len(latencies),
+        "errors": errors,
+        "seconds": round(elapsed, 3),
+        "throughput_ops": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(_percentile(latencies, 50), 3),
+        "p95_ms": round(_percentile(latencies, 95), 3),
+        "p99_ms": round(_percentile(latencies, 99), 3),
+        "max_ms": round(latencies[-1], 3) if latencies else 0.0
+    }
+
+
+def _scenarios(storage: Storage, args, users_total: int) -> dict:
+    chat_ids = [-1000000000000 - i for i in range(args.chats)]
+
+    def random_player(rng: random.Random):
+        return rng.choice(chat_ids), str(rng.randrange(users_total))
+
+    async def apply_dig(rng: random.Random):
+        chat_id, user_id = random_player(rng)
+        await storage.apply_dig(
+            chat_id, user_id, f"user{user_id}",
+            super_roll=rng.random() < 0.01,
+            success_roll=rng.random() < 0.75,
+            gain=rng.randint(1, 10),
+            lost=rng.randint(1, 5)
+        )
+
+    async def try_claim_box_cooldown(rng: random.Random):
+        await storage.try_claim_box_cooldown(str(rng.randrange(max(args.cooldowns, 1))), "bench")
+
+    async def atomic_add_gp5(rng: random.Random):
+        chat_id, user_id = random_player(rng)
+        await storage.atomic_add_gp5(chat_id, user_id, rng.randint(-5, 10), f"user{user_id}")
+
+    async def get_chat_top(rng: random.Random):
+        # Просмотры топа сосредоточены в небольшой доле активных чатов
+        await storage.get_chat_top(rng.choice(chat_ids[:max(len(chat_ids) // 10, 1)]))
+
+    async def get_global_top(rng: random.Random):
+        await storage.get_global_top(10)
+
+    async def get_user_profile_data(rng: random.Random):
+        await storage.get_user_profile_data(*random_player(rng))
+
+    async def atomic_use_promo(rng: random.Random):
+        # Десятая часть попыток — повторная активация тем же игроком
+        await storage.atomic_use_promo("BENCH", str(rng.randrange(max(args.ops * 9 // 10, 1))))
+
+    async def get_statistics(rng: random.Random):
+        # Без кэша результата — измеряется чтение готовых счётчиков
+        await storage.get_statistics(max_age=0)
+
+    async def get_bot_statistics(rng: random.Random):
+        await storage.get_bot_statistics()
+
+    scenarios = {
+        "apply_dig": apply_dig,
+        "try_claim_box_cooldown": try_claim_box_cooldown,
+        "atomic_add_gp5": atomic_add_gp5,
+        "get_chat_top": get_chat_top,
+        "get_global_top": get_global_top,
+        "get_user_profile_data": get_user_profile_data,
+        "atomic_use_promo": atomic_use_promo,
+        "get_statistics": get_statistics,
+        "get_bot_statistics": get_bot_statistics,
+    }
+    if args.only:
+        scenarios = {name: fn for name, fn in scenarios.items() if name in args.only}
+    return scenarios
+
+
+async def run(args) -> dict:
+    if args.backend == 'memory':
+        from memory_storage import MemoryStorage
+        storage = MemoryStorage(latency=args.latency_ms / 1000)
+    else:
+        from database import MongoStorage
+        mongodb_uri = os.getenv('MONGODB_URI')
+        if not mongodb_uri:
+            raise ValueError("MONGODB_URI not set in environment")
+        if args.db_name == 'bot_db':
+            raise ValueError("Refusing to benchmark against the production database 'bot_db'")
+        storage = MongoStorage(mongodb_uri, db_name=args.db_name)
+        await storage.client.drop_database(args.db_name)
+        await storage.prepare()
+
+    rng = random.Random(args.seed)
+    started = time.perf_counter()
+    if args.backend == 'memory':
+        users_total = await _seed_memory(storage, args, rng)
+    else:
+        users_total = await _seed_mongo(storage, args, rng)
+    seed_seconds = time.perf_counter() - started
+    await storage.create_promo("BENCH", 1, -1)
+
+    if args.flush_interval is not None:
+        for buffer in (storage.chat_activity_buffer, storage.global_stats_buffer, storage.stats_buffer):
+            buffer.flush_interval = args.flush_interval
+    storage.start_background()
+
+    results = {}
+    for name, operation in _scenarios(storage, args, users_total).items():
+        ops = args.ops if name != "get_bot_statistics" else max(args.ops // 100, 1)
+        peak = {"pending": 0}
+        sampler = asyncio.create_task(_sample_pending(storage, peak))
+        try:
+            results[name] = await _run_scenario(operation, ops, args.concurrency, args.seed)
+        finally:
+            sampler.cancel()
+        results[name]["peak_pending_writes"] = max(peak["pending"], _pending_writes(storage))
+        results[name]["pending_writes_after"] = _pending_writes(storage)
+        print(f"{name}: {results[name]['throughput_ops']} ops/s, p99 {results[name]['p99_ms']} ms", file=sys.stderr)
+
+    # Остаток буферов пишется при остановке — это время тоже входит в цену отложенной записи
+    pending_before_drain = _pending_writes(storage)
+    started = time.perf_counter()
+    await storage.stop_background()
+    drain_seconds = time.perf_counter() - started
+    print(f"final flush: {pending_before_drain} pending writes in {drain_seconds:.3f} s", file=sys.stderr)
+    write_behind = {
+        "flush_interval": storage.stats_buffer.flush_interval,
+        "final_flush_pending": pending_before_drain,
+        "final_flush_seconds": round(drain_seconds, 3),
+        "buffers": storage.get_write_behind_metrics()
+    }
+
+    if args.backend == 'mongo' and not args.keep:
+        await storage.client.drop_database(args.db_name)
+    await storage.close()
+
+    return {
+        "backend": args.backend,
+        "config": {
+            "chats": args.chats,
+            "players_per_chat": args.players_per_chat,
+            "chats_per_user": args.chats_per_user,
+            "users": users_total,
+            "cooldowns": args.cooldowns,
+            "ops": args.ops,
+            "concurrency": args.concurrency,
+            "latency_ms": args.latency_ms if args.backend == 'memory' else None,
+            "seed": args.seed
+        },
+        "seed_seconds": round(seed_seconds, 3),
+        "results": results,
+        "write_behind": write_behind
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the bot storage layer")
+    parser.add_argument('--backend', choices=['memory', 'mongo'], default='memory')
+    parser.add_argument('--db-name', default='bot_bench', help="MongoDB database for synthetic data")
+    parser.add_argument('--chats', type=int, default=1000)
+    parser.add_argument('--players-per-chat', type=int, default=50)
+    parser.add_argument('--chats-per-user', type=int, default=3, help="average number of chats per user")
+    parser.add_argument('--cooldowns', type=int, default=100000, help="box cooldown documents")
+    parser.add_argument('--ops', type=int, default=5000, help="operations per scenario")
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--latency-ms', type=float, default=0.0, help="emulated round trip for memory backend")
+    parser.add_argument('--flush-interval', type=float, help="write-behind flush interval, seconds (default: bot setting)")
+    parser.add_argument('--seed-batch', type=int, default=5000)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--only', nargs='*', help="run only the named scenarios")
+    parser.add_argument('--keep', action='store_true', help="keep the benchmark database after the run")
+    parser.add_argument('-o', '--output', help="write JSON report to a file instead of stdout")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
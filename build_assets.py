@@ -0,0 +1,234 @@
+"""
+Сборка картинок для отправки в Telegram.
+
+Перекодирует ассеты IMG/ в JPEG с длинной стороной не больше той, до которой
+Telegram всё равно ужимает фото, и складывает их в IMG_BUILD/ (с расширением
+.jpg) вместе с manifest.json. safe_image_path отдаёт оптимизированный вариант,
+если он есть в манифесте и исходник с тех пор не менялся; бот читает манифест
+при старте и в /cache_images. Запускается офлайн, до деплоя:
+
+    pip install -r requirements-dev.txt
+    python build_assets.py
+    python build_assets.py --quality 80 --max-side 1280 -o report.json
+
+--measure-upload N отправляет N собранных картинок в медиа-канал дважды —
+исходник и оптимизированный вариант — и добавляет в отчёт время загрузки
+(нужны TOKEN и MEDIA_CHANNEL_ID из config.txt; сообщения сразу удаляются).
+"""
+import os
+import io
+import sys
+import json
+import time
+import asyncio
+import argparse
+
+from utils import (
+    IMG_DIR, ASSETS_BUILD_DIR, ASSETS_MANIFEST, TELEGRAM_PHOTO_MAX_SIDE, ASSETS_JPEG_QUALITY, load_config
+)
+from media_cache import file_digest
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+JPEG_EXTENSIONS = ('.jpg', '.jpeg')
+
+
+def output_name(filename: str, sources: set) -> str:
+    """Имя JPEG-варианта: расширение совпадает с содержимым и не пересекается с другим исходником"""
+    if filename.lower().endswith(JPEG_EXTENSIONS):
+        return filename
+    name = f"{os.path.splitext(filename)[0]}.jpg"
+    return name if name not in sources else f"{filename}.jpg"
+
+
+def _load_manifest() -> dict:
+    try:
+        with open(ASSETS_MANIFEST, encoding='utf-8') as f:
+            return json.load(f).get('assets', {})
+    except (OSError, ValueError):
+        return {}
+
+
+def optimize_image(path: str, max_side: int, quality: int) -> tuple:
+    """JPEG-байты и размер картинки после уменьшения и перекодирования"""
+    with Image.open(path) as image:
+        image.load()
+        if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+            # Фото в Telegram без прозрачности — подложка белая, а не чёрная
+            image = image.convert('RGBA')
+            background = Image.new('RGB', image.size, (255, 255, 255))
+            background.paste(image, mask=image.getchannel('A'))
+            image = background
+        else:
+            image = image.convert('RGB')
+        image.thumbnail((max_side, max_side), Image.LANCZOS)
+        buffer = io.BytesIO()
+        image.save(buffer, 'JPEG', quality=quality, optimize=True, progressive=True)
+        return buffer.getvalue(), image.size
+
+
+def build(args) -> dict:
+    os.makedirs(ASSETS_BUILD_DIR, exist_ok=True)
+    previous = {} if args.force else _load_manifest()
+    manifest = {}
+    files = []
+    totals = {"source_bytes": 0, "output_bytes": 0, "built": 0, "reused": 0, "kept_original": 0, "failed": 0}
+    started = time.perf_counter()
+
+    sources = {
+        filename for filename in os.listdir(IMG_DIR)
+        if os.path.isfile(os.path.join(IMG_DIR, filename)) and filename.lower().endswith(IMAGE_EXTENSIONS)
+    }
+    for filename in sorted(sources):
+        path = os.path.join(IMG_DIR, filename)
+        source_size = os.path.getsize(path)
+        source_hash = file_digest(path)
+        output = output_name(filename, sources)
+        output_path = os.path.join(ASSETS_BUILD_DIR, output)
+        totals["source_bytes"] += source_size
+
+        entry = previous.get(filename)
+        if entry and entry.get('source_hash') == source_hash and entry.get('params') == [args.max_side, args.quality]:
+            if entry.get('hash') is None:
+                manifest[filename] = entry
+                totals["output_bytes"] += source_size
+                totals["kept_original"] += 1
+                continue
+            if entry.get('output') == output and os.path.exists(output_path) and file_digest(output_path) == entry['hash']:
+                manifest[filename] = entry
+                totals["output_bytes"] += entry['size']
+                totals["reused"] += 1
+                continue
+
+        try:
+            data, size = optimize_image(path, args.max_side, args.quality)
+        except Exception as e:
+            totals["failed"] += 1
+            totals["output_bytes"] += source_size
+            print(f"{filename}: {e}", file=sys.stderr)
+            continue
+
+        if len(data) >= source_size:
+            # Перекодирование не помогло — отправляется исходник, hash у записи пустой
+            manifest[filename] = {"source_hash": source_hash, "source_size": source_size,
+                                  "hash": None, "params": [args.max_side, args.quality]}
+            totals["kept_original"] += 1
+            totals["output_bytes"] += source_size
+            files.append({"file": filename, "source_bytes": source_size, "output_bytes": source_size})
+            continue
+
+        with open(output_path, 'wb') as f:
+            f.write(data)
+        manifest[filename] = {
+            "output": output,
+            "source_hash": source_hash,
+            "source_size": source_size,
+            "hash": file_digest(output_path),
+            "size": len(data),
+            "width": size[0],
+            "height": size[1],
+            "params": [args.max_side, args.quality]
+        }
+        totals["output_bytes"] += len(data)
+        totals["built"] += 1
+        files.append({"file": filename, "source_bytes": source_size, "output_bytes": len(data)})
+
+    # Выходные файлы ассетов, которых больше нет в IMG/ или которые отправляются исходником
+    outputs = {entry['output'] for entry in manifest.values() if entry['hash'] is not None}
+    for filename in os.listdir(ASSETS_BUILD_DIR):
+        if filename != os.path.basename(ASSETS_MANIFEST) and filename not in outputs:
+            os.remove(os.path.join(ASSETS_BUILD_DIR, filename))
+
+    with open(ASSETS_MANIFEST, 'w', encoding='utf-8') as f:
+        json.dump({"max_side": args.max_side, "quality": args.quality, "assets": manifest}, f,
+                  ensure_ascii=False, indent=2, sort_keys=True)
+
+    saved = totals["source_bytes"] - totals["output_bytes"]
+    return {
+        "config": {"max_side": args.max_side, "quality": args.quality, "force": args.force},
+        "seconds": round(time.perf_counter() - started, 3),
+        **totals,
+        "saved_bytes": saved,
+        "saved_percent": round(saved / totals["source_bytes"] * 100, 1) if totals["source_bytes"] else 0.0,
+        "files": files
+    }
+
+
+async def measure_uploads(manifest: dict, limit: int) -> dict:
+    """
+    Время отправки исходников и оптимизированных вариантов в медиа-канал.
+    Варианты одной картинки отправляются подряд, порядок чередуется,
+    чтобы колебания сети не ложились только на одну сторону.
+    """
+    from aiogram import Bot
+    from aiogram.types import FSInputFile
+
+    config = load_config()
+    if not config.token or not config.media_channel_id:
+        sys.exit("--measure-upload needs TOKEN and MEDIA_CHANNEL_ID in config.txt")
+    built = [(name, entry) for name, entry in sorted(manifest.items()) if entry.get('hash')][:limit]
+    totals = {"source": [0.0, 0], "optimized": [0.0, 0]}
+
+    bot = Bot(token=config.token)
+    try:
+        for index, (filename, entry) in enumerate(built):
+            variants = [
+                ("source", os.path.join(IMG_DIR, filename), entry['source_size']),
+                ("optimized", os.path.join(ASSETS_BUILD_DIR, entry['output']), entry['size'])
+            ]
+            for kind, path, size in (variants if index % 2 == 0 else variants[::-1]):
+                started = time.perf_counter()
+                message = await bot.send_photo(config.media_channel_id, FSInputFile(path))
+                totals[kind][0] += time.perf_counter() - started
+                totals[kind][1] += size
+                await bot.delete_message(config.media_channel_id, message.message_id)
+    finally:
+        await bot.session.close()
+
+    source_seconds, optimized_seconds = totals["source"][0], totals["optimized"][0]
+    return {
+        "files": len(built),
+        "source_seconds": round(source_seconds, 3),
+        "source_bytes": totals["source"][1],
+        "optimized_seconds": round(optimized_seconds, 3),
+        "optimized_bytes": totals["optimized"][1],
+        "saved_percent": round((1 - optimized_seconds / source_seconds) * 100, 1) if source_seconds else 0.0
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-encode IMG assets for Telegram photo uploads")
+    parser.add_argument('--max-side', type=int, default=TELEGRAM_PHOTO_MAX_SIDE,
+                        help="longest side in pixels, Telegram downscales larger photos anyway")
+    parser.add_argument('--quality', type=int, default=ASSETS_JPEG_QUALITY, help="JPEG quality")
+    parser.add_argument('--force', action='store_true', help="rebuild every asset, ignoring the manifest")
+    parser.add_argument('--measure-upload', type=int, metavar='N', default=0,
+                        help="upload N built assets as source and optimized to the media channel and time both")
+    parser.add_argument('-o', '--output', help="write JSON report to a file instead of stdout")
+    args = parser.parse_args()
+
+    if Image is None:
+        sys.exit("Pillow is required to build assets: pip install Pillow")
+
+    report = build(args)
+    print(f"{report['source_bytes']} → {report['output_bytes']} bytes, "
+          f"saved {report['saved_bytes']} ({report['saved_percent']}%)", file=sys.stderr)
+    if args.measure_upload:
+        report["upload"] = asyncio.run(measure_uploads(_load_manifest(), args.measure_upload))
+        upload = report["upload"]
+        print(f"upload of {upload['files']} files: {upload['source_seconds']} s → "
+              f"{upload['optimized_seconds']} s ({upload['saved_percent']}% faster)", file=sys.stderr)
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,293 @@
+import os
+import re
+import time
+import random
+import asyncio
+import logging
+from bisect import bisect_right
+from dataclasses import dataclass
+from string import Formatter
+from types import MappingProxyType
+from typing import List, Mapping, Optional, Pattern, Tuple
+
+from utils import escape_markdown_v2, load_messages, MESSAGES_FILE, MESSAGES_WATCH_INTERVAL
+
+BOX_CLOSED_IMAGE = 'closed.jpg'
+
+EVENT_KINDS = ('success', 'fail', 'super', 'box_win', 'box_lose', 'box_empty')
+
+# Заглушки на случай, если в messages.json нет нужного списка событий
+DEFAULT_EVENTS = {
+    'success': [{"text": "Нашёл {} ГП-5!", "image": "success.jpg"}],
+    'fail': [{"text": "Потерял {} ГП-5!", "image": "fail.jpg"}],
+    'super': [{"text": "Невероятная находка!", "image": "super.jpg"}],
+    'box_win': [{"text": "Ты нашёл {loot} ГП-5!", "image": "box_win.jpg"}],
+    'box_lose': [{"text": "Потерял {loot} ГП-5!", "image": "box_lose.jpg"}],
+    'box_empty': [{"text": "Пусто...", "image": "box_empty.jpg"}],
+}
+
+# Слова, запускающие вылазку без команды, если в messages.json нет списка triggers
+DEFAULT_TRIGGERS = ("хабарить",)
+
+_reload_lock = asyncio.Lock()
+
+UNKNOWN_RANK = {
+    "name": "Неизвестный",
+    "name_md": escape_markdown_v2("Неизвестный"),
+    "emoji": "❓",
+    "image": None,
+    "min_gp5": 0,
+    "next_rank": None,
+    "progress": 0
+}
+
+
+@dataclass(frozen=True)
+class Template:
+    """
+    Текст из messages.json, заранее разбитый на экранированные куски и поля
+    подстановки. render_md подставляет значения без повторного экранирования всего текста.
+    """
+    text: str
+    parts: Tuple[Tuple[str, Optional[str]], ...]
+
+    @classmethod
+    def compile(cls, text: str) -> 'Template':
+        try:
+            parsed = list(Formatter().parse(text))
+        except ValueError:
+            # Непарные фигурные скобки — текст выводится как есть
+            parsed = [(text, None, None, None)]
+        parts = tuple((escape_markdown_v2(literal), field) for literal, field, _, _ in parsed)
+        return cls(text, parts)
+
+    def render_md(self, value=None, **fields) -> str:
+        """Позиционное поле ({}) и {loot} получают value, именованные — fields"""
+        chunks = []
+        for literal, field in self.parts:
+            chunks.append(literal)
+            if field is not None:
+                chunks.append(escape_markdown_v2(str(fields.get(field, value))))
+        return ''.join(chunks)
+
+
+@dataclass(frozen=True)
+class Event:
+    template: Template
+    image: Optional[str]
+
+
+@dataclass(frozen=True)
+class Rank:
+    min_gp5: int
+    name: str
+    name_md: str
+    emoji: str
+    image: Optional[str]
+
+    def as_dict(self) -> dict:
+        return {"name": self.name, "emoji": self.emoji, "image": self.image, "min_gp5": self.min_gp5}
+
+
+@dataclass(frozen=True)
+class MessageCatalog:
+    """
+    Неизменяемый скомпилированный messages.json: таблица порогов рангов для
+    bisect, экранированные тексты, пулы событий и список всех картинок.
+    Собирается один раз при загрузке и подменяется целиком одним присваиванием.
+    """
+    raw: Mapping
+    ranks: Tuple[Rank, ...]
+    rank_thresholds: Tuple[int, ...]
+    events: Mapping[str, Tuple[Event, ...]]
+    welcome_greeting: Optional[Template]
+    welcome_body_md: str
+    welcome_image: Optional[str]
+    assets: Tuple[str, ...]
+    triggers: Tuple[str, ...]
+    trigger_pattern: Optional[Pattern]
+
+    @classmethod
+    def compile(cls, raw: dict) -> 'MessageCatalog':
+        ranks = []
+        for rank in sorted(raw.get("ranks", []), key=lambda r: r.get("min_gp5", 0)):
+            min_gp5 = rank.get("min_gp5", 0)
+            # При равных порогах действует ранг, который стоит в файле первым
+            if ranks and ranks[-1].min_gp5 == min_gp5:
+                continue
+            name = rank.get("name", "Неизвестный")
+            ranks.append(Rank(min_gp5, name, escape_markdown_v2(name), rank.get("emoji", "❓"), rank.get("image")))
+
+        events = {}
+        for kind in EVENT_KINDS:
+            items = raw.get(kind) or DEFAULT_EVENTS[kind]
+            if isinstance(items, dict):
+                items = [items]
+            events[kind] = tuple(Event(Template.compile(item.get("text", "")), item.get("image")) for item in items)
+
+        welcome = raw.get("welcome", {})
+        lines = welcome.get("text", [])
+        greeting = Template.compile(lines[0]) if lines else None
+        body = [escape_markdown_v2(line) for line in lines[1:3]]
+        if len(lines) > 3:
+            body += ["", f"*{escape_markdown_v2('Команды:')}*", escape_markdown_v2(lines[3].lstrip('\n'))]
+            body += [escape_markdown_v2(line) for line in lines[4:8]]
+
+        assets = {event.image for pool in events.values() for event in pool if event.image}
+        assets |= {rank.image for rank in ranks if rank.image}
+        if welcome.get("image"):
+            assets.add(welcome["image"])
+        assets.add(BOX_CLOSED_IMAGE)
+
+        triggers = tuple(dict.fromkeys(
+            word.strip().lower() for word in raw.get("triggers", DEFAULT_TRIGGERS) if word.strip()
+        ))
+        # Все слова — одна регулярка-альтернатива: один проход по тексту на сообщение
+        trigger_pattern = re.compile('|'.join(map(re.escape, triggers)), re.IGNORECASE) if triggers else None
+
+        return cls(
+            raw=MappingProxyType(raw),
+            ranks=tuple(ranks),
+            rank_thresholds=tuple(rank.min_gp5 for rank in ranks),
+            events=MappingProxyType(events),
+            welcome_greeting=greeting,
+            welcome_body_md='\n'.join(body),
+            welcome_image=welcome.get("image"),
+            assets=tuple(sorted(assets)),
+            triggers=triggers,
+            trigger_pattern=trigger_pattern
+        )
+
+    def match_trigger(self, text: str) -> bool:
+        return self.trigger_pattern is not None and self.trigger_pattern.search(text) is not None
+
+    def pick(self, kind: str) -> Event:
+        return random.choice(self.events[kind])
+
+    def render_welcome(self, username: str) -> Optional[str]:
+        if self.welcome_greeting is None:
+            return None
+        return f"**{self.welcome_greeting.render_md(username=username)}**\n{self.welcome_body_md}"
+
+    def rank_for(self, gp5: int) -> dict:
+        """Ранг по порогу: bisect по отсортированной таблице вместо сортировки на каждый вызов"""
+        if not self.ranks:
+            return dict(UNKNOWN_RANK)
+        index = bisect_right(self.rank_thresholds, gp5) - 1
+        if index < 0:
+            # Баланс ниже первого порога — младший ранг без прогресса
+            current, next_rank = self.ranks[0], self.ranks[0]
+        else:
+            current = self.ranks[index]
+            next_rank = self.ranks[index + 1] if index + 1 < len(self.ranks) else None
+
+        progress = 100
+        if next_rank and next_rank.min_gp5 > current.min_gp5:
+            progress = int(((gp5 - current.min_gp5) / (next_rank.min_gp5 - current.min_gp5)) * 100)
+            progress = max(0, min(progress, 99))
+        return {
+            **current.as_dict(),
+            "name_md": current.name_md,
+            "next_rank": next_rank.as_dict() if next_rank else None,
+            "progress": progress
+        }
+
+
+def validate_messages(raw) -> List[str]:
+    """Ошибки структуры messages.json (пустой список — файл годится)"""
+    if not isinstance(raw, dict):
+        return ["корень файла должен быть объектом"]
+    errors = []
+    ranks = raw.get("ranks", [])
+    if not isinstance(ranks, list):
+        errors.append("ranks: ожидается список")
+    else:
+        for i, rank in enumerate(ranks):
+            if not isinstance(rank, dict) or not isinstance(rank.get("min_gp5", 0), int):
+                errors.append(f"ranks[{i}]: нужен объект с целым min_gp5")
+    for kind in EVENT_KINDS:
+        items = raw.get(kind)
+        if items is None:
+            continue
+        if isinstance(items, dict):
+            items = [items]
+        if not isinstance(items, list):
+            errors.append(f"{kind}: ожидается список событий")
+            continue
+        for i, item in enumerate(items):
+            if not isinstance(item, dict) or not isinstance(item.get("text"), str):
+                errors.append(f"{kind}[{i}]: нужен объект с текстом text")
+    triggers = raw.get("triggers", [])
+    if not isinstance(triggers, list) or not all(isinstance(word, str) for word in triggers):
+        errors.append("triggers: ожидается список строк")
+    welcome = raw.get("welcome", {})
+    if not isinstance(welcome, dict) or not all(isinstance(line, str) for line in welcome.get("text", [])):
+        errors.append("welcome: text должен быть списком строк")
+    return errors
+
+
+def diff_catalogs(old: Optional[MessageCatalog], new: MessageCatalog) -> List[str]:
+    """Что поменялось между каталогами — строки для отчёта админу"""
+    if old is None:
+        return ["первая загрузка"]
+    changes = []
+    if old.ranks != new.ranks:
+        changes.append(f"ранги: {len(old.ranks)} → {len(new.ranks)}")
+    for kind in EVENT_KINDS:
+        before, after = set(old.events[kind]), set(new.events[kind])
+        if before != after:
+            changes.append(f"{kind}: +{len(after - before)} −{len(before - after)} (всего {len(after)})")
+    if (old.welcome_greeting, old.welcome_body_md, old.welcome_image) != (
+            new.welcome_greeting, new.welcome_body_md, new.welcome_image):
+        changes.append("приветствие")
+    if old.triggers != new.triggers:
+        changes.append(f"триггеры: {', '.join(new.triggers) or 'нет'}")
+    added = sorted(set(new.assets) - set(old.assets))
+    removed = sorted(set(old.assets) - set(new.assets))
+    if added:
+        changes.append(f"новые картинки: {', '.join(added[:10])}" + (" …" if len(added) > 10 else ""))
+    if removed:
+        changes.append(f"убраны картинки: {', '.join(removed[:10])}" + (" …" if len(removed) > 10 else ""))
+    return changes
+
+
+async def reload_messages(bot_state) -> dict:
+    """
+    Перечитывает messages.json, проверяет его и собирает новый каталог вне цикла
+    событий, затем подменяет bot_state.messages одним присваиванием.
+    При ошибке исключение пробрасывается, а прежний каталог остаётся в работе.
+    """
+    async with _reload_lock:
+        started = time.perf_counter()
+        raw = await load_messages(strict=True)
+        errors = validate_messages(raw)
+        if errors:
+            raise ValueError("; ".join(errors[:5]))
+        catalog = await asyncio.to_thread(MessageCatalog.compile, raw)
+        changes = diff_catalogs(bot_state.messages, catalog)
+        bot_state.messages = catalog
+        seconds = time.perf_counter() - started
+        logging.info(f"Messages reloaded in {seconds * 1000:.1f} ms: {', '.join(changes) or 'no changes'}")
+        return {"seconds": seconds, "changes": changes, "assets": len(catalog.assets)}
+
+
+def _messages_mtime() -> Optional[int]:
+    try:
+        return os.stat(MESSAGES_FILE).st_mtime_ns
+    except OSError:
+        return None
+
+
+async def watch_messages(bot_state, interval: float = MESSAGES_WATCH_INTERVAL):
+    """Фоновая проверка mtime messages.json: изменённый файл перезагружается сам"""
+    last_mtime = _messages_mtime()
+    while True:
+        await asyncio.sleep(interval)
+        mtime = _messages_mtime()
+        if mtime is None or mtime == last_mtime:
+            continue
+        last_mtime = mtime
+        try:
+            await reload_messages(bot_state)
+        except Exception as e:
+            logging.error(f"Messages reload failed, keeping previous catalog: {e}")
@@ -1,29 +1,30 @@
 import os
+import uuid
+import time
 import asyncio
 import logging
 from datetime import datetime, timedelta
 from typing import Optional, Tuple
 import motor.motor_asyncio
+from pymongo import UpdateOne
 from pymongo.errors import DuplicateKeyError
 
 from utils import (
-    GLOBAL_COOLDOWN_COLLECTION, CHATS_LIST_COLLECTION, PROMO_COLLECTION,
-    CHAT_DATA_COLLECTION, DIG_COOLDOWN_HOURS, BOX_COOLDOWN_HOURS, MIGRATION_VERSION
+    CHATS_COLLECTION, PROMO_CODES_COLLECTION, PROMO_USAGE_COLLECTION, MEDIA_CACHE_COLLECTION,
+    PLAYERS_COLLECTION, COOLDOWNS_COLLECTION, GLOBAL_STATS_COLLECTION, GLOBAL_STATS_REBUILD_COLLECTION,
+    STATS_COLLECTION, DIG_COOLDOWN_HOURS, BOX_COOLDOWN_HOURS, GLOBAL_STATS_REBUILD_BATCH, BULK_GIVE_BATCH,
+    STATS_DAYS_RETENTION
+)
+from storage import Storage, player_key, box_key, utcnow, cooldown_expiry
+from media_cache import media_key
+from migrations import (
+    MIGRATIONS, COOLDOWN_DOCUMENTS_VERSION, PLAYERS_VERSION, PROMO_DOCUMENTS_VERSION, DIG_COOLDOWNS_VERSION,
+    MigrationRunner, players_by_user_pipeline
 )
-
-MONGODB_URI = os.getenv('MONGODB_URI')
-if not MONGODB_URI:
-    raise ValueError("MONGODB_URI not set in environment")
-
-mongo_client = motor.motor_asyncio.AsyncIOMotorClient(MONGODB_URI)
-db = mongo_client['bot_db']
 
 
-async def ensure_singleton_documents():
+async def ensure_singleton_documents(db):
     singletons = [
-        (GLOBAL_COOLDOWN_COLLECTION, 'singleton'),
-        (CHATS_LIST_COLLECTION, 'singleton'),
-        (PROMO_COLLECTION, 'singleton'),
         ('config', 'maintenance'),
         ('migrations', 'version'),
     ]
@@ -39,779 +40,834 @@ async def ensure_singleton_documents():
     logging.info("Singleton documents ensured")
 
 
-async def ensure_indexes():
-    await db['global_stats'].create_index([('max_gp5', -1)])
-    await db[GLOBAL_COOLDOWN_COLLECTION].create_index([('_id', 1)])
-    await db[CHAT_DATA_COLLECTION].create_index([('_id', 1)])
-    await db['promo_usage'].create_index([('user_id', 1), ('code', 1)], unique=True)
-    await db['media_cache'].create_index([('_id', 1)])  # Добавьте эту строку
-    logging.info("Database indexes created")
-
-async def migrate_database():
-    lock_result = await db['migrations'].find_one_and_update(
-        {
-            '_id': 'lock',
-            '$or': [
-                {'locked': False},
-                {'locked': {'$exists': False}},
-                {'locked_at': {'$lt': datetime.now() - timedelta(minutes=5)}}
-            ]
-        },
-        {
-            '$set': {
-                'locked': True,
-                'locked_at': datetime.now()
-            }
-        },
-        upsert=True,
-        return_document=True
-    )
-    if not lock_result or (lock_result.get('locked') and
-                           lock_result.get('locked_at') and
-                           lock_result['locked_at'] > datetime.now() - timedelta(minutes=5) and
-                           lock_result.get('_id') != 'lock'):
-        logging.info("Migration already running by another process")
-        return
-    try:
-        version_doc = await db['migrations'].find_one({'_id': 'version'})
-        current_version = version_doc.get('version', 0) if version_doc else 0
-
-        if current_version < 1:
-            await _migrate_v1_global_stats()
-            await db['migrations'].update_one(
-                {'_id': 'version'},
-                {'$set': {'version': 1, 'migrated_at': datetime.now()}},
-                upsert=True
-            )
-            logging.info("Migration v1 completed")
-
-        if current_version < 2:
-            await _migrate_v2_total_gp5()
-            await db['migrations'].update_one(
-                {'_id': 'version'},
-                {'$set': {'version': 2, 'migrated_at': datetime.now()}},
-                upsert=True
-            )
-            logging.info("Migration v2 completed")
-
-        # Новая миграция для max_gp5
-        if current_version < 3:
-            await _migrate_v3_max_gp5()
-            await db['migrations'].update_one(
-                {'_id': 'version'},
-                {'$set': {'version': 3, 'migrated_at': datetime.now()}},
-                upsert=True
-            )
-            logging.info("Migration v3 (max_gp5) completed")
-
-        logging.info(f"Database at version {max(current_version, 3)}")
-    except Exception as e:
-        logging.error(f"Migration failed: {e}")
-        raise
-    finally:
-        await db['migrations'].update_one(
-            {'_id': 'lock'},
-            {'$set': {'locked': False}}
-        )
-
-
-async def _migrate_v3_max_gp5():
-    """Пересчёт max_gp5 (максимум по одному чату) для всех пользователей"""
-    logging.info("Migrating to max_gp5 (max across all chats)...")
+async def ensure_global_stats_indexes(collection):
+    """Индексы global_stats (общие для рабочей и теневой коллекции)"""
+    await collection.create_index([('max_gp5', -1)])
 
-    # Очищаем и пересоздаём global_stats с правильными данными
-    await db['global_stats'].delete_many({})
 
-    pipeline = [
-        {"$project": {"data": {"$objectToArray": "$data"}}},
-        {"$unwind": "$data"},
-        {"$group": {
-            "_id": "$data.k",  # user_id
-            "max_gp5": {"$max": "$data.v.gp5"},  # МАКСИМУМ, не сумма!
-            "username": {"$last": "$data.v.username"}
-        }}
-    ]
-
-    batch = []
-    count = 0
-
-    async for doc in db[CHAT_DATA_COLLECTION].aggregate(pipeline):
-        user_id = doc["_id"]
-        max_gp5 = doc.get("max_gp5", 0)
-        username = doc.get("username", "Unknown")
-
-        batch.append({
-            '_id': user_id,
-            'max_gp5': max_gp5,
-            'username': username
-        })
-
-        if len(batch) >= 100:
-            await db['global_stats'].insert_many(batch)
-            count += len(batch)
-            batch = []
-
-    if batch:
-        await db['global_stats'].insert_many(batch)
-        count += len(batch)
-
-    logging.info(f"Migration to max_gp5 completed: {count} users")
-
-
-async def recalculate_global_stats():
-    """Принудительный пересчёт max_gp5 для всех пользователей"""
-    logging.info("Starting full recalculation of global_stats (max_gp5)...")
+async def ensure_indexes(db):
+    await ensure_global_stats_indexes(db[GLOBAL_STATS_COLLECTION])
+    await db[COOLDOWNS_COLLECTION].create_index([('expires_at', 1)], expireAfterSeconds=0)
+    await db[COOLDOWNS_COLLECTION].create_index([('user_id', 1), ('kind', 1)])
+    await db[PLAYERS_COLLECTION].create_index([('chat_id', 1), ('gp5', -1)])
+    await db[PLAYERS_COLLECTION].create_index([('user_id', 1), ('gp5', -1)])
+    await db[PROMO_USAGE_COLLECTION].create_index([('user_id', 1), ('code', 1)], unique=True)
+    await db[STATS_COLLECTION].create_index([('expires_at', 1)], expireAfterSeconds=0)
+    await db[CHATS_COLLECTION].create_index([('status', 1), ('last_active', -1)])
+    await db[CHATS_COLLECTION].create_index([('last_active', -1)])
+    await db[CHATS_COLLECTION].create_index([('type', 1)])
+    logging.info("Database indexes created")
 
-    # Очищаем старые данные
-    await db['global_stats'].delete_many({})
 
-    pipeline = [
-        {"$project": {"data": {"$objectToArray": "$data"}}},
-        {"$unwind": "$data"},
-        {"$group": {
-            "_id": "$data.k",
-            "max_gp5": {"$max": "$data.v.gp5"},  # МАКСИМУМ!
-            "username": {"$last": "$data.v.username"}
-        }}
-    ]
+# $expr с $gt/$lt в $lookup (место в профиле) идёт по индексу только с MongoDB 5.0
+MIN_MONGODB_VERSION = (5, 0)
 
-    count = 0
-    batch = []
 
-    async for doc in db[CHAT_DATA_COLLECTION].aggregate(pipeline):
-        user_id = doc["_id"]
-        max_gp5 = doc.get("max_gp5", 0)
-        username = doc.get("username", "Unknown")
+class MongoStorage(Storage):
+    """Хранилище в MongoDB (Motor), нужна MongoDB 5.0+"""
 
-        batch.append({
-            '_id': user_id,
-            'max_gp5': max_gp5,
-            'username': username
-        })
-
-        if len(batch) >= 100:
-            await db['global_stats'].insert_many(batch)
-            count += len(batch)
-            batch = []
-
-    if batch:
-        await db['global_stats'].insert_many(batch)
-        count += len(batch)
-
-    logging.info(f"Recalculation completed: {count} users updated")
-    return count
-
-
-async def _migrate_v2_total_gp5():
-    """Старая миграция - теперь просто пропускаем"""
-    pass
-
-
-async def _migrate_v1_global_stats():
-    stats_count = await db['global_stats'].count_documents({})
-    if stats_count > 0:
-        return
-    logging.info("Migrating global stats from chat data...")
-    all_users = {}
-    async for doc in db[CHAT_DATA_COLLECTION].find():
-        chat_data = doc.get('data', {})
-        for user_id, data in chat_data.items():
-            gp5 = data.get('gp5', 0)
-            if user_id not in all_users or gp5 > all_users[user_id]['max_gp5']:
-                all_users[user_id] = {
-                    '_id': user_id,
-                    'max_gp5': gp5,
-                    'username': data.get('username', 'Unknown')
-                }
-    if all_users:
-        try:
-            await db['global_stats'].insert_many(list(all_users.values()), ordered=False)
-            logging.info(f"Migrated {len(all_users)} users to global_stats")
-        except Exception as e:
-            logging.warning(f"Some users already existed in global_stats: {e}")
+    def __init__(self, mongodb_uri: str, db_name: str = 'bot_db'):
+        super().__init__()
+        self.client = motor.motor_asyncio.AsyncIOMotorClient(mongodb_uri)
+        self.db = self.client[db_name]
+        self.migrations = MigrationRunner(self.db, MIGRATIONS)
 
+    async def prepare(self):
+        """
+        Индексы создаются до миграций, чтобы шаги сразу писали в индексированные коллекции.
+        MIGRATIONS_IN_BACKGROUND=1 — бот начинает отвечать, не дожидаясь миграций:
+        начисления пишут в players сразу (перенос сливает старые балансы), а вылазки,
+        массовая выдача и промокоды ждут шагов, переносящих их данные.
+        """
+        server = await self.client.server_info()
+        if tuple(server.get('versionArray', [0])[:2]) < MIN_MONGODB_VERSION:
+            logging.warning(
+                f"MongoDB {server.get('version')} is older than 5.0: "
+                f"profile rank lookups will scan whole chats instead of the (chat_id, gp5) index"
+            )
+        await ensure_singleton_documents(self.db)
+        await ensure_indexes(self.db)
+        if os.getenv('MIGRATIONS_IN_BACKGROUND', '0') == '1':
+            self.migrations.run_in_background()
+        else:
+            await self.migrations.run()
+
+    async def get_migration_status(self) -> Optional[dict]:
+        return await self.migrations.status()
+
+    async def close(self):
+        self.client.close()
+
+    async def _get_remaining_cooldown(self, key: str, cooldown_hours: int) -> Optional[int]:
+        doc = await self.db[COOLDOWNS_COLLECTION].find_one({'_id': key}, {'time': 1})
+        if not doc or not doc.get('time'):
+            return None
+        remaining = timedelta(hours=cooldown_hours) - (utcnow() - doc['time'])
+        if remaining.total_seconds() > 0:
+            return int(remaining.total_seconds())
+        return None
 
-async def load_data(collection_name: str, chat_id: int = None) -> dict:
-    if collection_name == CHAT_DATA_COLLECTION and chat_id:
-        doc = await db[collection_name].find_one({'_id': chat_id})
-        return doc.get('data', {}) if doc else {}
-    else:
-        doc = await db[collection_name].find_one({'_id': 'singleton'})
-        return doc.get('data', {}) if doc else {}
+    async def apply_dig(
+            self,
+            chat_id: int,
+            user_id: str,
+            username: str,
+            *,
+            super_roll: bool,
+            success_roll: bool,
+            gain: int,
+            lost: int,
+            super_loot: int = 40,
+            cooldown_hours: int = DIG_COOLDOWN_HOURS,
+            bypass_cooldown: bool = False
+    ) -> Tuple[Optional[dict], Optional[int]]:
+        """
+        Вылазка одной атомарной операцией над документом игрока:
+        проверка и захват кулдауна, выбор исхода, начисление и запись last_loot.
+        Случайные броски делаются заранее, сервер лишь выбирает ветку по состоянию документа.
+        Возвращает (результат, None) при успехе или (None, секунд_до_вылазки) если рано.
+        """
+        # Пока v7 не перенёс действующие кулдауны в players.dig_at, вылазка их не видит
+        await self.migrations.wait_for(DIG_COOLDOWNS_VERSION)
+        now = utcnow()
+        now = now.replace(microsecond=now.microsecond // 1000 * 1000)  # точность BSON datetime
+        cutoff = now - timedelta(hours=cooldown_hours)
+        token = uuid.uuid4().hex
+
+        if bypass_cooldown:
+            claimed_expr = True
+        else:
+            claimed_expr = {'$or': [
+                {'$eq': [{'$type': '$dig_at'}, 'missing']},
+                {'$lt': ['$dig_at', cutoff]}
+            ]}
+
+        applied = {
+            'chat_id': {'$ifNull': ['$chat_id', chat_id]},
+            'user_id': {'$ifNull': ['$user_id', {'$literal': user_id}]},
+            'gp5': {'$cond': ['$_dig.claimed', {'$add': [{'$ifNull': ['$gp5', 0]}, '$_dig.loot']}, '$gp5']},
+            'username': {'$cond': ['$_dig.claimed', {'$literal': username}, '$username']},
+            'last_loot': {'$cond': ['$_dig.claimed', '$_dig.loot', '$last_loot']},
+            'last_loot_type': {'$cond': ['$_dig.claimed', '$_dig.loot_type', '$last_loot_type']},
+            'dig_token': {'$cond': ['$_dig.claimed', token, '$dig_token']},
+            # Метка создания ставится только новому документу — по ней считаются новые игроки
+            'created_at': {'$ifNull': ['$created_at', {
+                '$cond': [{'$eq': [{'$type': '$user_id'}, 'missing']}, now, '$$REMOVE']
+            }]}
+        }
+        if not bypass_cooldown:
+            applied['dig_at'] = {'$cond': ['$_dig.claimed', now, '$dig_at']}
+
+        pipeline = [
+            {'$set': {'_dig': {
+                'claimed': claimed_expr,
+                'loot_type': {'$switch': {
+                    'branches': [
+                        # Сверхредкая находка не выпадает два раза подряд
+                        {'case': {'$and': [super_roll, {'$ne': ['$last_loot_type', 'super']}]}, 'then': 'super'},
+                        # Новичок всегда возвращается с добычей
+                        {'case': {'$or': [success_roll, {'$eq': [{'$type': '$gp5'}, 'missing']}]}, 'then': 'normal'}
+                    ],
+                    'default': 'fail'
+                }}
+            }}},
+            {'$set': {'_dig.loot': {'$switch': {
+                'branches': [
+                    {'case': {'$eq': ['$_dig.loot_type', 'super']}, 'then': super_loot},
+                    {'case': {'$eq': ['$_dig.loot_type', 'normal']}, 'then': gain}
+                ],
+                'default': -lost
+            }}}},
+            {'$set': applied},
+            {'$unset': '_dig'}
+        ]
+
+        doc = await self.db[PLAYERS_COLLECTION].find_one_and_update(
+            {'_id': player_key(chat_id, user_id)},
+            pipeline,
+            upsert=True,
+            return_document=True
+        )
 
+        if doc.get('dig_token') != token:
+            remaining = timedelta(hours=cooldown_hours) - (now - doc['dig_at'])
+            return None, int(remaining.total_seconds()) if remaining.total_seconds() > 0 else None
 
-async def save_data(data: dict, collection_name: str, chat_id: int = None):
-    if collection_name == CHAT_DATA_COLLECTION and chat_id:
-        await db[collection_name].replace_one(
-            {'_id': chat_id},
-            {'_id': chat_id, 'data': data},
-            upsert=True
-        )
-    else:
-        await db[collection_name].update_one(
-            {'_id': 'singleton'},
-            {'$set': {'data': data}},
-            upsert=True
+        new_player = doc.get('created_at') == now
+        self.chat_top_cache.update(chat_id, user_id, username, doc['gp5'], doc['_id'])
+        self.record_stats(
+            daily={'digs': 1, 'new_players': int(new_player)},
+            totals={'total_player_records': int(new_player)}
         )
+        loot = doc['last_loot']
+        return {
+            "loot": loot,
+            "loot_type": doc['last_loot_type'],
+            "old_balance": doc['gp5'] - loot,
+            "new_balance": doc['gp5']
+        }, None
+
+    async def try_claim_box_cooldown(
+            self,
+            user_id: str,
+            nonce: str,
+            cooldown_hours: int = BOX_COOLDOWN_HOURS
+    ) -> Tuple[bool, Optional[int]]:
+        """Занимает кулдаун ящика и запоминает nonce выданного набора кнопок"""
+        now = utcnow()
+        cutoff = now - timedelta(hours=cooldown_hours)
+        key = box_key(user_id)
 
-async def _retry_on_duplicate(operation, max_retries: int = 3):
-    for attempt in range(max_retries):
         try:
-            return await operation()
+            await self.db[COOLDOWNS_COLLECTION].update_one(
+                {
+                    '_id': key,
+                    '$or': [
+                        {'time': {'$exists': False}},
+                        {'time': {'$lt': cutoff}}
+                    ]
+                },
+                {
+                    '$set': {'pending': True, 'nonce': nonce, 'expires_at': cooldown_expiry(now)},
+                    '$unset': {'legacy_mapping': 1, 'legacy_until': 1},
+                    '$setOnInsert': {'user_id': user_id, 'chat_id': None, 'kind': 'box'}
+                },
+                upsert=True
+            )
+            return True, None
         except DuplicateKeyError:
-            if attempt < max_retries - 1:
-                await asyncio.sleep(0.01 * (attempt + 1))
-                continue
-            raise
-
-
-async def try_claim_dig_cooldown(
-        user_id: str,
-        chat_id: int,
-        cooldown_hours: int = DIG_COOLDOWN_HOURS
-) -> Tuple[bool, Optional[int]]:
-    now = datetime.now()
-    cutoff = now - timedelta(hours=cooldown_hours)
-    chat_id_str = str(chat_id)
-
-    async def do_update():
-        return await db[GLOBAL_COOLDOWN_COLLECTION].find_one_and_update(
+            pass
+        except Exception as e:
+            logging.error(f"Error in try_claim_box_cooldown: {e}")
+            return False, None
+        return False, await self._get_remaining_cooldown(key, cooldown_hours)
+
+    async def save_box_nonce(self, user_id: str, nonce: str):
+        """Запоминает nonce ящика без проверки кулдауна (админский /box)"""
+        await self.db[COOLDOWNS_COLLECTION].update_one(
+            {'_id': box_key(user_id)},
             {
-                '_id': 'singleton',
-                '$or': [
-                    {f'data.{user_id}.dig.{chat_id_str}.time': {'$exists': False}},
-                    {f'data.{user_id}.dig.{chat_id_str}.time': {'$lt': cutoff.isoformat()}}
-                ]
+                '$set': {'pending': True, 'nonce': nonce},
+                '$unset': {'legacy_mapping': 1, 'legacy_until': 1},
+                '$setOnInsert': {
+                    'user_id': user_id,
+                    'chat_id': None,
+                    'kind': 'box',
+                    'expires_at': cooldown_expiry(utcnow())
+                }
             },
+            upsert=True
+        )
+
+    async def claim_box(self, user_id: str, nonce: str) -> bool:
+        """Одноразовое открытие ящика: True, только если nonce ещё не был использован"""
+        now = utcnow()
+        result = await self.db[COOLDOWNS_COLLECTION].update_one(
+            {'_id': box_key(user_id), 'nonce': nonce},
             {
+                '$unset': {'nonce': 1, 'pending': 1},
                 '$set': {
-                    f'data.{user_id}.dig.{chat_id_str}.time': now.isoformat(),
-                    f'data.{user_id}.dig.{chat_id_str}.locked': True
+                    'time': now,
+                    'claimed': True,
+                    'expires_at': cooldown_expiry(now)
                 }
+            }
+        )
+        if result.modified_count != 1:
+            return False
+        self.record_stats(daily={'boxes': 1})
+        return True
+
+    async def claim_legacy_box(self, user_id: str, button_id: str) -> Optional[str]:
+        """Одноразовое открытие ящика старого формата по карте, перенесённой миграцией v4"""
+        await self.migrations.wait_for(COOLDOWN_DOCUMENTS_VERSION)
+        now = utcnow()
+        doc = await self.db[COOLDOWNS_COLLECTION].find_one_and_update(
+            {
+                '_id': box_key(user_id),
+                f'legacy_mapping.{button_id}': {'$exists': True},
+                'legacy_until': {'$gt': now}
+            },
+            {
+                '$unset': {'legacy_mapping': 1, 'legacy_until': 1, 'nonce': 1, 'pending': 1},
+                '$set': {'time': now, 'claimed': True, 'expires_at': cooldown_expiry(now)}
             },
             return_document=False
         )
+        if doc is None:
+            return None
+        self.record_stats(daily={'boxes': 1})
+        return doc['legacy_mapping'][button_id]
+
+    async def get_user_cooldown(self, user_id: str) -> Optional[dict]:
+        """Таймеры игрока в формате {'dig': {chat_id: {...}}, 'box': {...}}"""
+        box_task = self.db[COOLDOWNS_COLLECTION].find_one({'_id': box_key(user_id)})
+        dig_task = self.db[PLAYERS_COLLECTION].find(
+            {'user_id': user_id, 'dig_at': {'$exists': True}},
+            {'chat_id': 1, 'dig_at': 1, 'last_loot': 1}
+        ).to_list(None)
+        box_doc, dig_docs = await asyncio.gather(box_task, dig_task)
+
+        user_data = {}
+        if dig_docs:
+            user_data['dig'] = {
+                str(doc['chat_id']): {'time': doc['dig_at'], 'last_loot': doc.get('last_loot')}
+                for doc in dig_docs
+            }
+        if box_doc:
+            user_data['box'] = {
+                k: v for k, v in box_doc.items()
+                if k not in ('_id', 'user_id', 'chat_id', 'kind', 'expires_at', 'legacy_mapping', 'legacy_until')
+            }
+        return user_data or None
+
+    async def delete_user_cooldowns(self, user_id: str):
+        await asyncio.gather(
+            self.db[COOLDOWNS_COLLECTION].delete_many({'user_id': user_id}),
+            self.db[PLAYERS_COLLECTION].update_many(
+                {'user_id': user_id, 'dig_at': {'$exists': True}},
+                {'$unset': {'dig_at': 1}}
+            )
+        )
 
-    try:
-        result = await _retry_on_duplicate(do_update)
-    except DuplicateKeyError:
-        logging.error(f"DuplicateKeyError in try_claim_dig_cooldown after retries")
-        return False, None
-    except Exception as e:
-        logging.error(f"Error in try_claim_dig_cooldown: {e}")
-        return False, None
-    if result is not None:
-        return True, None
-    doc = await db[GLOBAL_COOLDOWN_COLLECTION].find_one({'_id': 'singleton'})
-    if doc and 'data' in doc:
-        user_data = doc['data'].get(user_id, {})
-        dig_data = user_data.get('dig', {}).get(chat_id_str, {})
-        if dig_data.get('locked'):
-            time_str = dig_data.get('time')
-            if time_str:
-                try:
-                    dig_time = datetime.fromisoformat(time_str.replace("Z", "+00:00"))
-                    if abs((now - dig_time).total_seconds()) < 2:
-                        return True, None
-                except ValueError:
-                    pass
-        time_str = dig_data.get('time')
-        if time_str:
-            try:
-                last_dig = datetime.fromisoformat(time_str.replace("Z", "+00:00"))
-                remaining = timedelta(hours=cooldown_hours) - (datetime.now() - last_dig)
-                if remaining.total_seconds() > 0:
-                    return False, int(remaining.total_seconds())
-            except ValueError:
-                pass
-    return False, None
-
-
-async def finish_dig_cooldown(user_id: str, chat_id: int, last_loot: int):
-    chat_id_str = str(chat_id)
-    await db[GLOBAL_COOLDOWN_COLLECTION].update_one(
-        {'_id': 'singleton'},
-        {
-            '$set': {f'data.{user_id}.dig.{chat_id_str}.last_loot': last_loot},
-            '$unset': {f'data.{user_id}.dig.{chat_id_str}.locked': 1}
-        }
-    )
+    async def atomic_add_gp5(self, chat_id: int, user_id: str, amount: int, username: str) -> int:
+        now = utcnow()
+        now = now.replace(microsecond=now.microsecond // 1000 * 1000)
+        result = await self.db[PLAYERS_COLLECTION].find_one_and_update(
+            {'_id': player_key(chat_id, user_id)},
+            {
+                '$inc': {'gp5': amount},
+                '$set': {'username': username},
+                '$setOnInsert': {'chat_id': chat_id, 'user_id': user_id, 'created_at': now}
+            },
+            upsert=True,
+            return_document=True
+        )
+        if result and result.get('created_at') == now:
+            self.record_stats(daily={'new_players': 1}, totals={'total_player_records': 1})
+        if result:
+            self.chat_top_cache.update(chat_id, user_id, username, result.get('gp5', amount), result['_id'])
+            return result.get('gp5', amount)
+        return amount
+
+    async def bulk_add_gp5(self, user_ids: list, amount: int, chat_id: Optional[int] = None) -> dict:
+        """
+        Начисление amount во все чаты каждого игрока из user_ids (или только в chat_id):
+        один update_many с $inc по индексу (user_id, gp5) на пачку игроков, без чтения документов.
+        Возвращает {user_id: {'chats', 'max_gp5', 'username'}} для найденных игроков;
+        новый максимум и карта чатов сразу записываются в global_stats.
+        """
+        # Игроки, ещё не перенесённые из chat_data, иначе не получили бы начисление
+        await self.migrations.wait_for(PLAYERS_VERSION)
+        summary = {}
+        for i in range(0, len(user_ids), BULK_GIVE_BATCH):
+            chunk = user_ids[i:i + BULK_GIVE_BATCH]
+            query = {'user_id': {'$in': chunk}}
+            if chat_id is not None:
+                query['chat_id'] = chat_id
+            result = await self.db[PLAYERS_COLLECTION].update_many(query, {'$inc': {'gp5': amount}})
+            if not result.matched_count:
+                continue
 
+            operations = []
+            pipeline = players_by_user_pipeline({'user_id': {'$in': chunk}})
+            async for doc in self.db[PLAYERS_COLLECTION].aggregate(pipeline):
+                chats = doc['chats']
+                if chat_id is not None and str(chat_id) not in chats:
+                    continue
+                max_gp5 = doc.get('max_gp5', 0)
+                username = doc.get('username', 'Unknown')
+                self.update_chat_tops(
+                    doc['_id'], username, chats if chat_id is None else {chat_id: chats[str(chat_id)]}
+                )
+                summary[doc['_id']] = {
+                    'chats': len(chats) if chat_id is None else 1,
+                    'max_gp5': max_gp5,
+                    'username': username
+                }
+                if amount > 0:
+                    # Рост — через $max, чтобы не затереть параллельную вылазку
+                    change = {'$max': {'max_gp5': max_gp5}, '$set': {'username': username, 'chats': chats}}
+                else:
+                    change = {'$set': {'max_gp5': max_gp5, 'username': username, 'chats': chats}}
+                operations.append(UpdateOne({'_id': doc['_id']}, change, upsert=True))
+            if operations:
+                result = await self.db[GLOBAL_STATS_COLLECTION].bulk_write(operations, ordered=False)
+                self.record_stats(totals={'unique_players': result.upserted_count})
+        return summary
+
+    async def get_player(self, chat_id: int, user_id: str) -> Optional[dict]:
+        """Данные игрока в конкретном чате (точечное чтение по _id)"""
+        return await self.db[PLAYERS_COLLECTION].find_one({'_id': player_key(chat_id, user_id)})
+
+    async def load_chat_top(self, chat_id: int, limit: int) -> list:
+        """Топ чата по индексу (chat_id, gp5 desc)"""
+        cursor = self.db[PLAYERS_COLLECTION].find(
+            {'chat_id': chat_id},
+            {'user_id': 1, 'username': 1, 'gp5': 1}
+        ).sort('gp5', -1).limit(limit)
+        return await cursor.to_list(limit)
+
+    async def flush_chat_activity(self, batch: dict):
+        """Накопленные обновления чатов — по одному upsert на документ чата в реестре"""
+        await self.db[CHATS_COLLECTION].bulk_write([
+            UpdateOne(
+                {'_id': chat_id},
+                {
+                    '$set': {
+                        'title': info['title'],
+                        'type': info['type'],
+                        'last_active': info['last_active'],
+                        'status': 'active'
+                    },
+                    '$unset': {'error': 1, 'error_at': 1}
+                },
+                upsert=True
+            )
+            for chat_id, info in batch.items()
+        ], ordered=False)
+
+    async def flush_global_stats(self, batch: dict):
+        """
+        $max для выросших балансов и $set изменившихся чатов в карте chats;
+        для уменьшившихся — точный пересчёт максимума и карты по players.
+        """
+        resync = [user_id for user_id, update in batch.items() if update['decreased']]
+        exact = {}
+        if resync:
+            pipeline = players_by_user_pipeline({"user_id": {"$in": resync}})
+            exact = {
+                doc['_id']: doc
+                async for doc in self.db[PLAYERS_COLLECTION].aggregate(pipeline)
+            }
 
-async def unlock_dig_cooldown(user_id: str, chat_id: int):
-    chat_id_str = str(chat_id)
-    await db[GLOBAL_COOLDOWN_COLLECTION].update_one(
-        {'_id': 'singleton'},
-        {'$unset': {f'data.{user_id}.dig.{chat_id_str}.locked': 1}}
-    )
+        operations = []
+        for user_id, update in batch.items():
+            if user_id in exact:
+                change = {'$set': {
+                    'max_gp5': exact[user_id].get('max_gp5', 0),
+                    'chats': exact[user_id]['chats'],
+                    'username': update['username']
+                }}
+            else:
+                change = {'$max': {'max_gp5': update['gp5']}, '$set': {'username': update['username']}}
+                for chat_id, gp5 in update['chats'].items():
+                    change['$set'][f'chats.{chat_id}'] = gp5
+            operations.append(UpdateOne({'_id': user_id}, change, upsert=True))
+        result = await self.db[GLOBAL_STATS_COLLECTION].bulk_write(operations, ordered=False)
+        self.record_stats(totals={'unique_players': result.upserted_count})
+
+    async def flush_stats(self, batch: dict):
+        """Приращения счётчиков — по одному $inc на документ (итоги и дневные корзины)"""
+        increments = {}
+        for (doc_id, field), amount in batch.items():
+            if amount:
+                increments.setdefault(doc_id, {})[field] = amount
+        if not increments:
+            return
+        expires_at = utcnow() + timedelta(days=STATS_DAYS_RETENTION)
+        operations = []
+        for doc_id, inc in increments.items():
+            change = {'$inc': inc}
+            if doc_id != 'counters':
+                change['$setOnInsert'] = {'expires_at': expires_at}
+            operations.append(UpdateOne({'_id': doc_id}, change, upsert=True))
+        await self.db[STATS_COLLECTION].bulk_write(operations, ordered=False)
+
+    async def get_global_top(self, limit: int = 10) -> list:
+        """
+        Получает топ игроков по МАКСИМАЛЬНОМУ GP-5 в одном чате.
+        Читает global_stats по индексу max_gp5 — стоимость не зависит от числа чатов.
+        """
+        cursor = self.db[GLOBAL_STATS_COLLECTION].find(
+            {},
+            {'max_gp5': 1, 'username': 1}
+        ).sort('max_gp5', -1).limit(limit)
+        return [
+            {'_id': doc['_id'], 'gp5': doc.get('max_gp5', 0), 'username': doc.get('username', 'Unknown')}
+            async for doc in cursor
+        ]
+
+    async def get_user_chats(self, user_id: str) -> dict:
+        """Балансы игрока по чатам из players (диапазон по индексу user_id, gp5)"""
+        cursor = self.db[PLAYERS_COLLECTION].find({'user_id': user_id}, {'chat_id': 1, 'gp5': 1})
+        return {str(doc['chat_id']): doc.get('gp5', 0) async for doc in cursor}
+
+    async def recalculate_global_stats(self) -> dict:
+        """
+        Полный пересчёт max_gp5 для всех пользователей.
+        Таблица собирается в теневой коллекции и подменяет global_stats одним
+        renameCollection — /gtop и ранги всё время видят полные данные,
+        а сбой посреди пересчёта не трогает рабочую таблицу. Подмена выбрасывает
+        записи, пришедшие в старую таблицу за время сборки: игроки, которых
+        в новой таблице нет, сразу дописываются из players, а изменившиеся
+        максимумы существующих догонит периодическая сверка.
+        """
+        logging.info("Starting full recalculation of global_stats (max_gp5)...")
+        started = time.perf_counter()
+
+        shadow = self.db[GLOBAL_STATS_REBUILD_COLLECTION]
+        await shadow.drop()  # остаток прерванного пересчёта
+
+        count = 0
+        batch = []
+
+        async for doc in self.db[PLAYERS_COLLECTION].aggregate(players_by_user_pipeline(), allowDiskUse=True):
+            batch.append({
+                '_id': doc["_id"],
+                'max_gp5': doc.get("max_gp5", 0),  # МАКСИМУМ!
+                'username': doc.get("username", "Unknown"),
+                'chats': doc["chats"]
+            })
+
+            if len(batch) >= GLOBAL_STATS_REBUILD_BATCH:
+                await shadow.insert_many(batch, ordered=False)
+                count += len(batch)
+                batch = []
+
+        if batch:
+            await shadow.insert_many(batch, ordered=False)
+            count += len(batch)
 
+        await ensure_global_stats_indexes(shadow)
+        if count:
+            await shadow.rename(GLOBAL_STATS_COLLECTION, dropTarget=True)
+            count += await self.restore_missing_global_stats()
+        else:
+            await self.db[GLOBAL_STATS_COLLECTION].delete_many({})
+
+        seconds = time.perf_counter() - started
+        rows_per_sec = count / seconds if seconds else 0.0
+        logging.info(
+            f"Recalculation completed: {count} users in {seconds:.2f}s ({rows_per_sec:.0f} rows/s)"
+        )
+        return {"count": count, "seconds": round(seconds, 2), "rows_per_sec": round(rows_per_sec)}
+
+    async def restore_missing_global_stats(self) -> int:
+        """
+        Дописывает в global_stats игроков из players, у которых нет записи.
+        $setOnInsert и $max не затирают запись, параллельно созданную ботом.
+        """
+        pipeline = players_by_user_pipeline() + [
+            {"$lookup": {
+                "from": GLOBAL_STATS_COLLECTION,
+                "localField": "_id",
+                "foreignField": "_id",
+                "as": "stored"
+            }},
+            {"$match": {"stored": {"$size": 0}}}
+        ]
+        operations = [
+            UpdateOne(
+                {'_id': doc['_id']},
+                {
+                    '$max': {'max_gp5': doc.get('max_gp5', 0)},
+                    '$setOnInsert': {'username': doc.get('username', 'Unknown'), 'chats': doc['chats']}
+                },
+                upsert=True
+            )
+            async for doc in self.db[PLAYERS_COLLECTION].aggregate(pipeline, allowDiskUse=True)
+        ]
+        restored = 0
+        for i in range(0, len(operations), GLOBAL_STATS_REBUILD_BATCH):
+            result = await self.db[GLOBAL_STATS_COLLECTION].bulk_write(
+                operations[i:i + GLOBAL_STATS_REBUILD_BATCH], ordered=False
+            )
+            restored += result.upserted_count
+        if restored:
+            logging.info(f"Global stats: {restored} users restored after rebuild")
+        return restored
+
+    async def reconcile_global_stats(self, batch_size: int = 500) -> int:
+        """
+        Сверяет global_stats (максимум и карту чатов) с players пачками и исправляет расхождения.
+        Запись идёт compare-and-set по старому значению, чтобы не затереть параллельный $max.
+        """
+        fixed = 0
+        last_id = None
+
+        while True:
+            query = {'_id': {'$gt': last_id}} if last_id is not None else {}
+            batch = await self.db[GLOBAL_STATS_COLLECTION].find(
+                query, {'max_gp5': 1, 'chats': 1}
+            ).sort('_id', 1).limit(batch_size).to_list(batch_size)
+            if not batch:
+                break
+            last_id = batch[-1]['_id']
+
+            stored = {doc['_id']: doc for doc in batch}
+            pipeline = players_by_user_pipeline({"user_id": {"$in": list(stored)}})
+            actual = {
+                doc['_id']: doc
+                async for doc in self.db[PLAYERS_COLLECTION].aggregate(pipeline)
+            }
+
+            operations = []
+            for user_id, doc in stored.items():
+                if user_id not in actual:
+                    continue
+                stored_max = doc.get('max_gp5', 0)
+                actual_max = actual[user_id].get('max_gp5', 0)
+                if actual_max != stored_max or actual[user_id]['chats'] != doc.get('chats'):
+                    operations.append(UpdateOne(
+                        {'_id': user_id, 'max_gp5': stored_max},
+                        {'$set': {'max_gp5': actual_max, 'chats': actual[user_id]['chats']}}
+                    ))
+            if operations:
+                result = await self.db[GLOBAL_STATS_COLLECTION].bulk_write(operations, ordered=False)
+                fixed += result.modified_count
+
+        if fixed:
+            logging.info(f"Global stats reconciled: {fixed} users fixed")
+        return fixed
+
+    async def mark_chat_inactive(self, chat_id: int, error_reason: str = None):
+        """Пометить чат как неактивный (бот удалён/заблокирован)"""
+        await self.db[CHATS_COLLECTION].update_one(
+            {'_id': chat_id},
+            {'$set': {'status': 'inactive', 'error': error_reason, 'error_at': utcnow()}},
+            upsert=True
+        )
 
-async def try_claim_box_cooldown(
-        user_id: str,
-        cooldown_hours: int = BOX_COOLDOWN_HOURS
-) -> Tuple[bool, Optional[int]]:
-    now = datetime.now()
-    cutoff = now - timedelta(hours=cooldown_hours)
+    async def get_broadcast_chat_ids(self) -> list:
+        """Диапазон индекса (status, last_active): только _id активных чатов"""
+        cursor = self.db[CHATS_COLLECTION].find({'status': 'active'}, {'_id': 1}).sort('last_active', -1)
+        return [doc['_id'] async for doc in cursor]
+
+    async def get_active_chats_stats(self) -> dict:
+        """Каждый счётчик — count по диапазону индекса, без чтения документов чатов"""
+        chats = self.db[CHATS_COLLECTION]
+        now = utcnow()
+        windows = [
+            chats.count_documents({'status': 'active', 'last_active': {'$gte': now - timedelta(days=days)}})
+            for days in (1, 7, 30)
+        ]
+        total, inactive, groups, supergroups, active_24h, active_7d, active_30d = await asyncio.gather(
+            chats.count_documents({}),
+            chats.count_documents({'status': 'inactive'}),
+            chats.count_documents({'type': 'group'}),
+            chats.count_documents({'type': 'supergroup'}),
+            *windows
+        )
+        return {
+            "total": total,
+            "active_24h": active_24h,
+            "active_7d": active_7d,
+            "active_30d": active_30d,
+            "inactive": inactive,
+            "groups": groups,
+            "supergroups": supergroups
+        }
 
-    async def do_update():
-        return await db[GLOBAL_COOLDOWN_COLLECTION].find_one_and_update(
+    async def create_promo(self, code: str, amount: int, uses: int):
+        """Создать (или пересоздать) промокод; старые активации кода сбрасываются"""
+        await self.db[PROMO_CODES_COLLECTION].replace_one(
+            {'_id': code},
             {
-                '_id': 'singleton',
-                '$or': [
-                    {f'data.{user_id}.box.time': {'$exists': False}},
-                    {f'data.{user_id}.box.time': {'$lt': cutoff.isoformat()}}
-                ]
+                'amount': amount,
+                'uses': uses,
+                'remaining': uses,
+                'used_count': 0,
+                'created_at': datetime.now().isoformat()
             },
+            upsert=True
+        )
+        await self.db[PROMO_USAGE_COLLECTION].delete_many({'code': code})
+
+    async def atomic_use_promo(self, code: str, user_id: str) -> Tuple[bool, str, int]:
+        """
+        Активация промокода: запись в promo_usage (уникальный индекс user_id+code)
+        и атомарное списание одного использования. Возвращает (успех, причина, награда).
+        """
+        await self.migrations.wait_for(PROMO_DOCUMENTS_VERSION)
+        try:
+            await self.db[PROMO_USAGE_COLLECTION].insert_one({
+                'user_id': user_id,
+                'code': code,
+                'used_at': datetime.now().isoformat()
+            })
+        except DuplicateKeyError:
+            return False, "already_used", 0
+
+        promo = await self.db[PROMO_CODES_COLLECTION].find_one_and_update(
             {
-                '$set': {f'data.{user_id}.box.pending': True}
+                '_id': code,
+                '$or': [{'uses': -1}, {'remaining': {'$gt': 0}}]
             },
-            return_document=False
+            [{'$set': {
+                'remaining': {'$cond': [
+                    {'$eq': ['$uses', -1]}, '$remaining', {'$subtract': ['$remaining', 1]}
+                ]},
+                'used_count': {'$add': [{'$ifNull': ['$used_count', 0]}, 1]}
+            }}],
+            return_document=True
+        )
+        if promo is not None:
+            return True, "success", promo.get('amount', 0)
+
+        # Откатываем запись об активации: код не найден или исчерпан
+        await self.db[PROMO_USAGE_COLLECTION].delete_one({'user_id': user_id, 'code': code})
+        exists = await self.db[PROMO_CODES_COLLECTION].find_one({'_id': code}, {'_id': 1})
+        return False, "exhausted" if exists else "not_found", 0
+
+    async def list_promos(self) -> list:
+        return await self.db[PROMO_CODES_COLLECTION].find().sort('created_at', 1).to_list(None)
+
+    async def delete_exhausted_promos(self) -> Tuple[int, int]:
+        """Удаляет исчерпанные промокоды. Возвращает (удалено, осталось)"""
+        exhausted = await self.db[PROMO_CODES_COLLECTION].find(
+            {'uses': {'$ne': -1}, 'remaining': {'$lte': 0}},
+            {'_id': 1}
+        ).to_list(None)
+        codes = [doc['_id'] for doc in exhausted]
+        if codes:
+            await self.db[PROMO_CODES_COLLECTION].delete_many({'_id': {'$in': codes}})
+            await self.db[PROMO_USAGE_COLLECTION].delete_many({'code': {'$in': codes}})
+        left = await self.db[PROMO_CODES_COLLECTION].count_documents({})
+        return len(codes), left
+
+    async def get_user_profile_data(self, chat_id: int, user_id: str) -> dict:
+        """
+        Профиль за один параллельный набор запросов: игрок вместе с местом в чате, размер чата, максимум.
+        Место считается $lookup с $expr $gt по (chat_id, gp5) — диапазон индекса с MongoDB 5.0,
+        на более старых серверах это полный проход по игрокам чата.
+        """
+        player_task = self.db[PLAYERS_COLLECTION].aggregate([
+            {'$match': {'_id': player_key(chat_id, user_id)}},
+            # Место в чате = число игроков с бОльшим балансом + 1 (диапазон по индексу chat_id, gp5)
+            {'$lookup': {
+                'from': PLAYERS_COLLECTION,
+                'let': {'gp5': {'$ifNull': ['$gp5', 0]}},
+                'pipeline': [
+                    {'$match': {'chat_id': chat_id, '$expr': {'$gt': ['$gp5', '$$gp5']}}},
+                    {'$count': 'count'}
+                ],
+                'as': 'above'
+            }}
+        ]).to_list(1)
+        chat_total_task = self.db[PLAYERS_COLLECTION].count_documents({'chat_id': chat_id})
+        global_task = self.db[GLOBAL_STATS_COLLECTION].find_one({'_id': user_id}, {'max_gp5': 1})
+
+        players, total_in_chat, global_doc = await asyncio.gather(
+            player_task, chat_total_task, global_task
         )
 
-    try:
-        result = await _retry_on_duplicate(do_update)
-    except DuplicateKeyError:
-        logging.error(f"DuplicateKeyError in try_claim_box_cooldown after retries")
-        return False, None
-    except Exception as e:
-        logging.error(f"Error in try_claim_box_cooldown: {e}")
-        return False, None
-    if result is not None:
-        return True, None
-    doc = await db[GLOBAL_COOLDOWN_COLLECTION].find_one({'_id': 'singleton'})
-    if doc and 'data' in doc:
-        user_data = doc['data'].get(user_id, {})
-        box_data = user_data.get('box', {})
-        if box_data.get('pending') and not box_data.get('time'):
-            return True, None
-        time_str = box_data.get('time')
-        if time_str:
-            try:
-                last_box = datetime.fromisoformat(time_str.replace("Z", "+00:00"))
-                remaining = timedelta(hours=cooldown_hours) - (datetime.now() - last_box)
-                if remaining.total_seconds() > 0:
-                    return False, int(remaining.total_seconds())
-            except ValueError:
-                pass
-    return False, None
-
-
-async def atomic_add_gp5(chat_id: int, user_id: str, amount: int, username: str) -> int:
-    result = await db[CHAT_DATA_COLLECTION].find_one_and_update(
-        {'_id': chat_id},
-        {
-            '$inc': {f'data.{user_id}.gp5': amount},
-            '$set': {f'data.{user_id}.username': username}
-        },
-        upsert=True,
-        return_document=True
-    )
-    if result and 'data' in result and user_id in result['data']:
-        return result['data'][user_id].get('gp5', amount)
-    return amount
-
-
-async def save_box_mapping(user_id: str, mapping: dict):
-    await db[GLOBAL_COOLDOWN_COLLECTION].update_one(
-        {'_id': 'singleton'},
-        {'$set': {f'data.{user_id}.box_mapping': mapping}}
-    )
-
-
-async def claim_box_mapping(user_id: str, button_id: str) -> Optional[str]:
-    result = await db[GLOBAL_COOLDOWN_COLLECTION].find_one_and_update(
-        {
-            '_id': 'singleton',
-            f'data.{user_id}.box_mapping': {'$exists': True, '$ne': {}},
-            f'data.{user_id}.box_mapping.{button_id}': {'$exists': True}
-        },
-        {
-            '$unset': {
-                f'data.{user_id}.box_mapping': 1,
-                f'data.{user_id}.box.pending': 1
-            },
-            '$set': {
-                f'data.{user_id}.box.time': datetime.now().isoformat(),
-                f'data.{user_id}.box.claimed': True
-            }
-        },
-        return_document=False
-    )
-    if not result:
-        return None
-    user_data = result.get('data', {}).get(user_id, {})
-    box_mapping = user_data.get('box_mapping', {})
-    return box_mapping.get(button_id)
-
-
-async def get_user_cooldown(user_id: str) -> Optional[dict]:
-    doc = await db[GLOBAL_COOLDOWN_COLLECTION].find_one({'_id': 'singleton'})
-    if doc and 'data' in doc:
-        return doc['data'].get(user_id)
-    return None
-
-
-async def get_user_dig_cooldown(user_id: str, chat_id: int) -> Optional[dict]:
-    doc = await db[GLOBAL_COOLDOWN_COLLECTION].find_one({'_id': 'singleton'})
-    if doc and 'data' in doc:
-        user_data = doc['data'].get(user_id, {})
-        return user_data.get('dig', {}).get(str(chat_id))
-    return None
-
-
-async def delete_user_cooldowns(user_id: str):
-    await db[GLOBAL_COOLDOWN_COLLECTION].update_one(
-        {'_id': 'singleton'},
-        {'$unset': {f'data.{user_id}': 1}}
-    )
-
-
-async def atomic_set_user_data(chat_id: int, user_id: str, data: dict):
-    await db[CHAT_DATA_COLLECTION].update_one(
-        {'_id': chat_id},
-        {'$set': {f'data.{user_id}': data}},
-        upsert=True
-    )
-
-
-async def update_chat_list(chat_id: int, chat_title: str, chat_type: str):
-    """Обновить информацию о чате и пометить как активный"""
-    await db[CHATS_LIST_COLLECTION].update_one(
-        {'_id': 'singleton'},
-        {
-            '$set': {
-                f'data.{chat_id}.title': chat_title,
-                f'data.{chat_id}.last_active': datetime.now().isoformat(),
-                f'data.{chat_id}.type': chat_type,
-                f'data.{chat_id}.status': 'active'
-            },
-            '$unset': {
-                f'data.{chat_id}.error': 1,
-                f'data.{chat_id}.error_at': 1
-            }
-        }
-    )
-
-
-async def update_global_stats(user_id: int, new_gp5_in_chat: int, username: str):
-    """
-    Обновляет max_gp5 если новое значение больше текущего.
-    ВАЖНО: передавать нужно НОВЫЙ БАЛАНС в чате, а не дельту!
-    """
-    await db['global_stats'].update_one(
-        {'_id': str(user_id)},
-        {
-            '$max': {'max_gp5': new_gp5_in_chat},  # Сохраняет максимум
-            '$set': {'username': username}
-        },
-        upsert=True
-    )
-
-
-async def get_global_top(limit: int = 10) -> list:
-    """
-    Получает топ игроков по МАКСИМАЛЬНОМУ GP-5 в одном чате.
-    Использует агрегацию для гарантированно корректного результата.
-    """
-    pipeline = [
-        {"$project": {"data": {"$objectToArray": "$data"}}},
-        {"$unwind": "$data"},
-        {"$group": {
-            "_id": "$data.k",  # user_id
-            "gp5": {"$max": "$data.v.gp5"},  # МАКСИМУМ по чатам!
-            "username": {"$last": "$data.v.username"}
-        }},
-        {"$sort": {"gp5": -1}},
-        {"$limit": limit}
-    ]
+        player = players[0] if players else None
+        user_chat_data = player or {}
 
-    result = await db[CHAT_DATA_COLLECTION].aggregate(pipeline).to_list(limit)
-    return result
+        # Глобальный GP-5 = максимум по всем чатам (поддерживается в global_stats)
+        global_gp5 = global_doc.get('max_gp5', 0) if global_doc else 0
 
+        last_loot = user_chat_data.get('last_loot')
 
-async def get_user_max_gp5(user_id: str) -> int:
-    """Получает максимальный GP-5 пользователя по всем чатам"""
-    pipeline = [
-        {"$project": {"data": {"$objectToArray": "$data"}}},
-        {"$unwind": "$data"},
-        {"$match": {"data.k": user_id}},
-        {"$group": {
-            "_id": None,
-            "max_gp5": {"$max": "$data.v.gp5"}
-        }}
-    ]
+        position = None
+        if player:
+            above = player['above']
+            position = (above[0]['count'] if above else 0) + 1
 
-    result = await db[CHAT_DATA_COLLECTION].aggregate(pipeline).to_list(1)
-    return result[0]['max_gp5'] if result else 0
-
-
-async def find_user_in_chats(user_id: int) -> Optional[dict]:
-    user_data = None
-    async for doc in db[CHAT_DATA_COLLECTION].find():
-        chat_data = doc.get('data', {})
-        user_id_str = str(user_id)
-        if user_id_str in chat_data:
-            current = chat_data[user_id_str]
-            if user_data is None or current.get("gp5", 0) > user_data.get("gp5", 0):
-                user_data = current.copy()
-                user_data["chat_id"] = str(doc['_id'])
-    return user_data
-
-
-async def atomic_use_promo(code: str, user_id: str, amount: int) -> Tuple[bool, str]:
-    result = await db[PROMO_COLLECTION].find_one_and_update(
-        {
-            '_id': 'singleton',
-            f'data.{code}': {'$exists': True},
-            f'data.{code}.used_by.{user_id}': {'$exists': False},
-            '$or': [
-                {f'data.{code}.uses': -1},
-                {f'data.{code}.uses': {'$gt': {'$size': f'$data.{code}.used_by'}}}
-            ]
-        },
-        {
-            '$set': {f'data.{code}.used_by.{user_id}': datetime.now().isoformat()}
-        },
-        return_document=False
-    )
-    if result is not None:
-        return True, "success"
-    promos = await load_data(PROMO_COLLECTION)
-    if code not in promos:
-        return False, "not_found"
-    promo_data = promos[code]
-    if user_id in promo_data.get("used_by", {}):
-        return False, "already_used"
-    if promo_data["uses"] > -1 and len(promo_data.get("used_by", {})) >= promo_data["uses"]:
-        return False, "exhausted"
-    promos[code]["used_by"][user_id] = datetime.now().isoformat()
-    await save_data(promos, PROMO_COLLECTION)
-    return True, "success"
-
-
-async def get_user_profile_data(chat_id: int, user_id: str) -> dict:
-    chat_data_task = db[CHAT_DATA_COLLECTION].find_one({'_id': chat_id})
-    cooldown_task = db[GLOBAL_COOLDOWN_COLLECTION].find_one(
-        {'_id': 'singleton'},
-        {f'data.{user_id}.dig.{chat_id}': 1}
-    )
-
-    # Агрегация для получения максимума по всем чатам
-    max_pipeline = [
-        {"$project": {"data": {"$objectToArray": "$data"}}},
-        {"$unwind": "$data"},
-        {"$match": {"data.k": user_id}},
-        {"$group": {
-            "_id": None,
-            "max_gp5": {"$max": "$data.v.gp5"}
-        }}
-    ]
-    max_gp5_task = db[CHAT_DATA_COLLECTION].aggregate(max_pipeline).to_list(1)
+        return {
+            "chat_gp5": user_chat_data.get("gp5", 0),
+            "global_gp5": global_gp5,  # Теперь это МАКСИМУМ
+            "chat_position": position,
+            "chat_total": total_in_chat,
+            "username": user_chat_data.get("username", "Unknown"),
+            "exists_in_chat": player is not None,
+            "exists_globally": global_gp5 > 0 or player is not None,
+            "last_loot": last_loot
+        }
+
+    async def get_bot_statistics(self) -> dict:
+        unique_players_task = self.db[GLOBAL_STATS_COLLECTION].count_documents({})
+        pipeline = [
+            {"$group": {"_id": "$chat_id", "player_count": {"$sum": 1}}},
+            {"$group": {
+                "_id": None,
+                "chats_count": {"$sum": 1},
+                "total_player_records": {"$sum": "$player_count"},
+                "max_players_in_chat": {"$max": "$player_count"},
+                "avg_players_per_chat": {"$avg": "$player_count"}
+            }}
+        ]
+        aggregation_task = self.db[PLAYERS_COLLECTION].aggregate(pipeline).to_list(1)
+
+        # Топ игрок — лучшая запись игрок-чат
+        top_player_task = self.db[PLAYERS_COLLECTION].find(
+            {},
+            {'_id': 0, 'user_id': 1, 'gp5': 1, 'username': 1}
+        ).sort('gp5', -1).limit(1).to_list(1)
+
+        unique_players, agg_result, top_player = await asyncio.gather(
+            unique_players_task,
+            aggregation_task,
+            top_player_task
+        )
 
-    chat_doc, cooldown_doc, max_result = await asyncio.gather(
-        chat_data_task, cooldown_task, max_gp5_task
-    )
+        agg_data = agg_result[0] if agg_result else {}
 
-    chat_data = chat_doc.get('data', {}) if chat_doc else {}
-    user_chat_data = chat_data.get(user_id, {})
+        return {
+            "unique_players": unique_players,
+            "active_chats": agg_data.get("chats_count", 0),
+            "total_player_records": agg_data.get("total_player_records", 0),
+            "max_players_in_chat": agg_data.get("max_players_in_chat", 0),
+            "avg_players_per_chat": round(agg_data.get("avg_players_per_chat", 0), 1),
+            "top_player": top_player[0] if top_player else None
+        }
 
-    # Глобальный GP-5 = максимум по всем чатам
-    global_gp5 = max_result[0]['max_gp5'] if max_result else 0
+    async def load_stats_documents(self, day_keys: list) -> Tuple[Optional[dict], dict]:
+        docs = await self.db[STATS_COLLECTION].find({'_id': {'$in': ['counters', *day_keys]}}).to_list(None)
+        by_id = {doc['_id']: doc for doc in docs}
+        counters = by_id.pop('counters', None)
+        if counters is not None and 'reconciled_at' not in counters:
+            # Инкременты успели создать документ раньше первой сверки
+            counters = None
+        return counters, by_id
+
+    async def save_stats_counters(self, counters: dict):
+        await self.db[STATS_COLLECTION].update_one({'_id': 'counters'}, {'$set': counters}, upsert=True)
+
+    async def load_maintenance(self) -> bool:
+        doc = await self.db['config'].find_one({'_id': 'maintenance'})
+        return bool(doc.get('value')) if doc else False
+
+    async def set_maintenance(self, value: bool):
+        await self.db['config'].update_one(
+            {'_id': 'maintenance'},
+            {'$set': {'value': int(value)}},
+            upsert=True
+        )
 
-    last_loot = None
-    if cooldown_doc and 'data' in cooldown_doc:
-        user_cooldown = cooldown_doc['data'].get(user_id, {})
-        dig_data = user_cooldown.get('dig', {}).get(str(chat_id), {})
-        last_loot = dig_data.get('last_loot')
+    async def get_global_stats(self, user_id: str) -> Optional[dict]:
+        return await self.db[GLOBAL_STATS_COLLECTION].find_one({'_id': user_id})
 
-    if chat_data:
-        sorted_users = sorted(
-            chat_data.items(),
-            key=lambda x: x[1].get('gp5', 0),
-            reverse=True
+    async def load_media_cache(self) -> list:
+        # Старые записи без хэша (ключ — только имя файла) пропускаются
+        cursor = self.db[MEDIA_CACHE_COLLECTION].find(
+            {'hash': {'$exists': True}},
+            {'_id': 0, 'filename': 1, 'hash': 1, 'file_id': 1}
         )
-        position = next(
-            (i + 1 for i, (uid, _) in enumerate(sorted_users) if uid == user_id),
-            None
+        return await cursor.to_list(length=None)
+
+    async def save_media_file_id(self, filename: str, digest: str, file_id: str):
+        await self.db[MEDIA_CACHE_COLLECTION].update_one(
+            {'_id': media_key(filename, digest)},
+            {'$set': {'filename': filename, 'hash': digest, 'file_id': file_id, 'updated_at': time.time()}},
+            upsert=True
         )
-        total_in_chat = len(sorted_users)
-    else:
-        position = None
-        total_in_chat = 0
-
-    return {
-        "chat_gp5": user_chat_data.get("gp5", 0),
-        "global_gp5": global_gp5,  # Теперь это МАКСИМУМ
-        "chat_position": position,
-        "chat_total": total_in_chat,
-        "username": user_chat_data.get("username", "Unknown"),
-        "exists_in_chat": user_id in chat_data,
-        "exists_globally": global_gp5 > 0 or user_id in chat_data,
-        "last_loot": last_loot
-    }
-
-
-async def get_admin_user_info(user_id: str) -> dict:
-    cooldown_task = db[GLOBAL_COOLDOWN_COLLECTION].find_one(
-        {'_id': 'singleton'},
-        {f'data.{user_id}': 1}
-    )
-
-    # Агрегация для подсчёта чатов, суммы и максимума
-    chats_pipeline = [
-        {"$project": {"data": {"$objectToArray": "$data"}}},
-        {"$unwind": "$data"},
-        {"$match": {"data.k": user_id}},
-        {"$group": {
-            "_id": None,
-            "chats_count": {"$sum": 1},
-            "total_gp5": {"$sum": "$data.v.gp5"},
-            "max_gp5": {"$max": "$data.v.gp5"},
-            "username": {"$last": "$data.v.username"}
-        }}
-    ]
 
-    cooldown_doc, chats_agg = await asyncio.gather(
-        cooldown_task,
-        db[CHAT_DATA_COLLECTION].aggregate(chats_pipeline).to_list(1)
-    )
-
-    cooldown_data = {}
-    if cooldown_doc and 'data' in cooldown_doc:
-        cooldown_data = cooldown_doc['data'].get(user_id, {})
-
-    chats_info = chats_agg[0] if chats_agg else {
-        "chats_count": 0,
-        "total_gp5": 0,
-        "max_gp5": 0,
-        "username": "Unknown"
-    }
-
-    return {
-        "global_gp5": chats_info.get("max_gp5", 0),  # МАКСИМУМ
-        "username": chats_info.get("username", "Unknown"),
-        "exists_globally": chats_info.get("chats_count", 0) > 0,
-        "chats_count": chats_info.get("chats_count", 0),
-        "total_gp5_sum": chats_info.get("total_gp5", 0),  # Сумма для справки
-        "cooldown_data": cooldown_data
-    }
-
-
-async def get_bot_statistics() -> dict:
-    unique_players_task = db['global_stats'].count_documents({})
-    active_chats_task = db[CHAT_DATA_COLLECTION].count_documents({})
-
-    pipeline = [
-        {"$project": {"players": {"$objectToArray": "$data"}}},
-        {"$project": {"player_count": {"$size": "$players"}}},
-        {"$group": {
-            "_id": None,
-            "total_player_records": {"$sum": "$player_count"},
-            "max_players_in_chat": {"$max": "$player_count"},
-            "avg_players_per_chat": {"$avg": "$player_count"}
-        }}
-    ]
-    aggregation_task = db[CHAT_DATA_COLLECTION].aggregate(pipeline).to_list(1)
-
-    # Топ игрок через агрегацию
-    top_pipeline = [
-        {"$project": {"data": {"$objectToArray": "$data"}}},
-        {"$unwind": "$data"},
-        {"$group": {
-            "_id": "$data.k",
-            "gp5": {"$max": "$data.v.gp5"},
-            "username": {"$last": "$data.v.username"}
-        }},
-        {"$sort": {"gp5": -1}},
-        {"$limit": 1}
-    ]
-    top_player_task = db[CHAT_DATA_COLLECTION].aggregate(top_pipeline).to_list(1)
-
-    unique_players, active_chats, agg_result, top_player = await asyncio.gather(
-        unique_players_task,
-        active_chats_task,
-        aggregation_task,
-        top_player_task
-    )
-
-    agg_data = agg_result[0] if agg_result else {}
-
-    return {
-        "unique_players": unique_players,
-        "active_chats": active_chats,
-        "total_player_records": agg_data.get("total_player_records", 0),
-        "max_players_in_chat": agg_data.get("max_players_in_chat", 0),
-        "avg_players_per_chat": round(agg_data.get("avg_players_per_chat", 0), 1),
-        "top_player": top_player[0] if top_player else None
-    }
-
-async def mark_chat_inactive(chat_id: int, error_reason: str = None):
-    """Пометить чат как неактивный (бот удалён/заблокирован)"""
-    await db[CHATS_LIST_COLLECTION].update_one(
-        {'_id': 'singleton'},
-        {'$set': {
-            f'data.{chat_id}.status': 'inactive',
-            f'data.{chat_id}.error': error_reason,
-            f'data.{chat_id}.error_at': datetime.now().isoformat()
-        }}
-    )
-
-
-async def get_active_chats_stats() -> dict:
-    """Получить детальную статистику по активным чатам"""
-    doc = await db[CHATS_LIST_COLLECTION].find_one({'_id': 'singleton'})
-    if not doc or 'data' not in doc:
-        return {
-            "total": 0,
-            "active_24h": 0,
-            "active_7d": 0,
-            "active_30d": 0,
-            "inactive": 0,
-            "groups": 0,
-            "supergroups": 0
-        }
+    async def save_media_file_ids(self, entries: list):
+        now = time.time()
+        await self.db[MEDIA_CACHE_COLLECTION].bulk_write([
+            UpdateOne(
+                {'_id': media_key(filename, digest)},
+                {'$set': {'filename': filename, 'hash': digest, 'file_id': file_id, 'updated_at': now}},
+                upsert=True
+            )
+            for filename, digest, file_id in entries
+        ], ordered=False)
+
+    async def clear_media_cache(self) -> int:
+        result = await self.db[MEDIA_CACHE_COLLECTION].delete_many({})
+        return result.deleted_count
 
-    now = datetime.now()
-    chats_data = doc.get('data', {})
-
-    stats = {
-        "total": len(chats_data),
-        "active_24h": 0,
-        "active_7d": 0,
-        "active_30d": 0,
-        "inactive": 0,
-        "groups": 0,
-        "supergroups": 0
-    }
-
-    for chat_id, data in chats_data.items():
-        chat_type = data.get('type', '')
-        if chat_type == 'group':
-            stats["groups"] += 1
-        elif chat_type == 'supergroup':
-            stats["supergroups"] += 1
-
-        if data.get('status') == 'inactive':
-            stats["inactive"] += 1
-            continue
-
-        last_active_str = data.get('last_active')
-        if last_active_str:
-            try:
-                last_active = datetime.fromisoformat(last_active_str.replace("Z", "+00:00"))
-                age = now - last_active
-
-                if age < timedelta(days=1):
-                    stats["active_24h"] += 1
-                if age < timedelta(days=7):
-                    stats["active_7d"] += 1
-                if age < timedelta(days=30):
-                    stats["active_30d"] += 1
-            except ValueError:
-                pass
-
-    return stats
-
-async def load_initial_maintenance() -> bool:
-    doc = await db['config'].find_one({'_id': 'maintenance'})
-    return bool(doc.get('value')) if doc else False
\ No newline at end of file
+    async def count_media_cache(self) -> int:
+        return await self.db[MEDIA_CACHE_COLLECTION].count_documents({})
\ No newline at end of file
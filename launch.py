@@ -1,10 +1,10 @@
+import re
 import asyncio
-import uuid
 import random
 import logging
 
 from aiogram import Bot, Dispatcher, types, F
-from aiogram.filters import Command
+from aiogram.filters import Command, MagicData
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, FSInputFile
 
 from utils import (
@@ -12,31 +12,29 @@ from utils import (
     escape_markdown_v2, format_wait_time, format_dig_result,
     check_subscription, send_response, is_admin, safe_image_path,
     get_user_rank, format_progress_bar, logger,
-    RateLimitMiddleware, MaintenanceMiddleware, StateMiddleware,
-    CHAT_DATA_COLLECTION, CHATS_LIST_COLLECTION, PROMO_COLLECTION,
+    RateLimitMiddleware, MaintenanceMiddleware, StateMiddleware, PrefilterMiddleware,
     DIG_COOLDOWN_HOURS, BOX_COOLDOWN_HOURS, escape_number, send_temporary_message,
     format_balance_change, get_dig_lock, get_box_lock,
-    get_cached_file_id, save_file_id, send_photo_cached, MEDIA_CACHE_COLLECTION
+    new_box_nonce, pack_box_callback, unpack_box_callback, unpack_legacy_box_callback, BOX_OUTCOMES,
+    get_cached_file_id, save_file_id, send_photo_cached, send_view, edit_view, view_cache,
+    parse_user_ids, BULK_GIVE_MAX_FILE_SIZE, subscription_cache, media_cache, load_optimized_assets
 )
+from subscription_cache import SUBSCRIBED_STATUSES
 
-from database import (
-    db, ensure_singleton_documents, ensure_indexes, migrate_database,
-    load_data, save_data, load_initial_maintenance,
-    try_claim_dig_cooldown, finish_dig_cooldown, unlock_dig_cooldown,
-    try_claim_box_cooldown, atomic_add_gp5, save_box_mapping, claim_box_mapping,
-    get_user_cooldown, delete_user_cooldowns, atomic_set_user_data,
-    update_chat_list, update_global_stats, get_global_top,
-    atomic_use_promo, get_user_profile_data, get_bot_statistics,
-    get_admin_user_info, recalculate_global_stats,
-    mark_chat_inactive, get_active_chats_stats
-)
+from storage import create_storage
+from catalog import MessageCatalog, reload_messages, watch_messages
 
 config = load_config()
+storage = create_storage()
 bot = Bot(token=config.token)
 dp = Dispatcher()
 
 bot_state = BotState(config=config)
 
+EMPTY_TOP_MD = escape_markdown_v2("Пока пусто...")
+
+prefilter = PrefilterMiddleware(bot_state)
+dp.message.outer_middleware(prefilter)
 dp.message.middleware(StateMiddleware(bot_state))
 dp.callback_query.middleware(StateMiddleware(bot_state))
 dp.message.middleware(MaintenanceMiddleware(bot_state))
@@ -45,37 +43,27 @@ dp.message.middleware(RateLimitMiddleware(rate_limit=0.5))
 dp.callback_query.middleware(RateLimitMiddleware(rate_limit=1.5))
 
 
+@dp.chat_member(F.chat.id == config.channel_id)
+async def on_channel_member(update: types.ChatMemberUpdated):
+    # Подписка и отписка сразу попадают в кэш — следующая проверка обойдётся без запроса
+    subscription_cache.set(update.new_chat_member.user.id, update.new_chat_member.status in SUBSCRIBED_STATUSES)
+
+
 @dp.message(Command("start"))
 async def cmd_start(message: types.Message, bot_state: BotState):
     if message.chat.type == "private":
         await message.reply("Я работаю только в групповых чатах!")
         return
-    await update_chat_list(message.chat.id, message.chat.title or "", message.chat.type)
-    welcome = bot_state.messages.get("welcome", {})
-    welcome_lines = welcome.get("text", [])
-    if not welcome_lines:
+    storage.touch_chat(message.chat.id, message.chat.title or "", message.chat.type)
+    catalog = bot_state.messages
+    welcome_text = catalog.render_welcome(message.from_user.full_name)
+    if welcome_text is None:
         await message.reply("Добро пожаловать! Используйте /help для списка команд.")
         return
-    username = message.from_user.full_name
-    greeting_text = welcome_lines[0].format(username=username) if welcome_lines else ""
-    escaped_greeting = escape_markdown_v2(greeting_text)
-    formatted_lines = [
-        f"**{escaped_greeting}**",
-        escape_markdown_v2(welcome_lines[1]),
-        escape_markdown_v2(welcome_lines[2]),
-        "",
-        f"*{escape_markdown_v2('Команды:')}*",
-        escape_markdown_v2(welcome_lines[3].lstrip('\n')),
-        escape_markdown_v2(welcome_lines[4]),
-        escape_markdown_v2(welcome_lines[5]),
-        escape_markdown_v2(welcome_lines[6]),
-        escape_markdown_v2(welcome_lines[7])
-    ]
-    welcome_text = '\n'.join(formatted_lines)
     await send_response(
         message,
         welcome_text,
-        image=welcome.get("image"),
+        image=catalog.welcome_image,
         parse_mode="MarkdownV2"
     )
 
@@ -115,19 +103,8 @@ async def cmd_dig(message: types.Message, bot_state: BotState, bypass_cooldown:
         return
 
     async with dig_lock:
-        subscription_task = check_subscription(bot, bot_state.config.channel_id, user_id)
-        data_task = load_data(CHAT_DATA_COLLECTION, bunker_id)
-
-        # Админы пропускают cooldown
-        if bypass_cooldown:
-            is_subscribed, bunker_data = await asyncio.gather(subscription_task, data_task)
-            can_dig, wait_seconds = True, None
-        else:
-            cooldown_task = try_claim_dig_cooldown(user_id_str, bunker_id, cooldown_hours=DIG_COOLDOWN_HOURS)
-            is_subscribed, (can_dig, wait_seconds), bunker_data = await asyncio.gather(
-                subscription_task, cooldown_task, data_task
-            )
-
+        # Подписка проверяется до вылазки: сама вылазка сразу начисляет добычу
+        is_subscribed = await check_subscription(bot, bot_state.config.channel_id, user_id)
         if not is_subscribed:
             keyboard = InlineKeyboardMarkup(inline_keyboard=[
                 [InlineKeyboardButton(text="Подписаться", url=bot_state.config.channel_link)]
@@ -138,7 +115,18 @@ async def cmd_dig(message: types.Message, bot_state: BotState, bypass_cooldown:
             )
             return
 
-        if not can_dig:
+        # Кулдаун, исход, баланс и last_loot — одна атомарная операция в БД
+        result, wait_seconds = await storage.apply_dig(
+            bunker_id, user_id_str, username,
+            super_roll=random.random() < 0.01,
+            success_roll=random.choices([True, False], weights=[75, 25])[0],
+            gain=random.randint(1, 5),
+            lost=random.randint(1, 3),
+            cooldown_hours=DIG_COOLDOWN_HOURS,
+            bypass_cooldown=bypass_cooldown
+        )
+
+        if result is None:
             if wait_seconds:
                 await message.reply(
                     f"Ещё рано выходить\\!\nЖди ещё *{escape_markdown_v2(format_wait_time(wait_seconds))}*",
@@ -146,100 +134,51 @@ async def cmd_dig(message: types.Message, bot_state: BotState, bypass_cooldown:
                 )
             return
 
-        asyncio.create_task(
-            update_chat_list(bunker_id, message.chat.title or "", message.chat.type)
-        )
+        storage.touch_chat(bunker_id, message.chat.title or "", message.chat.type)
 
-        try:
-            is_new_user = user_id_str not in bunker_data
-            digger_data = bunker_data.get(user_id_str, {
-                "gp5": 0,
-                "username": username,
-                "last_loot_type": None
-            })
-
-            old_balance = digger_data.get("gp5", 0)
-
-            messages_data = bot_state.messages
-            if random.random() < 0.01 and digger_data.get("last_loot_type") != "super":
-                loot = 40
-                event = messages_data.get("super", {"text": "Невероятная находка!", "image": "super.jpg"})
-                event_text = event["text"]
-                loot_type = "super"
-            else:
-                if is_new_user:
-                    event = random.choice(
-                        messages_data.get("success", [{"text": "Нашёл {} ГП-5!", "image": "success.jpg"}]))
-                    loot = random.randint(1, 5)
-                    event_text = event["text"].format(loot)
-                    loot_type = "normal"
-                else:
-                    is_success = random.choices([True, False], weights=[75, 25])[0]
-                    if is_success:
-                        event = random.choice(
-                            messages_data.get("success", [{"text": "Нашёл {} ГП-5!", "image": "success.jpg"}]))
-                        loot = random.randint(1, 5)
-                        event_text = event["text"].format(loot)
-                        loot_type = "normal"
-                    else:
-                        event = random.choice(
-                            messages_data.get("fail", [{"text": "Потерял {} ГП-5!", "image": "fail.jpg"}]))
-                        lost = random.randint(1, 3)
-                        loot = -lost
-                        event_text = event["text"].format(lost)
-                        loot_type = "fail"
-
-            digger_data["gp5"] += loot
-            digger_data["username"] = username
-            digger_data["last_loot_type"] = loot_type
-
-            new_balance = digger_data["gp5"]
-
-            caption_text = format_dig_result(
-                event_text, loot, loot_type,
-                old_balance=old_balance,
-                new_balance=new_balance
-            )
+        loot = result["loot"]
+        loot_type = result["loot_type"]
+        new_balance = result["new_balance"]
 
-            keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="Профиль", callback_data=f"profile_{user_id}")],
-                [InlineKeyboardButton(text="Топ чата", callback_data="top")]
-            ])
+        if loot_type == "super":
+            event = bot_state.messages.pick("super")
+        elif loot_type == "normal":
+            event = bot_state.messages.pick("success")
+        else:
+            event = bot_state.messages.pick("fail")
 
-            send_task = send_response(
-                message,
-                caption_text,
-                image=event.get("image"),
-                keyboard=keyboard,
-                parse_mode="MarkdownV2"
-            )
+        caption_text = format_dig_result(
+            event.template.render_md(abs(loot)), loot, loot_type,
+            old_balance=result["old_balance"],
+            new_balance=new_balance
+        )
 
-            save_tasks = [
-                atomic_set_user_data(bunker_id, user_id_str, digger_data),
-                update_global_stats(user_id, new_balance, username)
-            ]
+        keyboard = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="Профиль", callback_data=f"profile_{user_id}_new")],
+            [InlineKeyboardButton(text="Топ чата", callback_data="top_new")]
+        ])
 
-            # Обновляем cooldown только если не bypass
-            if not bypass_cooldown:
-                save_tasks.append(finish_dig_cooldown(user_id_str, bunker_id, loot))
+        # Глобальный максимум пишется отложенно пачкой, ответ не ждёт второй записи
+        storage.record_global_stats(user_id, new_balance, username, decreased=loot < 0, chat_id=bunker_id)
 
-            await asyncio.gather(send_task, *save_tasks)
+        await send_response(
+            message,
+            caption_text,
+            image=event.image,
+            keyboard=keyboard,
+            parse_mode="MarkdownV2"
+        )
 
-            admin_mark = " [ADMIN]" if bypass_cooldown else ""
-            logger.info(
-                f"DIG{admin_mark} | {username} (@{message.from_user.username}) | "
-                f"Chat: {message.chat.title or message.chat.id} | "
-                f"Loot: {'+' if loot >= 0 else ''}{loot} | "
-                f"Total: {new_balance} GP-5"
-            )
-        except Exception as e:
-            if not bypass_cooldown:
-                await unlock_dig_cooldown(user_id_str, bunker_id)
-            logging.error(f"Error in cmd_dig: {e}")
-            raise
+        admin_mark = " [ADMIN]" if bypass_cooldown else ""
+        logger.info(
+            f"DIG{admin_mark} | {username} (@{message.from_user.username}) | "
+            f"Chat: {message.chat.title or message.chat.id} | "
+            f"Loot: {'+' if loot >= 0 else ''}{loot} | "
+            f"Total: {new_balance} GP-5"
+        )
 
 
-@dp.message(F.text.lower().contains("хабарить"), ~F.text.startswith("/"))
+@dp.message(MagicData(F.message_kind == "trigger"))
 async def handle_habarit(message: types.Message, bot_state: BotState, bypass_cooldown: bool = False):
     if message.chat.type == "private":
         return
@@ -270,14 +209,19 @@ async def cmd_box(message: types.Message, bot_state: BotState, bypass_cooldown:
         return
 
     async with box_lock:
+        nonce = new_box_nonce()
+
         # Админы пропускают cooldown
         if bypass_cooldown:
-            is_subscribed = await check_subscription(bot, bot_state.config.channel_id, user_id)
+            is_subscribed, _ = await asyncio.gather(
+                check_subscription(bot, bot_state.config.channel_id, user_id),
+                storage.save_box_nonce(user_id_str, nonce)
+            )
             can_open, wait_seconds = True, None
         else:
             is_subscribed, (can_open, wait_seconds) = await asyncio.gather(
                 check_subscription(bot, bot_state.config.channel_id, user_id),
-                try_claim_box_cooldown(user_id_str, cooldown_hours=BOX_COOLDOWN_HOURS)
+                storage.try_claim_box_cooldown(user_id_str, nonce, cooldown_hours=BOX_COOLDOWN_HOURS)
             )
 
         if not is_subscribed:
@@ -298,23 +242,23 @@ async def cmd_box(message: types.Message, bot_state: BotState, bypass_cooldown:
                 )
             return
 
-        asyncio.create_task(
-            update_chat_list(bunker_id, message.chat.title or "", message.chat.type)
-        )
+        storage.touch_chat(bunker_id, message.chat.title or "", message.chat.type)
 
         outcomes = ["win", "win"]
         outcomes.append(random.choices(["empty", "lose"], weights=[40, 60])[0])
         random.shuffle(outcomes)
-        button_ids = [str(uuid.uuid4()) for _ in range(3)]
-        id_to_outcome = {button_ids[i]: outcomes[i] for i in range(3)}
 
         # Для админов используем специальный префикс
         box_prefix = "abox" if bypass_cooldown else "box"
-        await save_box_mapping(user_id_str, id_to_outcome)
+        secret = bot_state.config.callback_secret
 
+        # Исход зашит в подписанный callback_data — отдельное хранение раскладки не нужно
         keyboard = InlineKeyboardMarkup(inline_keyboard=[
             [
-                InlineKeyboardButton(text="📦", callback_data=f"{box_prefix}_{user_id}_{button_ids[i]}")
+                InlineKeyboardButton(
+                    text="📦",
+                    callback_data=pack_box_callback(secret, box_prefix, user_id, nonce, i, outcomes[i])
+                )
                 for i in range(3)
             ]
         ])
@@ -350,13 +294,8 @@ async def cmd_profile(message: types.Message, bot_state: BotState, target_user:
         await message.reply("Я работаю только в групповых чатах!")
         return
 
-    chat_id = message.chat.id
-    user = target_user or message.from_user
-    user_id_str = str(user.id)
-
-    profile = await get_user_profile_data(chat_id, user_id_str)
-
-    if not profile["exists_in_chat"] and not profile["exists_globally"]:
+    view = await render_profile(message.chat.id, target_user or message.from_user, bot_state)
+    if view is None:
         await message.reply(
             "❌ Ты ещё не начал игру\\!\n"
             "Используй /dig чтобы отправиться на вылазку",
@@ -364,6 +303,18 @@ async def cmd_profile(message: types.Message, bot_state: BotState, target_user:
         )
         return
 
+    profile_text, image, keyboard = view
+    # Отправка с кэшированием изображения ранга
+    await send_view(message, profile_text, image=image, keyboard=keyboard)
+
+
+async def render_profile(chat_id: int, user: types.User, bot_state: BotState):
+    """Экран профиля: (текст, картинка ранга, клавиатура) или None, если игрока нет"""
+    profile = await storage.get_user_profile_data(chat_id, str(user.id))
+
+    if not profile["exists_in_chat"] and not profile["exists_globally"]:
+        return None
+
     global_gp5 = profile["global_gp5"]
     chat_gp5 = profile["chat_gp5"]
     rank = get_user_rank(global_gp5, bot_state.messages)
@@ -396,7 +347,7 @@ async def cmd_profile(message: types.Message, bot_state: BotState, target_user:
     else:
         progress_text = "\n\n⭐ *Максимальный ранг достигнут\\!*"
 
-    rank_name = escape_markdown_v2(rank["name"])
+    rank_name = rank["name_md"]
     rank_emoji = rank["emoji"]
 
     last_loot = profile.get("last_loot")
@@ -429,29 +380,44 @@ async def cmd_profile(message: types.Message, bot_state: BotState, target_user:
             InlineKeyboardButton(text="🔄 Обновить", callback_data=f"profile_{user.id}")
         ]
     ])
-
-    # Отправка с кэшированием изображения ранга
-    await send_response(
-        message,
-        profile_text,
-        image=rank.get("image"),
-        keyboard=keyboard,
-        parse_mode="MarkdownV2"
-    )
+    return profile_text, rank.get("image"), keyboard
+
+
+async def show_view(query: types.CallbackQuery, view, new_message: bool):
+    """
+    Кнопки под результатами вылазок и ящиков (суффикс _new) присылают экран
+    новым сообщением, навигация внутри экранов перерисовывает его на месте.
+    """
+    text, image, keyboard = view
+    if new_message:
+        await query.answer()
+        await send_view(query.message, text, image=image, keyboard=keyboard)
+    elif await edit_view(query, text, image=image, keyboard=keyboard):
+        await query.answer()
+    else:
+        await query.answer("Без изменений")
 
 
-@dp.callback_query(F.data.startswith("profile_"))
-async def callback_profile(query: types.CallbackQuery, bot_state: BotState):
+async def callback_own_profile(query: types.CallbackQuery, bot_state: BotState, denied: str):
+    parts = query.data.split("_")
     try:
-        callback_user_id = int(query.data.split("_")[1])
+        callback_user_id = int(parts[1])
     except (IndexError, ValueError):
         await query.answer("❌ Ошибка данных", show_alert=True)
         return
     if query.from_user.id != callback_user_id:
-        await query.answer("❌ Это не твой профиль!", show_alert=True)
+        await query.answer(denied, show_alert=True)
+        return
+    view = await render_profile(query.message.chat.id, query.from_user, bot_state)
+    if view is None:
+        await query.answer("❌ Ты ещё не начал игру! Используй /dig", show_alert=True)
         return
-    await query.answer("🔄 Обновляю...")
-    await cmd_profile(query.message, bot_state, target_user=query.from_user)
+    await show_view(query, view, new_message=parts[-1] == "new")
+
+
+@dp.callback_query(F.data.startswith("profile_"))
+async def callback_profile(query: types.CallbackQuery, bot_state: BotState):
+    await callback_own_profile(query, bot_state, "❌ Это не твой профиль!")
 
 
 @dp.message(Command("top"))
@@ -459,13 +425,12 @@ async def cmd_top(message: types.Message, bot_state: BotState):
     if message.chat.type == "private":
         await message.reply("Я работаю только в групповых чатах!")
         return
-    bunker_id = message.chat.id
-    bunker_data = await load_data(CHAT_DATA_COLLECTION, bunker_id)
-    sorted_diggers = sorted(
-        bunker_data.values(),
-        key=lambda x: x.get("gp5", 0),
-        reverse=True
-    )[:10]
+    reply_text, _, keyboard = await render_chat_top(message.chat.id)
+    await send_view(message, reply_text, keyboard=keyboard)
+
+
+async def render_chat_top(bunker_id: int):
+    sorted_diggers = await storage.get_chat_top(bunker_id, 10)
 
     def escape_gp5(n: int) -> str:
         if n < 0:
@@ -481,12 +446,12 @@ async def cmd_top(message: types.Message, bot_state: BotState):
             top_lines.append(f"{medal} {i + 1}\\. {escape_markdown_v2(username)} — *{escape_gp5(gp5)}* ГП\\-5")
         top_list = "\n".join(top_lines)
     else:
-        top_list = escape_markdown_v2("Пока пусто...")
+        top_list = EMPTY_TOP_MD
     reply_text = f"*Топ чата:*\n\n{top_list}"
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="Глобальный топ", callback_data="gtop")]
     ])
-    await message.reply(reply_text, parse_mode="MarkdownV2", reply_markup=keyboard)
+    return reply_text, None, keyboard
 
 
 @dp.message(Command("gtop"))
@@ -494,7 +459,12 @@ async def cmd_global_top(message: types.Message, bot_state: BotState):
     if message.chat.type == "private":
         await message.reply("Я работаю только в групповых чатах!")
         return
-    top_users = await get_global_top(10)
+    reply_text, _, keyboard = await render_global_top()
+    await send_view(message, reply_text, keyboard=keyboard)
+
+
+async def render_global_top():
+    top_users = await storage.get_global_top(10)
 
     def escape_gp5(n: int) -> str:
         if n < 0:
@@ -510,38 +480,27 @@ async def cmd_global_top(message: types.Message, bot_state: BotState):
             top_lines.append(f"{medal} {i + 1}\\. {escape_markdown_v2(username)} — *{escape_gp5(gp5)}* ГП\\-5")
         top_list = "\n".join(top_lines)
     else:
-        top_list = escape_markdown_v2("Пока пусто...")
+        top_list = EMPTY_TOP_MD
     reply_text = f"*🔥 Мировой рейтинг диггеров:*\n\n{top_list}"
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="Топ чата", callback_data="top")]
     ])
-    await message.reply(reply_text, parse_mode="MarkdownV2", reply_markup=keyboard)
+    return reply_text, None, keyboard
 
 
-@dp.callback_query(F.data == "top")
+@dp.callback_query(F.data.in_({"top", "top_new"}))
 async def callback_top(query: types.CallbackQuery, bot_state: BotState):
-    await cmd_top(query.message, bot_state)
-    await query.answer()
+    await show_view(query, await render_chat_top(query.message.chat.id), new_message=query.data == "top_new")
 
 
 @dp.callback_query(F.data == "gtop")
 async def callback_gtop(query: types.CallbackQuery, bot_state: BotState):
-    await cmd_global_top(query.message, bot_state)
-    await query.answer()
+    await show_view(query, await render_global_top(), new_message=False)
 
 
 @dp.callback_query(F.data.startswith("myloot_"))
 async def callback_myloot(query: types.CallbackQuery, bot_state: BotState):
-    try:
-        callback_user_id = int(query.data.split("_")[1])
-    except (IndexError, ValueError):
-        await query.answer("❌ Ошибка данных", show_alert=True)
-        return
-    if query.from_user.id != callback_user_id:
-        await query.answer("❌ Это не твоя кнопка!", show_alert=True)
-        return
-    await cmd_profile(query.message, bot_state, target_user=query.from_user)
-    await query.answer()
+    await callback_own_profile(query, bot_state, "❌ Это не твоя кнопка!")
 
 
 @dp.callback_query(F.data.startswith("box_") | F.data.startswith("abox_"))
@@ -549,17 +508,17 @@ async def callback_box_open(query: types.CallbackQuery, bot_state: BotState):
     if not query.message:
         return
 
-    try:
-        parts = query.data.split("_")
-        if len(parts) != 3:
-            raise ValueError("Invalid format")
-
-        is_admin_box = parts[0] == "abox"
-        owner_user_id = int(parts[1])
-        button_id = parts[2]
-    except (IndexError, ValueError):
+    unpacked = unpack_box_callback(bot_state.config.callback_secret, query.data)
+    # Кнопки, выданные до подписанного формата, работают ещё одно окно кулдауна
+    legacy = unpack_legacy_box_callback(query.data) if unpacked is None else None
+    if unpacked is not None:
+        box_prefix, owner_user_id, nonce, outcome = unpacked
+    elif legacy is not None:
+        box_prefix, owner_user_id, button_id = legacy
+    else:
         await query.answer("Ошибка данных!", show_alert=True)
         return
+    is_admin_box = box_prefix == "abox"
 
     if query.from_user.id != owner_user_id:
         await query.answer("Это не твой ящик!", show_alert=True)
@@ -569,35 +528,30 @@ async def callback_box_open(query: types.CallbackQuery, bot_state: BotState):
     chat_id = query.message.chat.id
     username = query.from_user.full_name
 
-    outcome = await claim_box_mapping(user_id_str, button_id)
-    if outcome is None:
+    if legacy is not None:
+        outcome = await storage.claim_legacy_box(user_id_str, button_id)
+        claimed = outcome in BOX_OUTCOMES
+    else:
+        claimed = await storage.claim_box(user_id_str, nonce)
+    if not claimed:
         await query.answer("Ты уже открыл ящик!", show_alert=True)
         return
 
     await query.answer()
 
-    messages_data = bot_state.messages
     if outcome == "win":
         loot = random.randint(10, 18)
-        text_key = random.choice(
-            messages_data.get("box_win", [{"text": "Ты нашёл {loot} ГП-5!", "image": "box_win.jpg"}]))
     elif outcome == "lose":
         loot = random.randint(-6, -3)
-        text_key = random.choice(
-            messages_data.get("box_lose", [{"text": "Потерял {loot} ГП-5!", "image": "box_lose.jpg"}]))
     else:
         loot = 0
-        text_key = random.choice(messages_data.get("box_empty", [{"text": "Пусто...", "image": "box_empty.jpg"}]))
+    event = bot_state.messages.pick(f"box_{outcome}")
 
-    new_gp5 = await atomic_add_gp5(chat_id, user_id_str, loot, username)
-    asyncio.create_task(update_global_stats(query.from_user.id, new_gp5, username))
+    new_gp5 = await storage.atomic_add_gp5(chat_id, user_id_str, loot, username)
+    storage.record_global_stats(query.from_user.id, new_gp5, username, decreased=loot < 0, chat_id=chat_id)
 
     old_gp5 = new_gp5 - loot
 
-    event_text = text_key["text"]
-    if "{loot}" in event_text:
-        event_text = event_text.format(loot=abs(loot))
-
     if loot > 0:
         loot_str = f"\\+{loot}"
     elif loot < 0:
@@ -607,13 +561,13 @@ async def callback_box_open(query: types.CallbackQuery, bot_state: BotState):
 
     caption = (
         f"*📻 Результат:*\n\n"
-        f"{escape_markdown_v2(event_text)}\n\n"
+        f"{event.template.render_md(abs(loot))}\n\n"
         f"*☢️{loot_str} ГП\\-5*\n"
         f"{format_balance_change(old_gp5, new_gp5)} ГП\\-5"
     )
 
-    image_filename = text_key.get("image")
-    file_id = await get_cached_file_id(image_filename) if image_filename else None
+    image_filename = event.image
+    file_id = get_cached_file_id(image_filename) if image_filename else None
 
     edited = False
 
@@ -630,6 +584,7 @@ async def callback_box_open(query: types.CallbackQuery, bot_state: BotState):
             edited = True
         except Exception as e:
             logging.warning(f"Edit with cached file_id failed: {e}")
+            media_cache.drop(image_filename)
 
     if not edited and image_filename:
         image_path = safe_image_path(image_filename)
@@ -664,8 +619,8 @@ async def callback_box_open(query: types.CallbackQuery, bot_state: BotState):
 
     if not edited:
         keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="Профиль", callback_data=f"profile_{query.from_user.id}")],
-            [InlineKeyboardButton(text="Топ чата", callback_data="top")]
+            [InlineKeyboardButton(text="Профиль", callback_data=f"profile_{query.from_user.id}_new")],
+            [InlineKeyboardButton(text="Топ чата", callback_data="top_new")]
         ])
         await query.message.reply(
             caption,
@@ -688,13 +643,15 @@ async def cmd_admin_help(message: types.Message, bot_state: BotState):
         return
     help_text = (
         "🛠 *Админ\\-команды:*\n\n"
-        "📌 /give \\<кол\\-во\\> \\<ID\\> \\[chat\\_id\\] — выдать ГП\\-5\n"
+        "📌 /give \\<кол\\-во\\> \\<ID\\[,ID…\\]\\> \\[chat\\_id\\] — выдать ГП\\-5 \\(или файл с ID\\)\n"
         "📌 /reset — сбросить таймеры\n"
         "📌 /info \\<user\\_id\\> — информация об игроке\n"
         "📌 /check\\_user \\<user\\_id\\> — проверка данных игрока\n"
         "📌 /chatstats — статистика по чатам\n"
         "📌 /post — разослать пост \\(ответ на сообщение\\)\n"
-        "📌 /recalc\\_stats — пересчитать глобальную статистику\n\n"
+        "📌 /recalc\\_stats — пересчитать глобальную статистику\n"
+        "📌 /migrations — состояние миграций базы\n"
+        "📌 /reload\\_messages — перечитать messages\\.json без перезапуска\n\n"
         "🖼 /cache\\_images — закэшировать все изображения\n"
         "🖼 /clear\\_image\\_cache — очистить кэш изображений\n"
         "🖼 /cache\\_status — статус кэша изображений\n\n"
@@ -727,91 +684,19 @@ async def cmd_cache_images(message: types.Message, bot_state: BotState):
         )
         return
 
-    from utils import _file_id_cache
-
-    # Собираем все уникальные изображения из messages.json
-    images = set()
-    messages_data = bot_state.messages
-
-    # Из событий success
-    for event in messages_data.get("success", []):
-        if event.get("image"):
-            images.add(event["image"])
-
-    # Из событий fail
-    for event in messages_data.get("fail", []):
-        if event.get("image"):
-            images.add(event["image"])
-
-    # Super событие
-    super_event = messages_data.get("super", {})
-    if super_event.get("image"):
-        images.add(super_event["image"])
-
-    # Box события
-    for event in messages_data.get("box_win", []):
-        if event.get("image"):
-            images.add(event["image"])
-    for event in messages_data.get("box_lose", []):
-        if event.get("image"):
-            images.add(event["image"])
-    for event in messages_data.get("box_empty", []):
-        if event.get("image"):
-            images.add(event["image"])
-
-    # Ранги
-    for rank in messages_data.get("ranks", []):
-        if rank.get("image"):
-            images.add(rank["image"])
-
-    # Welcome
-    welcome = messages_data.get("welcome", {})
-    if welcome.get("image"):
-        images.add(welcome["image"])
-
-    # Closed.jpg для box
-    images.add("closed.jpg")
+    # Все уникальные изображения messages.json — готовый манифест каталога
+    images = bot_state.messages.assets
 
     await message.reply(f"🔄 Начинаю кэширование {len(images)} изображений...")
 
-    cached = 0
-    failed = 0
-    skipped = 0
-    failed_list = []
-
-    for filename in sorted(images):
-        # Проверяем, есть ли уже в кэше
-        existing_file_id = await get_cached_file_id(filename)
-        if existing_file_id:
-            skipped += 1
-            continue
-
-        image_path = safe_image_path(filename)
-        if not image_path:
-            failed += 1
-            failed_list.append(f"❌ {filename} — файл не найден")
-            continue
+    # Свежая сборка build_assets.py подхватывается без перезапуска
+    await load_optimized_assets()
 
-        try:
-            # Отправляем в медиа-канал
-            msg = await bot.send_photo(
-                chat_id=bot_state.config.media_channel_id,
-                photo=FSInputFile(image_path),
-                caption=f"📦 Cache: {filename}"
-            )
-
-            if msg.photo:
-                file_id = msg.photo[-1].file_id
-                await save_file_id(filename, file_id)
-                cached += 1
-                logger.info(f"Cached: {filename} -> {file_id[:20]}...")
-
-            await asyncio.sleep(0.5)  # Избегаем rate limit
-
-        except Exception as e:
-            failed += 1
-            failed_list.append(f"❌ {filename} — {str(e)[:50]}")
-            logging.error(f"Failed to cache {filename}: {e}")
+    report = await media_cache.preupload(bot, bot_state.config.media_channel_id, images)
+    cached = report["cached"]
+    skipped = report["skipped"]
+    failed = len(report["failed"])
+    failed_list = [f"❌ {filename} — {error}" for filename, error in report["failed"]]
 
     result_text = (
         f"✅ *Кэширование завершено\\!*\n\n"
@@ -819,6 +704,10 @@ async def cmd_cache_images(message: types.Message, bot_state: BotState):
         f"⏭ Уже в кэше: *{skipped}*\n"
         f"❌ Ошибок: *{failed}*"
     )
+    if cached:
+        megabytes = escape_markdown_v2(f"{report['bytes'] / 1024 / 1024:.1f}")
+        seconds = escape_markdown_v2(f"{report['seconds']:.1f}")
+        result_text += f"\n\n📤 Загружено {megabytes} МБ за {seconds} с"
 
     if failed_list:
         result_text += "\n\n*Ошибки:*\n" + escape_markdown_v2("\n".join(failed_list[:10]))
@@ -832,15 +721,11 @@ async def cmd_clear_image_cache(message: types.Message, bot_state: BotState):
     if not is_admin(message.from_user.id, bot_state):
         return
 
-    from utils import _file_id_cache
-
     # Очищаем память
-    memory_count = len(_file_id_cache)
-    _file_id_cache.clear()
+    memory_count = media_cache.clear()
 
     # Очищаем БД
-    result = await db[MEDIA_CACHE_COLLECTION].delete_many({})
-    db_count = result.deleted_count
+    db_count = await storage.clear_media_cache()
 
     await message.reply(
         f"✅ *Кэш изображений очищен\\!*\n\n"
@@ -856,43 +741,14 @@ async def cmd_cache_status(message: types.Message, bot_state: BotState):
     if not is_admin(message.from_user.id, bot_state):
         return
 
-    from utils import _file_id_cache
-
     # Считаем в памяти
-    memory_count = len(_file_id_cache)
+    memory_count = len(media_cache)
 
     # Считаем в БД
-    db_count = await db[MEDIA_CACHE_COLLECTION].count_documents({})
-
-    # Собираем все нужные изображения
-    images = set()
-    messages_data = bot_state.messages
-
-    for event in messages_data.get("success", []):
-        if event.get("image"):
-            images.add(event["image"])
-    for event in messages_data.get("fail", []):
-        if event.get("image"):
-            images.add(event["image"])
-    super_event = messages_data.get("super", {})
-    if super_event.get("image"):
-        images.add(super_event["image"])
-    for event in messages_data.get("box_win", []):
-        if event.get("image"):
-            images.add(event["image"])
-    for event in messages_data.get("box_lose", []):
-        if event.get("image"):
-            images.add(event["image"])
-    for event in messages_data.get("box_empty", []):
-        if event.get("image"):
-            images.add(event["image"])
-    for rank in messages_data.get("ranks", []):
-        if rank.get("image"):
-            images.add(rank["image"])
-    welcome = messages_data.get("welcome", {})
-    if welcome.get("image"):
-        images.add(welcome["image"])
-    images.add("closed.jpg")
+    db_count = await storage.count_media_cache()
+
+    # Все нужные изображения — из манифеста каталога
+    images = bot_state.messages.assets
 
     total_needed = len(images)
 
@@ -900,8 +756,8 @@ async def cmd_cache_status(message: types.Message, bot_state: BotState):
     cached_count = 0
     not_cached = []
 
-    for filename in sorted(images):
-        file_id = await get_cached_file_id(filename)
+    for filename in images:
+        file_id = get_cached_file_id(filename)
         if file_id:
             cached_count += 1
         else:
@@ -950,7 +806,7 @@ async def cmd_info(message: types.Message, bot_state: BotState):
     except ValueError:
         await message.reply("❌ ID пользователя должен быть числом!")
         return
-    info = await get_admin_user_info(target_user_id_str)
+    info = await storage.get_admin_user_info(target_user_id_str)
     if not info["exists_globally"] and info["chats_count"] == 0:
         await message.reply(
             f"❌ Пользователь `{target_user_id}` не найден в базе данных",
@@ -966,7 +822,7 @@ async def cmd_info(message: types.Message, bot_state: BotState):
     global_gp5 = info["global_gp5"]
     rank = get_user_rank(global_gp5, bot_state.messages)
     username = escape_markdown_v2(info["username"])
-    rank_name = escape_markdown_v2(rank["name"])
+    rank_name = rank["name_md"]
     rank_emoji = rank["emoji"]
     cooldown_data = info.get("cooldown_data", {})
     dig_data = cooldown_data.get("dig", {})
@@ -1024,17 +880,22 @@ async def cmd_give(message: types.Message, bot_state: BotState):
         await message.reply("❌ Неизвестная команда")
         return
 
-    args = message.text.split()
-    if len(args) < 3:
+    args = (message.text or message.caption or "").split()
+    document = message.document or (message.reply_to_message and message.reply_to_message.document)
+    if len(args) < 2 or (len(args) < 3 and not document):
         await message.reply(
             "⚙️ *Использование команды /give:*\n\n"
             "• Выдать в конкретный чат:\n"
             "`/give <кол-во> <user_id> <chat_id>`\n\n"
             "• Выдать во все чаты пользователя:\n"
             "`/give <кол-во> <user_id>`\n\n"
+            "• Выдать нескольким игрокам:\n"
+            "`/give <кол-во> <id1>,<id2>,... [chat_id]`\n"
+            "или `/give <кол-во> [chat_id]` с файлом ID (подписью или ответом на файл)\n\n"
             "*Примеры:*\n"
             "`/give 100 123456789 -100500500`\n"
-            "`/give 50 987654321`",
+            "`/give 50 987654321`\n"
+            "`/give 10 111,222,333`",
             parse_mode="Markdown"
         )
         return
@@ -1048,41 +909,68 @@ async def cmd_give(message: types.Message, bot_state: BotState):
         await message.reply("❌ Количество ГП-5 должно быть числом!")
         return
 
-    try:
-        target_user_id = int(args[2])
-        target_user_id_str = str(target_user_id)
-    except ValueError:
-        await message.reply("❌ ID пользователя должен быть числом!")
+    if document:
+        if document.file_size and document.file_size > BULK_GIVE_MAX_FILE_SIZE:
+            await message.reply("❌ Файл со списком ID слишком большой")
+            return
+        content = await bot.download(document)
+        target_ids = parse_user_ids(content.read().decode('utf-8', errors='ignore'))
+        chat_arg = args[2] if len(args) >= 3 else None
+    else:
+        if not re.fullmatch(r'\d+(,\d+)*,?', args[2]):
+            await message.reply("❌ ID пользователя должен быть числом!")
+            return
+        target_ids = parse_user_ids(args[2])
+        chat_arg = args[3] if len(args) >= 4 else None
+
+    if not target_ids:
+        await message.reply("❌ Не найдено ни одного ID пользователя")
         return
 
-    specific_chat = len(args) >= 4
     target_chat_id = None
-
-    if specific_chat:
+    if chat_arg is not None:
         try:
-            target_chat_id = int(args[3])
+            target_chat_id = int(chat_arg)
         except ValueError:
             await message.reply("❌ ID чата должен быть числом!")
             return
 
-    if specific_chat and target_chat_id:
-        chat_data = await load_data(CHAT_DATA_COLLECTION, target_chat_id)
-        if target_user_id_str not in chat_data:
+    sign = "+" if amount > 0 else ""
+
+    if len(target_ids) > 1:
+        summary = await storage.bulk_add_gp5(target_ids, amount, chat_id=target_chat_id)
+        best_id = max(summary, key=lambda uid: summary[uid]['max_gp5'], default=None)
+        result = (
+            f"✅ Готово! Выдано *{sign}{amount}* ГП-5\n"
+            f"👥 Игроков в списке: *{len(target_ids)}*, найдено: *{len(summary)}*\n"
+            f"📊 Обновлено записей: *{sum(info['chats'] for info in summary.values())}*"
+        )
+        if target_chat_id:
+            result += f"\n💬 Чат: `{target_chat_id}`"
+        if best_id:
+            result += f"\n🏆 Наибольший новый максимум: *{summary[best_id]['max_gp5']}* ГП-5 (`{best_id}`)"
+        await message.reply(result, parse_mode="Markdown")
+        return
+
+    target_user_id_str = target_ids[0]
+    target_user_id = int(target_user_id_str)
+
+    if target_chat_id:
+        player = await storage.get_player(target_chat_id, target_user_id_str)
+        if not player:
             await message.reply(
                 f"❌ Пользователь `{target_user_id}` не найден в чате `{target_chat_id}`",
                 parse_mode="Markdown"
             )
             return
 
-        old_gp5 = chat_data[target_user_id_str].get("gp5", 0)
-        new_gp5 = old_gp5 + amount
-        chat_data[target_user_id_str]["gp5"] = new_gp5
-        username = chat_data[target_user_id_str].get("username", "Неизвестный")
-
-        await save_data(chat_data, CHAT_DATA_COLLECTION, target_chat_id)
-        await update_global_stats(target_user_id, new_gp5, username)
+        username = player.get("username", "Неизвестный")
+        new_gp5 = await storage.atomic_add_gp5(target_chat_id, target_user_id_str, amount, username)
+        old_gp5 = new_gp5 - amount
+        await storage.update_global_stats(
+            target_user_id, new_gp5, username, decreased=amount < 0, chat_id=target_chat_id
+        )
 
-        sign = "+" if amount > 0 else ""
         await message.reply(
             f"✅ Успешно выдано *{sign}{amount}* ГП-5\n"
             f"👤 Пользователь: `{target_user_id}`\n"
@@ -1091,43 +979,21 @@ async def cmd_give(message: types.Message, bot_state: BotState):
             parse_mode="Markdown"
         )
     else:
-        updated_chats = 0
-        username = "Неизвестный"
-        max_new_gp5 = 0
-
-        async for doc in db[CHAT_DATA_COLLECTION].find():
-            chat_id = doc["_id"]
-            chat_data = doc.get("data", {})
-
-            if target_user_id_str in chat_data:
-                old_gp5 = chat_data[target_user_id_str].get("gp5", 0)
-                new_gp5 = old_gp5 + amount
-                chat_data[target_user_id_str]["gp5"] = new_gp5
-                username = chat_data[target_user_id_str].get("username", username)
-
-                if new_gp5 > max_new_gp5:
-                    max_new_gp5 = new_gp5
-
-                await db[CHAT_DATA_COLLECTION].replace_one(
-                    {"_id": chat_id},
-                    {"_id": chat_id, "data": chat_data}
-                )
-                updated_chats += 1
+        # Один $inc по индексу user_id сразу во всех чатах игрока
+        summary = await storage.bulk_add_gp5([target_user_id_str], amount)
+        info = summary.get(target_user_id_str)
 
-        if updated_chats == 0:
+        if not info:
             await message.reply(
                 f"❌ Пользователь `{target_user_id}` не найден ни в одном чате",
                 parse_mode="Markdown"
             )
         else:
-            await update_global_stats(target_user_id, max_new_gp5, username)
-
-            sign = "+" if amount > 0 else ""
             await message.reply(
                 f"✅ Готово! Выдано *{sign}{amount}* ГП-5 в каждый чат\n"
                 f"👤 Пользователь: `{target_user_id}`\n"
-                f"📊 Обновлено чатов: *{updated_chats}*\n"
-                f"🏆 Новый максимум: *{max_new_gp5}* ГП-5",
+                f"📊 Обновлено чатов: *{info['chats']}*\n"
+                f"🏆 Новый максимум: *{info['max_gp5']}* ГП-5",
                 parse_mode="Markdown"
             )
 
@@ -1144,34 +1010,27 @@ async def cmd_check_user(message: types.Message, bot_state: BotState):
 
     target_user_id = args[1]
 
-    chats_info = []
-    max_gp5 = 0
-
-    async for doc in db[CHAT_DATA_COLLECTION].find():
-        chat_id = doc["_id"]
-        chat_data = doc.get("data", {})
-
-        if target_user_id in chat_data:
-            user_data = chat_data[target_user_id]
-            gp5 = user_data.get("gp5", 0)
-            if gp5 > max_gp5:
-                max_gp5 = gp5
-            chats_info.append(f"• Чат `{chat_id}`: **{gp5}** ГП-5")
-
-    global_doc = await db['global_stats'].find_one({'_id': target_user_id})
-    stored_max = global_doc.get('max_gp5', 0) if global_doc else 0
+    # Настоящие балансы из players против записи global_stats — две точечные выборки
+    check = await storage.check_user_stats(target_user_id)
+    chats = sorted(check['chats'].items(), key=lambda item: item[1], reverse=True)
+    chats_info = [f"• Чат `{chat_id}`: **{gp5}** ГП-5" for chat_id, gp5 in chats]
 
     result = (
-            f"📊 **Проверка пользователя** `{target_user_id}`\n\n"
-            f"**По чатам:**\n" + "\n".join(chats_info) + "\n\n"
-                                                         f"**Максимум по чатам:** {max_gp5}\n"
-                                                         f"**В global_stats.max_gp5:** {stored_max}\n\n"
+        f"📊 **Проверка пользователя** `{target_user_id}`\n\n"
+        f"**По чатам (players):**\n" + "\n".join(chats_info) + "\n\n"
+        f"**Максимум по чатам:** {check['max_gp5']}\n"
+        f"**В global_stats.max_gp5:** {check['stored_max']}\n\n"
     )
 
-    if max_gp5 == stored_max:
-        result += "✅ Данные корректны!"
-    else:
-        result += f"⚠️ Расхождение: должно быть {max_gp5}, хранится {stored_max}"
+    problems = []
+    if check['max_gp5'] != check['stored_max']:
+        problems.append(f"⚠️ Расхождение: должно быть {check['max_gp5']}, хранится {check['stored_max']}")
+    for chat_id in check['chats_mismatch']:
+        problems.append(
+            f"⚠️ Чат `{chat_id}`: в players {check['chats'].get(chat_id, '—')}, "
+            f"в global_stats.chats {check['stored_chats'].get(chat_id, '—')}"
+        )
+    result += "\n".join(problems) if problems else "✅ Данные корректны!"
 
     await message.reply(result, parse_mode="Markdown")
 
@@ -1182,8 +1041,55 @@ async def cmd_recalc_stats(message: types.Message, bot_state: BotState):
         return
 
     await message.reply("🔄 Начинаю пересчёт глобальной статистики...")
-    count = await recalculate_global_stats()
-    await message.reply(f"✅ Пересчёт завершён! Обновлено {count} пользователей.")
+    result = await storage.recalculate_global_stats()
+    await message.reply(
+        f"✅ Пересчёт завершён! Обновлено {result['count']} пользователей.\n"
+        f"⏱ {result['seconds']} с, {result['rows_per_sec']} записей/с"
+    )
+
+
+@dp.message(Command("migrations"))
+async def cmd_migrations(message: types.Message, bot_state: BotState):
+    if not is_admin(message.from_user.id, bot_state):
+        return
+
+    status = await storage.get_migration_status()
+    if status is None:
+        await message.reply("ℹ️ Это хранилище не использует миграции.")
+        return
+
+    lines = [
+        f"🗄 Версия схемы: {status['version']} из {status['target']}",
+        f"⏳ Выполняется: {'да' if status['running'] else 'нет'}",
+        ""
+    ]
+    for step in status['steps']:
+        progress = f"{step['processed']}/{step['total']}" if step['total'] else str(step['processed'])
+        lines.append(f"• v{step['version']} {step['name']}: {step['status']} ({progress})")
+        if step['error']:
+            lines.append(f"  ⚠️ {step['error'][:100]}")
+
+    await message.reply("\n".join(lines))
+
+
+@dp.message(Command("reload_messages"))
+async def cmd_reload_messages(message: types.Message, bot_state: BotState):
+    if not is_admin(message.from_user.id, bot_state):
+        return
+
+    try:
+        report = await reload_messages(bot_state)
+    except Exception as e:
+        await message.reply(f"❌ messages.json не перезагружен, работает прежняя версия:\n{str(e)[:500]}")
+        return
+
+    lines = [
+        f"✅ messages.json перезагружен за {report['seconds'] * 1000:.1f} мс",
+        f"🖼 Картинок в манифесте: {report['assets']}",
+        ""
+    ]
+    lines += [f"• {change}" for change in report['changes']] or ["Изменений нет"]
+    await message.reply("\n".join(lines))
 
 
 @dp.message(Command("reset"))
@@ -1206,7 +1112,7 @@ async def cmd_resetcooldown(message: types.Message, bot_state: BotState):
             target_user_id = int(args[1])
             target_user_id_str = str(target_user_id)
             # Пытаемся найти имя пользователя в базе
-            info = await get_admin_user_info(target_user_id_str)
+            info = await storage.get_admin_user_info(target_user_id_str)
             target_username = info.get("username", f"ID: {target_user_id}")
         except ValueError:
             await message.reply(
@@ -1233,7 +1139,7 @@ async def cmd_resetcooldown(message: types.Message, bot_state: BotState):
         return
 
     target_user_id_str = str(target_user_id)
-    user_data = await get_user_cooldown(target_user_id_str)
+    user_data = await storage.get_user_cooldown(target_user_id_str)
 
     if not user_data:
         await message.reply(
@@ -1245,7 +1151,7 @@ async def cmd_resetcooldown(message: types.Message, bot_state: BotState):
 
     reset_dig = "dig" in user_data
     reset_box = "box" in user_data
-    await delete_user_cooldowns(target_user_id_str)
+    await storage.delete_user_cooldowns(target_user_id_str)
 
     parts = []
     if reset_dig:
@@ -1266,26 +1172,15 @@ async def cmd_resetcooldown(message: types.Message, bot_state: BotState):
 async def cmd_promoclean(message: types.Message, bot_state: BotState):
     if not is_admin(message.from_user.id, bot_state):
         return
-    promos = await load_data(PROMO_COLLECTION)
-    if not promos:
+    deleted, left = await storage.delete_exhausted_promos()
+    before_count = deleted + left
+    if not before_count:
         await message.reply("ℹ️ Промокодов нет вообще.")
         return
-    before_count = len(promos)
-    codes_to_delete = []
-    for code, data in promos.items():
-        max_uses = data.get("uses", -1)
-        if max_uses == -1:
-            continue
-        used_count = len(data.get("used_by", {}))
-        if used_count >= max_uses:
-            codes_to_delete.append(code)
-    for code in codes_to_delete:
-        del promos[code]
-    await save_data(promos, PROMO_COLLECTION)
     await message.reply(
         f"🧹 *Очистка промокодов завершена\\!*\n\n"
-        f"🗑 Удалено: *{len(codes_to_delete)}*\n"
-        f"📋 Осталось: *{len(promos)}* \\(было {before_count}\\)",
+        f"🗑 Удалено: *{deleted}*\n"
+        f"📋 Осталось: *{left}* \\(было {before_count}\\)",
         parse_mode="MarkdownV2"
     )
 
@@ -1298,8 +1193,10 @@ async def cmd_chat_stats(message: types.Message, bot_state: BotState):
     loading_msg = await message.reply("📊 Собираю статистику...")
 
     try:
-        stats = await get_bot_statistics()
-        chat_stats = await get_active_chats_stats()
+        stats = await storage.get_statistics()
+        chat_stats = stats["chats"]
+        today = stats["today"]
+        week = stats["week"]
 
         def fmt(n):
             formatted = f"{n:,}".replace(",", " ")
@@ -1329,7 +1226,11 @@ async def cmd_chat_stats(message: types.Message, bot_state: BotState):
             f"└ Групп/супергрупп: *{fmt(chat_stats['groups'])}*/*{fmt(chat_stats['supergroups'])}*\n\n"
             f"📈 *Показатели:*\n"
             f"├ Макс\\. игроков в чате: *{fmt(max_in_chat)}*\n"
-            f"└ Среднее: *{fmt_float(avg_per_chat)}*"
+            f"└ Среднее: *{fmt_float(avg_per_chat)}*\n\n"
+            f"🗓 *Активность сегодня / за 7д:*\n"
+            f"├ Вылазок: *{fmt(today['digs'])}* / *{fmt(week['digs'])}*\n"
+            f"├ Ящиков: *{fmt(today['boxes'])}* / *{fmt(week['boxes'])}*\n"
+            f"└ Новых игроков: *{fmt(today['new_players'])}* / *{fmt(week['new_players'])}*"
         )
 
         if top:
@@ -1337,6 +1238,49 @@ async def cmd_chat_stats(message: types.Message, bot_state: BotState):
             top_gp5 = fmt(top.get("gp5", 0))
             stats_text += f"\n\n🏆 *Лидер:* {top_name} — *{top_gp5}* ГП\\-5"
 
+        buffer_lines = [
+            f"• {escape_markdown_v2(m['name'])}: очередь *{fmt(m['pending'])}*, "
+            f"слито *{fmt(m['coalesced'])}*, потеряно *{fmt(m['dropped'])}*, "
+            f"сброс *{fmt_float(m['last_flush_ms'])}*/{fmt_float(m['max_flush_ms'])} мс"
+            for m in storage.get_write_behind_metrics()
+        ]
+        stats_text += "\n\n⚙️ *Отложенная запись:*\n" + "\n".join(buffer_lines)
+        top_cache = storage.chat_top_cache.metrics()
+        stats_text += (
+            f"\n\n🗂 *Кэш топов чатов:* {fmt(top_cache['size'])} чатов, "
+            f"попаданий *{fmt_float(top_cache['hit_rate'])}%* "
+            f"\\({fmt(top_cache['hits'])}/{fmt(top_cache['hits'] + top_cache['misses'])}\\), "
+            f"правок *{fmt(top_cache['patched'])}*, сбросов *{fmt(top_cache['invalidations'])}*"
+        )
+        subs = subscription_cache.metrics()
+        stats_text += (
+            f"\n📡 *Кэш подписок:* {fmt(subs['size'])} игроков, "
+            f"попаданий *{fmt_float(subs['hit_rate'])}%*, "
+            f"запросов к API *{fmt(subs['api_calls'])}* \\(ошибок {fmt(subs['api_errors'])}\\), "
+            f"склеено *{fmt(subs['coalesced'])}*, обновлений *{fmt(subs['updates'])}*"
+        )
+        media = media_cache.metrics()
+        stats_text += (
+            f"\n🖼 *Кэш file\\_id:* {fmt(media['size'])} картинок, "
+            f"попаданий *{fmt_float(media['hit_rate'])}%*, "
+            f"загружено *{fmt(media['stored'])}*, сброшено *{fmt(media['dropped'])}*"
+        )
+        views = view_cache.metrics()
+        stats_text += (
+            f"\n🧭 *Навигация:* правок *{fmt(views['edits'])}*, "
+            f"без изменений *{fmt(views['unchanged'])}* \\({fmt_float(views['skip_rate'])}%\\), "
+            f"новых сообщений *{fmt(views['fallbacks'])}*"
+        )
+        messages_filter = prefilter.metrics()
+        stats_text += (
+            f"\n🚦 *Префильтр сообщений:* команд *{fmt(messages_filter['commands'])}*, "
+            f"триггеров *{fmt(messages_filter['triggers'])}*, "
+            f"отброшено *{fmt(messages_filter['dropped'])}* \\({fmt_float(messages_filter['drop_rate'])}%\\)"
+        )
+        if stats["reconciled_at"]:
+            reconciled = escape_markdown_v2(stats["reconciled_at"].strftime('%H:%M:%S'))
+            stats_text += f"\n\n🔄 Сверка счётчиков: {reconciled} UTC"
+
         await loading_msg.edit_text(stats_text, parse_mode="MarkdownV2")
 
     except Exception as e:
@@ -1344,25 +1288,15 @@ async def cmd_chat_stats(message: types.Message, bot_state: BotState):
         await loading_msg.edit_text("❌ Ошибка при сборе статистики")
 
 async def send_post_to_all(reply_msg: types.Message, admin_chat_id: int):
-    chats_data = await load_data(CHATS_LIST_COLLECTION)
-    total_chats = len(chats_data)
+    # Неактивные чаты отсекаются запросом к реестру
+    chat_ids = await storage.get_broadcast_chat_ids()
+    total_chats = len(chat_ids)
     successful = 0
     failed = 0
     inactive_marked = 0
     progress_interval = 50
 
-    for idx, (chat_id_str, chat_info) in enumerate(list(chats_data.items()), 1):
-        try:
-            target_chat_id = int(chat_id_str)
-        except ValueError:
-            failed += 1
-            continue
-
-        # Пропускаем уже помеченные как неактивные
-        if isinstance(chat_info, dict) and chat_info.get('status') == 'inactive':
-            failed += 1
-            continue
-
+    for idx, target_chat_id in enumerate(chat_ids, 1):
         try:
             if reply_msg.photo:
                 await bot.send_photo(
@@ -1390,11 +1324,10 @@ async def send_post_to_all(reply_msg: types.Message, admin_chat_id: int):
                 'bot is not a member', 'have no rights', 'chat_write_forbidden',
                 'user is deactivated', 'group chat was upgraded', 'need administrator rights'
             ]):
-                await mark_chat_inactive(target_chat_id, error_str[:100])
+                await storage.mark_chat_inactive(target_chat_id, error_str[:100])
                 inactive_marked += 1
             elif 'too many requests' in error_str or 'retry after' in error_str:
                 # При flood wait ждём указанное время
-                import re
                 match = re.search(r'retry after (\d+)', error_str)
                 wait_time = int(match.group(1)) if match else 30
                 await asyncio.sleep(wait_time)
@@ -1450,8 +1383,8 @@ async def cmd_post(message: types.Message, bot_state: BotState):
     if not message.reply_to_message:
         await message.reply("💡 Ответьте на сообщение, которое нужно разослать!")
         return
-    chats_data = await load_data(CHATS_LIST_COLLECTION)
-    total_chats = len(chats_data)
+    chat_stats = await storage.get_active_chats_stats()
+    total_chats = chat_stats['total'] - chat_stats['inactive']
     await message.reply(f"📤 Рассылка запущена в *{total_chats}* чатов...", parse_mode="Markdown")
     asyncio.create_task(send_post_to_all(message.reply_to_message, message.chat.id))
 
@@ -1480,16 +1413,7 @@ async def cmd_promoadd(message: types.Message, bot_state: BotState):
             parse_mode="Markdown"
         )
         return
-    from datetime import datetime
-    promos = await load_data(PROMO_COLLECTION)
-    promos[code] = {
-        "amount": amount,
-        "uses": uses,
-        "duration": 0,
-        "used_by": {},
-        "created_at": datetime.now().isoformat()
-    }
-    await save_data(promos, PROMO_COLLECTION)
+    await storage.create_promo(code, amount, uses)
     uses_text = "неограничено" if uses == -1 else str(uses)
     await message.reply(
         f"✅ *Промокод создан\\!*\n\n"
@@ -1517,19 +1441,7 @@ async def cmd_promo(message: types.Message, bot_state: BotState):
     user_id = str(message.from_user.id)
     bunker_id = message.chat.id
 
-    promos = await load_data(PROMO_COLLECTION)
-    if code not in promos:
-        await send_temporary_message(
-            message,
-            "Промокод не найден!",
-            delete_after=10
-        )
-        return
-
-    promo_data = promos[code]
-    amount = promo_data["amount"]
-
-    success, reason = await atomic_use_promo(code, user_id, amount)
+    success, reason, amount = await storage.atomic_use_promo(code, user_id)
     if not success:
         error_messages = {
             "not_found": "Промокод не найден!",
@@ -1543,8 +1455,8 @@ async def cmd_promo(message: types.Message, bot_state: BotState):
         )
         return
 
-    new_gp5 = await atomic_add_gp5(bunker_id, user_id, amount, message.from_user.full_name)
-    await update_global_stats(message.from_user.id, new_gp5, message.from_user.full_name)
+    new_gp5 = await storage.atomic_add_gp5(bunker_id, user_id, amount, message.from_user.full_name)
+    storage.record_global_stats(message.from_user.id, new_gp5, message.from_user.full_name, chat_id=bunker_id)
 
     old_gp5 = new_gp5 - amount
 
@@ -1560,14 +1472,15 @@ async def cmd_promo(message: types.Message, bot_state: BotState):
 async def cmd_promoinfo(message: types.Message, bot_state: BotState):
     if not is_admin(message.from_user.id, bot_state):
         return
-    promos = await load_data(PROMO_COLLECTION)
+    promos = await storage.list_promos()
     if not promos:
         await message.reply("ℹ️ Нет активных промокодов")
         return
     info_lines = ["📊 *Информация о промокодах:*\n"]
-    for code, data in promos.items():
+    for data in promos:
+        code = data['_id']
         uses_limit = 'безлимит' if data['uses'] == -1 else str(data['uses'])
-        used_count = len(data.get('used_by', {}))
+        used_count = data.get('used_count', 0)
         info_lines.append(
             f"🎟 `{escape_markdown_v2(code)}`\n"
             f"   💰 Награда: *{data['amount']}* ГП\\-5\n"
@@ -1595,37 +1508,23 @@ async def cmd_testevents(message: types.Message, bot_state: BotState):
         await message.reply("❌ Доступные типы: `success`, `fail`, `super`", parse_mode="Markdown")
         return
     await message.reply(f"🔄 Запускаю показ всех событий типа «{event_type}»...")
-    messages_data = bot_state.messages
+    events_list = bot_state.messages.events[event_type]
     if event_type == "success":
-        events_list = messages_data.get("success", [])
         loot_values = [1, 2, 3, 4, 5]
+        loot_type = "normal"
     elif event_type == "fail":
-        events_list = messages_data.get("fail", [])
         loot_values = [-1, -2, -3]
+        loot_type = "fail"
     else:
-        super_events = messages_data.get("super", {})
-        events_list = super_events if isinstance(super_events, list) else [super_events]
         loot_values = [40]
-    if not events_list:
-        await message.reply(f"❌ Нет событий типа «{event_type}» в messages.json")
-        return
+        loot_type = "super"
     for idx, event in enumerate(events_list):
         loot = loot_values[idx % len(loot_values)]
-        if event_type == "success":
-            event_text = event["text"].format(loot)
-            loot_type = "normal"
-        elif event_type == "fail":
-            event_text = event["text"].format(-loot)
-            loot_type = "fail"
-        else:
-            event_text = event.get("text", "⚡ СВЕРХРЕДКАЯ НАХОДКА! ⚡")
-            loot = 40
-            loot_type = "super"
-        caption_text = format_dig_result(event_text, loot, loot_type)
+        caption_text = format_dig_result(event.template.render_md(abs(loot)), loot, loot_type)
         await send_response(
             message,
             caption_text,
-            image=event.get("image"),
+            image=event.image,
             parse_mode="MarkdownV2"
         )
         await asyncio.sleep(1)
@@ -1637,12 +1536,7 @@ async def cmd_maintenance_on(message: types.Message, bot_state: BotState):
     if not is_admin(message.from_user.id, bot_state):
         return
     bot_state.maintenance = True
-    from database import db
-    await db['config'].update_one(
-        {'_id': 'maintenance'},
-        {'$set': {'value': 1}},
-        upsert=True
-    )
+    await storage.set_maintenance(True)
     for admin_id in bot_state.config.admin_ids:
         try:
             await bot.send_message(admin_id, "⚙️ Технические работы *включены*.", parse_mode="Markdown")
@@ -1657,12 +1551,7 @@ async def cmd_maintenance_off(message: types.Message, bot_state: BotState):
     if not is_admin(message.from_user.id, bot_state):
         return
     bot_state.maintenance = False
-    from database import db
-    await db['config'].update_one(
-        {'_id': 'maintenance'},
-        {'$set': {'value': 0}},
-        upsert=True
-    )
+    await storage.set_maintenance(False)
     for admin_id in bot_state.config.admin_ids:
         try:
             await bot.send_message(admin_id, "✅ Технические работы *отключены*.", parse_mode="Markdown")
@@ -1671,19 +1560,43 @@ async def cmd_maintenance_off(message: types.Message, bot_state: BotState):
     await message.reply("✅ Технические работы *отключены*.\n\nБот работает в обычном режиме.", parse_mode="Markdown")
 
 
+async def preupload_assets():
+    """Фоновая предзагрузка картинок каталога при старте"""
+    try:
+        report = await media_cache.preupload(bot, bot_state.config.media_channel_id, bot_state.messages.assets)
+    except Exception as e:
+        logging.error(f"Media pre-upload failed: {e}")
+        return
+    for filename, error in report["failed"]:
+        logging.warning(f"Media pre-upload skipped {filename}: {error}")
+
+
 async def main():
-    await ensure_singleton_documents()
-    await migrate_database()
-    await ensure_indexes()
-    bot_state.maintenance = await load_initial_maintenance()
-    bot_state.messages = await load_messages()
+    await storage.prepare()
+    storage.start_background()
+    bot_state.maintenance = await storage.load_maintenance()
+    bot_state.messages = MessageCatalog.compile(await load_messages())
+    # Манифест оптимизированных картинок и file_id всех картинок — в память до первого апдейта
+    await load_optimized_assets()
+    await media_cache.preload()
     logger.info("=" * 50)
     logger.info("BOT STARTED")
     logger.info(f"Maintenance mode: {bot_state.maintenance}")
     logger.info(f"Admins: {bot_state.config.admin_ids}")
     logger.info(f"Media channel: {bot_state.config.media_channel_id}")
     logger.info("=" * 50)
-    await dp.start_polling(bot, skip_updates=True)
+    watcher = asyncio.create_task(watch_messages(bot_state)) if bot_state.config.watch_messages else None
+    # Картинки, которых нет в кэше, загружаются в медиа-канал в фоне
+    preupload = asyncio.create_task(preupload_assets()) if bot_state.config.media_channel_id else None
+    try:
+        await dp.start_polling(bot, skip_updates=True)
+    finally:
+        if watcher:
+            watcher.cancel()
+        if preupload:
+            preupload.cancel()
+        await storage.stop_background()
+        await storage.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,222 @@
+import os
+import time
+import asyncio
+import hashlib
+import logging
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.types import FSInputFile, InputMediaPhoto
+
+
+def media_key(filename: str, digest: str) -> str:
+    """_id записи кэша: имя файла + хэш содержимого"""
+    return f"{filename}@{digest}"
+
+
+def file_digest(path: str) -> str:
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            sha.update(chunk)
+    return sha.hexdigest()[:16]
+
+
+class MediaCache:
+    """
+    Кэш file_id картинок в памяти процесса, ключ — имя файла и хэш содержимого.
+    Вся коллекция media_cache загружается одним запросом при старте, после
+    этого отправки не ходят в базу: промах означает загрузку файла заново.
+    Заменённый в IMG/ файл получает новый хэш и потому загружается сам
+    (файл перепроверяется не чаще раза в recheck_interval секунд).
+    """
+
+    def __init__(self, resolve_path: Callable[[str], Optional[str]],
+                 batch_size: int = 10, concurrency: int = 3, retries: int = 3,
+                 recheck_interval: float = 5.0):
+        self._resolve_path = resolve_path
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.retries = retries
+        self.recheck_interval = recheck_interval
+        # Одновременно идёт одна предзагрузка: /cache_images ждёт стартовую
+        self._upload_lock = asyncio.Lock()
+        self._file_ids: Dict[str, str] = {}
+        # Хэш по пути файла пересчитывается, только когда меняются mtime или размер
+        self._digests: Dict[str, Tuple[int, int, str]] = {}
+        # Хэш по имени: путь и mtime проверяются не чаще раза в recheck_interval
+        self._checked: Dict[str, Tuple[float, Optional[str]]] = {}
+        # Последний известный file_id по имени — если локального файла нет
+        self._by_name: Dict[str, str] = {}
+        self.loaded = False
+
+        self.hits = 0
+        self.misses = 0
+        self.stored = 0
+        self.dropped = 0
+
+    def digest(self, filename: str) -> Optional[str]:
+        now = time.monotonic()
+        checked = self._checked.get(filename)
+        if checked and now - checked[0] < self.recheck_interval:
+            return checked[1]
+        digest = self._path_digest(self._resolve_path(filename))
+        self._checked[filename] = (now, digest)
+        return digest
+
+    def _path_digest(self, path: Optional[str]) -> Optional[str]:
+        if not path:
+            return None
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        cached = self._digests.get(path)
+        if cached and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+            return cached[2]
+        digest = file_digest(path)
+        self._digests[path] = (stat.st_mtime_ns, stat.st_size, digest)
+        return digest
+
+    async def preload(self) -> int:
+        """Загрузка всей коллекции media_cache одним запросом"""
+        from storage import get_storage
+        entries = await get_storage().load_media_cache()
+        for entry in entries:
+            self._file_ids[media_key(entry['filename'], entry['hash'])] = entry['file_id']
+            self._by_name[entry['filename']] = entry['file_id']
+        self.loaded = True
+        logging.info(f"Media cache preloaded: {len(entries)} file_ids")
+        return len(entries)
+
+    def _lookup(self, filename: str, digest: Optional[str]) -> Optional[str]:
+        if digest is None:
+            return self._by_name.get(filename)
+        return self._file_ids.get(media_key(filename, digest))
+
+    def get(self, filename: str) -> Optional[str]:
+        file_id = self._lookup(filename, self.digest(filename))
+        if file_id is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return file_id
+
+    async def put(self, filename: str, file_id: str):
+        digest = self.digest(filename)
+        self._by_name[filename] = file_id
+        if digest is None:
+            return
+        self.stored += 1
+        self._file_ids[media_key(filename, digest)] = file_id
+        from storage import get_storage
+        await get_storage().save_media_file_id(filename, digest, file_id)
+
+    async def preupload(self, bot: Bot, channel_id: int, filenames: Sequence[str]) -> dict:
+        """
+        Загрузка незакэшированных картинок в медиа-канал альбомами по batch_size
+        штук, не больше concurrency альбомов параллельно. Полученные file_id
+        сохраняются в БД одной пакетной записью.
+        """
+        async with self._upload_lock:
+            started = time.perf_counter()
+            pending, failed = [], []
+            for filename in filenames:
+                # Проверка без счётчиков hits/misses: они только про отправки
+                digest = await asyncio.to_thread(self.digest, filename)
+                if digest is None:
+                    if filename not in self._by_name:
+                        failed.append((filename, "файл не найден"))
+                elif self._lookup(filename, digest) is None:
+                    pending.append((filename, digest))
+            skipped = len(filenames) - len(pending) - len(failed)
+
+            batches = [pending[i:i + self.batch_size] for i in range(0, len(pending), self.batch_size)]
+            semaphore = asyncio.Semaphore(self.concurrency)
+            uploaded: List[Tuple[str, str, str]] = []
+            uploaded_bytes = 0
+
+            async def upload(batch):
+                nonlocal uploaded_bytes
+                async with semaphore:
+                    try:
+                        file_ids = await self._send_batch(bot, channel_id, [name for name, _ in batch])
+                    except Exception as e:
+                        logging.error(f"Failed to upload media batch {batch[0][0]}..: {e}")
+                        failed.extend((name, str(e)[:50]) for name, _ in batch)
+                        return
+                for (name, digest), file_id in zip(batch, file_ids):
+                    if file_id:
+                        self._file_ids[media_key(name, digest)] = file_id
+                        self._by_name[name] = file_id
+                        uploaded.append((name, digest, file_id))
+                        uploaded_bytes += os.path.getsize(self._resolve_path(name))
+                    else:
+                        failed.append((name, "нет фото в ответе"))
+
+            await asyncio.gather(*(upload(batch) for batch in batches))
+
+            if uploaded:
+                from storage import get_storage
+                await get_storage().save_media_file_ids(uploaded)
+                self.stored += len(uploaded)
+            seconds = time.perf_counter() - started
+            logging.info(f"Media pre-upload: {len(uploaded)} uploaded ({uploaded_bytes} bytes) "
+                         f"in {len(batches)} batches, {seconds:.1f} s, {skipped} cached, {len(failed)} failed")
+            return {"cached": len(uploaded), "skipped": skipped, "failed": failed,
+                    "bytes": uploaded_bytes, "seconds": seconds}
+
+    async def _send_batch(self, bot: Bot, channel_id: int, names: List[str]) -> List[Optional[str]]:
+        for attempt in range(self.retries + 1):
+            try:
+                if len(names) == 1:
+                    # Альбом требует минимум двух элементов
+                    messages = [await bot.send_photo(
+                        chat_id=channel_id,
+                        photo=FSInputFile(self._resolve_path(names[0])),
+                        caption=f"📦 Cache: {names[0]}"
+                    )]
+                else:
+                    messages = await bot.send_media_group(
+                        chat_id=channel_id,
+                        media=[
+                            InputMediaPhoto(media=FSInputFile(self._resolve_path(name)), caption=f"📦 Cache: {name}")
+                            for name in names
+                        ]
+                    )
+                return [msg.photo[-1].file_id if msg.photo else None for msg in messages]
+            except TelegramRetryAfter as e:
+                if attempt == self.retries:
+                    raise
+                logging.warning(f"Media upload flood control, retry in {e.retry_after}s")
+                await asyncio.sleep(e.retry_after)
+
+    def drop(self, filename: str):
+        """Забыть file_id, который Telegram перестал принимать"""
+        self.dropped += 1
+        self._by_name.pop(filename, None)
+        digest = self.digest(filename)
+        if digest is not None:
+            self._file_ids.pop(media_key(filename, digest), None)
+
+    def clear(self) -> int:
+        count = len(self._file_ids)
+        self._file_ids.clear()
+        self._by_name.clear()
+        return count
+
+    def __len__(self) -> int:
+        return len(self._file_ids)
+
+    def metrics(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "name": "media",
+            "size": len(self._file_ids),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups * 100, 1) if lookups else 0.0,
+            "stored": self.stored,
+            "dropped": self.dropped
+        }
@@ -0,0 +1,501 @@
+import time
+import heapq
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Dict, Optional, Tuple
+
+from utils import DIG_COOLDOWN_HOURS, BOX_COOLDOWN_HOURS
+from storage import Storage, player_key, box_key, utcnow
+from media_cache import media_key
+
+
+class MemoryStorage(Storage):
+    """
+    Хранилище в памяти процесса — для нагрузочных тестов и бенчмарков без MongoDB.
+    Между чтением и записью документа нет await, поэтому каждая операция атомарна
+    относительно других корутин, как одиночный update в MongoDB.
+    latency — искусственная задержка перед каждым запросом (имитация сети).
+    """
+
+    def __init__(self, latency: float = 0.0):
+        super().__init__()
+        self.latency = latency
+        self.players: Dict[str, dict] = {}
+        self.chat_players: Dict[int, Dict[str, dict]] = {}
+        self.user_players: Dict[str, Dict[int, dict]] = {}
+        self.cooldowns: Dict[str, dict] = {}
+        self.global_stats: Dict[str, dict] = {}
+        self.promo_codes: Dict[str, dict] = {}
+        self.promo_usage: Dict[Tuple[str, str], str] = {}
+        self.chats: Dict[int, dict] = {}
+        self.media_cache: Dict[str, dict] = {}
+        self.stats: Dict[str, dict] = {}
+        self.maintenance = False
+
+    async def _roundtrip(self):
+        # sleep(0) тоже отдаёт управление, как настоящий запрос к базе
+        await asyncio.sleep(self.latency)
+
+    def _upsert_player(self, chat_id: int, user_id: str, count: bool = True) -> dict:
+        key = player_key(chat_id, user_id)
+        doc = self.players.get(key)
+        if doc is None:
+            doc = {'_id': key, 'chat_id': chat_id, 'user_id': user_id}
+            self.players[key] = doc
+            self.chat_players.setdefault(chat_id, {})[user_id] = doc
+            self.user_players.setdefault(user_id, {})[chat_id] = doc
+            if count:
+                self.record_stats(daily={'new_players': 1}, totals={'total_player_records': 1})
+        return doc
+
+    def _user_max(self, user_id: str) -> Optional[dict]:
+        records = self.user_players.get(user_id)
+        if not records:
+            return None
+        return max(records.values(), key=lambda doc: doc.get('gp5', 0))
+
+    def _user_chats(self, user_id: str) -> Dict[str, int]:
+        return {str(chat_id): doc.get('gp5', 0) for chat_id, doc in self.user_players.get(user_id, {}).items()}
+
+    # --- Отложенная запись ---
+
+    async def flush_chat_activity(self, batch: dict):
+        await self._roundtrip()
+        for chat_id, info in batch.items():
+            chat = self.chats.setdefault(chat_id, {})
+            chat.update(info)
+            chat['status'] = 'active'
+            chat.pop('error', None)
+            chat.pop('error_at', None)
+
+    async def flush_global_stats(self, batch: dict):
+        await self._roundtrip()
+        new_users = sum(1 for user_id in batch if user_id not in self.global_stats)
+        self.record_stats(totals={'unique_players': new_users})
+        for user_id, update in batch.items():
+            stats = self.global_stats.setdefault(user_id, {'max_gp5': update['gp5'], 'chats': {}})
+            top = self._user_max(user_id) if update['decreased'] else None
+            if top is not None:
+                stats['max_gp5'] = top.get('gp5', 0)
+                stats['chats'] = self._user_chats(user_id)
+            else:
+                stats['max_gp5'] = max(stats['max_gp5'], update['gp5'])
+                stats['chats'].update(update['chats'])
+            stats['username'] = update['username']
+
+    async def flush_stats(self, batch: dict):
+        await self._roundtrip()
+        for (doc_id, field), amount in batch.items():
+            doc = self.stats.setdefault(doc_id, {})
+            doc[field] = doc.get(field, 0) + amount
+
+    # --- Техработы ---
+
+    async def load_maintenance(self) -> bool:
+        await self._roundtrip()
+        return self.maintenance
+
+    async def set_maintenance(self, value: bool):
+        await self._roundtrip()
+        self.maintenance = value
+
+    # --- Вылазки и ящики ---
+
+    async def apply_dig(
+            self,
+            chat_id: int,
+            user_id: str,
+            username: str,
+            *,
+            super_roll: bool,
+            success_roll: bool,
+            gain: int,
+            lost: int,
+            super_loot: int = 40,
+            cooldown_hours: int = DIG_COOLDOWN_HOURS,
+            bypass_cooldown: bool = False
+    ) -> Tuple[Optional[dict], Optional[int]]:
+        await self._roundtrip()
+        now = utcnow()
+        doc = self._upsert_player(chat_id, user_id)
+
+        dig_at = doc.get('dig_at')
+        if not bypass_cooldown and dig_at is not None and dig_at >= now - timedelta(hours=cooldown_hours):
+            remaining = timedelta(hours=cooldown_hours) - (now - dig_at)
+            return None, int(remaining.total_seconds()) if remaining.total_seconds() > 0 else None
+
+        if super_roll and doc.get('last_loot_type') != 'super':
+            loot_type, loot = 'super', super_loot
+        elif success_roll or 'gp5' not in doc:
+            loot_type, loot = 'normal', gain
+        else:
+            loot_type, loot = 'fail', -lost
+
+        old_balance = doc.get('gp5', 0)
+        doc['gp5'] = old_balance + loot
+        doc['username'] = username
+        doc['last_loot'] = loot
+        doc['last_loot_type'] = loot_type
+        if not bypass_cooldown:
+            doc['dig_at'] = now
+        self.record_stats(daily={'digs': 1})
+        self.chat_top_cache.update(chat_id, user_id, username, doc['gp5'], doc['_id'])
+
+        return {
+            "loot": loot,
+            "loot_type": loot_type,
+            "old_balance": old_balance,
+            "new_balance": doc['gp5']
+        }, None
+
+    async def try_claim_box_cooldown(
+            self,
+            user_id: str,
+            nonce: str,
+            cooldown_hours: int = BOX_COOLDOWN_HOURS
+    ) -> Tuple[bool, Optional[int]]:
+        await self._roundtrip()
+        now = utcnow()
+        doc = self.cooldowns.setdefault(box_key(user_id), {'user_id': user_id})
+        box_time = doc.get('time')
+        if box_time is not None and box_time >= now - timedelta(hours=cooldown_hours):
+            remaining = timedelta(hours=cooldown_hours) - (now - box_time)
+            return False, int(remaining.total_seconds()) if remaining.total_seconds() > 0 else None
+        doc['pending'] = True
+        doc['nonce'] = nonce
+        doc.pop('legacy_mapping', None)
+        doc.pop('legacy_until', None)
+        return True, None
+
+    async def save_box_nonce(self, user_id: str, nonce: str):
+        await self._roundtrip()
+        doc = self.cooldowns.setdefault(box_key(user_id), {'user_id': user_id})
+        doc['pending'] = True
+        doc['nonce'] = nonce
+        doc.pop('legacy_mapping', None)
+        doc.pop('legacy_until', None)
+
+    async def claim_box(self, user_id: str, nonce: str) -> bool:
+        await self._roundtrip()
+        doc = self.cooldowns.get(box_key(user_id))
+        if not doc or doc.get('nonce') != nonce:
+            return False
+        doc.pop('nonce')
+        doc.pop('pending', None)
+        doc['time'] = utcnow()
+        doc['claimed'] = True
+        self.record_stats(daily={'boxes': 1})
+        return True
+
+    async def claim_legacy_box(self, user_id: str, button_id: str) -> Optional[str]:
+        await self._roundtrip()
+        now = utcnow()
+        doc = self.cooldowns.get(box_key(user_id))
+        if not doc or button_id not in doc.get('legacy_mapping', {}) or doc['legacy_until'] <= now:
+            return None
+        outcome = doc.pop('legacy_mapping')[button_id]
+        doc.pop('legacy_until')
+        doc.pop('nonce', None)
+        doc.pop('pending', None)
+        doc['time'] = now
+        doc['claimed'] = True
+        self.record_stats(daily={'boxes': 1})
+        return outcome
+
+    async def get_user_cooldown(self, user_id: str) -> Optional[dict]:
+        await self._roundtrip()
+        user_data = {}
+        dig = {
+            str(chat_id): {'time': doc['dig_at'], 'last_loot': doc.get('last_loot')}
+            for chat_id, doc in self.user_players.get(user_id, {}).items()
+            if 'dig_at' in doc
+        }
+        if dig:
+            user_data['dig'] = dig
+        box_doc = self.cooldowns.get(box_key(user_id))
+        if box_doc:
+            user_data['box'] = {
+                k: v for k, v in box_doc.items() if k not in ('user_id', 'legacy_mapping', 'legacy_until')
+            }
+        return user_data or None
+
+    async def delete_user_cooldowns(self, user_id: str):
+        await self._roundtrip()
+        self.cooldowns.pop(box_key(user_id), None)
+        for doc in self.user_players.get(user_id, {}).values():
+            doc.pop('dig_at', None)
+
+    # --- Игроки ---
+
+    async def atomic_add_gp5(self, chat_id: int, user_id: str, amount: int, username: str) -> int:
+        await self._roundtrip()
+        doc = self._upsert_player(chat_id, user_id)
+        doc['gp5'] = doc.get('gp5', 0) + amount
+        doc['username'] = username
+        self.chat_top_cache.update(chat_id, user_id, username, doc['gp5'], doc['_id'])
+        return doc['gp5']
+
+    async def bulk_add_gp5(self, user_ids: list, amount: int, chat_id: Optional[int] = None) -> dict:
+        await self._roundtrip()
+        summary = {}
+        for user_id in user_ids:
+            records = self.user_players.get(user_id, {})
+            if chat_id is None:
+                targets = list(records.values())
+            else:
+                targets = [records[chat_id]] if chat_id in records else []
+            if not targets:
+                continue
+            for doc in targets:
+                doc['gp5'] = doc.get('gp5', 0) + amount
+            top = self._user_max(user_id)
+            username = targets[-1].get('username', 'Unknown')
+            self.update_chat_tops(user_id, username, {doc['chat_id']: doc['gp5'] for doc in targets})
+            if user_id not in self.global_stats:
+                self.record_stats(totals={'unique_players': 1})
+            summary[user_id] = {'chats': len(targets), 'max_gp5': top.get('gp5', 0), 'username': username}
+            stats = self.global_stats.setdefault(user_id, {'max_gp5': top.get('gp5', 0)})
+            stats['max_gp5'] = max(stats['max_gp5'], top.get('gp5', 0)) if amount > 0 else top.get('gp5', 0)
+            stats['username'] = username
+            stats['chats'] = self._user_chats(user_id)
+        return summary
+
+    async def get_player(self, chat_id: int, user_id: str) -> Optional[dict]:
+        await self._roundtrip()
+        doc = self.players.get(player_key(chat_id, user_id))
+        return dict(doc) if doc else None
+
+    async def load_chat_top(self, chat_id: int, limit: int) -> list:
+        await self._roundtrip()
+        top = heapq.nlargest(
+            limit,
+            self.chat_players.get(chat_id, {}).values(),
+            key=lambda doc: doc.get('gp5', 0)
+        )
+        return [
+            {'_id': doc['_id'], 'user_id': doc['user_id'], 'username': doc.get('username'), 'gp5': doc.get('gp5')}
+            for doc in top
+        ]
+
+    # --- Глобальный рейтинг ---
+
+    async def get_global_stats(self, user_id: str) -> Optional[dict]:
+        await self._roundtrip()
+        stats = self.global_stats.get(user_id)
+        if not stats:
+            return None
+        return {'_id': user_id, **stats, 'chats': dict(stats.get('chats', {}))}
+
+    async def get_global_top(self, limit: int = 10) -> list:
+        await self._roundtrip()
+        top = heapq.nlargest(limit, self.global_stats.items(), key=lambda item: item[1]['max_gp5'])
+        return [
+            {'_id': user_id, 'gp5': stats['max_gp5'], 'username': stats.get('username', 'Unknown')}
+            for user_id, stats in top
+        ]
+
+    async def get_user_chats(self, user_id: str) -> dict:
+        await self._roundtrip()
+        return self._user_chats(user_id)
+
+    async def recalculate_global_stats(self) -> dict:
+        await self._roundtrip()
+        started = time.perf_counter()
+        # Новая таблица собирается отдельно и подменяет старую одним присваиванием
+        rebuilt = {}
+        for user_id in self.user_players:
+            top = self._user_max(user_id)
+            if top is not None:
+                rebuilt[user_id] = {
+                    'max_gp5': top.get('gp5', 0),
+                    'username': top.get('username', 'Unknown'),
+                    'chats': self._user_chats(user_id)
+                }
+        self.global_stats = rebuilt
+        seconds = time.perf_counter() - started
+        rows_per_sec = len(rebuilt) / seconds if seconds else 0.0
+        logging.info(f"Recalculation completed: {len(rebuilt)} users in {seconds:.2f}s ({rows_per_sec:.0f} rows/s)")
+        return {"count": len(rebuilt), "seconds": round(seconds, 2), "rows_per_sec": round(rows_per_sec)}
+
+    async def reconcile_global_stats(self, batch_size: int = 500) -> int:
+        await self._roundtrip()
+        fixed = 0
+        for user_id, stats in self.global_stats.items():
+            top = self._user_max(user_id)
+            if top is None:
+                continue
+            chats = self._user_chats(user_id)
+            if top.get('gp5', 0) != stats['max_gp5'] or chats != stats.get('chats'):
+                stats['max_gp5'] = top.get('gp5', 0)
+                stats['chats'] = chats
+                fixed += 1
+        if fixed:
+            logging.info(f"Global stats reconciled: {fixed} users fixed")
+        return fixed
+
+    # --- Чаты ---
+
+    async def get_broadcast_chat_ids(self) -> list:
+        await self._roundtrip()
+        active = [(chat_id, info) for chat_id, info in self.chats.items() if info.get('status') == 'active']
+        active.sort(key=lambda item: item[1]['last_active'], reverse=True)
+        return [chat_id for chat_id, _ in active]
+
+    async def mark_chat_inactive(self, chat_id: int, error_reason: str = None):
+        await self._roundtrip()
+        self.chats.setdefault(chat_id, {}).update({
+            'status': 'inactive',
+            'error': error_reason,
+            'error_at': utcnow()
+        })
+
+    async def get_active_chats_stats(self) -> dict:
+        await self._roundtrip()
+        now = utcnow()
+        stats = {
+            "total": len(self.chats),
+            "active_24h": 0,
+            "active_7d": 0,
+            "active_30d": 0,
+            "inactive": 0,
+            "groups": 0,
+            "supergroups": 0
+        }
+        for info in self.chats.values():
+            if info.get('type') == 'group':
+                stats["groups"] += 1
+            elif info.get('type') == 'supergroup':
+                stats["supergroups"] += 1
+            if info.get('status') == 'inactive':
+                stats["inactive"] += 1
+                continue
+            age = now - info['last_active']
+            for days, key in ((1, "active_24h"), (7, "active_7d"), (30, "active_30d")):
+                if age < timedelta(days=days):
+                    stats[key] += 1
+        return stats
+
+    # --- Промокоды ---
+
+    async def create_promo(self, code: str, amount: int, uses: int):
+        await self._roundtrip()
+        self.promo_codes[code] = {
+            '_id': code,
+            'amount': amount,
+            'uses': uses,
+            'remaining': uses,
+            'used_count': 0,
+            'created_at': datetime.now().isoformat()
+        }
+        for usage_key in [k for k in self.promo_usage if k[1] == code]:
+            del self.promo_usage[usage_key]
+
+    async def atomic_use_promo(self, code: str, user_id: str) -> Tuple[bool, str, int]:
+        await self._roundtrip()
+        if (user_id, code) in self.promo_usage:
+            return False, "already_used", 0
+        promo = self.promo_codes.get(code)
+        if promo is None:
+            return False, "not_found", 0
+        if promo['uses'] != -1 and promo['remaining'] <= 0:
+            return False, "exhausted", 0
+        self.promo_usage[(user_id, code)] = datetime.now().isoformat()
+        if promo['uses'] != -1:
+            promo['remaining'] -= 1
+        promo['used_count'] += 1
+        return True, "success", promo['amount']
+
+    async def list_promos(self) -> list:
+        await self._roundtrip()
+        return sorted((dict(promo) for promo in self.promo_codes.values()), key=lambda p: p['created_at'])
+
+    async def delete_exhausted_promos(self) -> Tuple[int, int]:
+        await self._roundtrip()
+        codes = {
+            code for code, promo in self.promo_codes.items()
+            if promo['uses'] != -1 and promo['remaining'] <= 0
+        }
+        for code in codes:
+            del self.promo_codes[code]
+        for usage_key in [k for k in self.promo_usage if k[1] in codes]:
+            del self.promo_usage[usage_key]
+        return len(codes), len(self.promo_codes)
+
+    # --- Профиль и статистика ---
+
+    async def get_user_profile_data(self, chat_id: int, user_id: str) -> dict:
+        await self._roundtrip()
+        chat = self.chat_players.get(chat_id, {})
+        player = chat.get(user_id)
+        stats = self.global_stats.get(user_id)
+        global_gp5 = stats['max_gp5'] if stats else 0
+
+        position = None
+        if player is not None:
+            gp5 = player.get('gp5', 0)
+            position = sum(1 for doc in chat.values() if doc.get('gp5', 0) > gp5) + 1
+
+        user_chat_data = player or {}
+        return {
+            "chat_gp5": user_chat_data.get("gp5", 0),
+            "global_gp5": global_gp5,
+            "chat_position": position,
+            "chat_total": len(chat),
+            "username": user_chat_data.get("username", "Unknown"),
+            "exists_in_chat": player is not None,
+            "exists_globally": global_gp5 > 0 or player is not None,
+            "last_loot": user_chat_data.get('last_loot')
+        }
+
+    async def get_bot_statistics(self) -> dict:
+        await self._roundtrip()
+        sizes = [len(chat) for chat in self.chat_players.values() if chat]
+        top = max(self.players.values(), key=lambda doc: doc.get('gp5', 0), default=None)
+        return {
+            "unique_players": len(self.global_stats),
+            "active_chats": len(sizes),
+            "total_player_records": sum(sizes),
+            "max_players_in_chat": max(sizes, default=0),
+            "avg_players_per_chat": round(sum(sizes) / len(sizes), 1) if sizes else 0,
+            "top_player": {
+                'user_id': top['user_id'], 'gp5': top.get('gp5'), 'username': top.get('username')
+            } if top else None
+        }
+
+    async def load_stats_documents(self, day_keys: list) -> Tuple[Optional[dict], dict]:
+        await self._roundtrip()
+        counters = self.stats.get('counters')
+        if counters is not None and 'reconciled_at' not in counters:
+            counters = None
+        days = {key: dict(self.stats[key]) for key in day_keys if key in self.stats}
+        return (dict(counters) if counters is not None else None), days
+
+    async def save_stats_counters(self, counters: dict):
+        await self._roundtrip()
+        self.stats.setdefault('counters', {}).update(counters)
+
+    # --- Кэш file_id ---
+
+    async def load_media_cache(self) -> list:
+        await self._roundtrip()
+        return [dict(entry) for entry in self.media_cache.values()]
+
+    async def save_media_file_id(self, filename: str, digest: str, file_id: str):
+        await self._roundtrip()
+        self.media_cache[media_key(filename, digest)] = {'filename': filename, 'hash': digest, 'file_id': file_id}
+
+    async def save_media_file_ids(self, entries: list):
+        await self._roundtrip()
+        for filename, digest, file_id in entries:
+            self.media_cache[media_key(filename, digest)] = {'filename': filename, 'hash': digest, 'file_id': file_id}
+
+    async def clear_media_cache(self) -> int:
+        await self._roundtrip()
+        count = len(self.media_cache)
+        self.media_cache.clear()
+        return count
+
+    async def count_media_cache(self) -> int:
+        await self._roundtrip()
+        return len(self.media_cache)
@@ -0,0 +1,618 @@
+import uuid
+import time
+import asyncio
+import logging
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Any, AsyncIterator, Awaitable, Callable, List, Optional
+
+from pymongo import UpdateOne
+from pymongo.errors import DuplicateKeyError
+
+from utils import (
+    GLOBAL_COOLDOWN_COLLECTION, PROMO_COLLECTION,
+    PROMO_CODES_COLLECTION, PROMO_USAGE_COLLECTION,
+    CHAT_DATA_COLLECTION, PLAYERS_COLLECTION, COOLDOWNS_COLLECTION, GLOBAL_STATS_COLLECTION,
+    CHATS_LIST_COLLECTION, CHATS_COLLECTION,
+    MIGRATION_BATCH_SIZE, MIGRATION_LOCK_LEASE, BOX_COOLDOWN_HOURS
+)
+from storage import player_key, box_key, utcnow, cooldown_expiry
+
+MIGRATIONS_COLLECTION = 'migrations'
+
+
+@dataclass
+class Migration:
+    version: int
+    name: str
+    apply: Callable[['MigrationRunner', 'StepState'], Awaitable[None]]
+
+
+@dataclass
+class StepState:
+    """Чекпоинт шага: последний обработанный _id источника и счётчики"""
+    version: int
+    name: str
+    status: str = 'pending'
+    cursor: Any = None
+    processed: int = 0
+    total: Optional[int] = None
+    error: Optional[str] = None
+
+    def to_doc(self) -> dict:
+        return {
+            'name': self.name,
+            'status': self.status,
+            'cursor': self.cursor,
+            'processed': self.processed,
+            'total': self.total,
+            'error': self.error,
+            'updated_at': utcnow()
+        }
+
+
+class MigrationRunner:
+    """
+    Выполняет миграции по порядку версий. После каждой пачки шаг сохраняет
+    чекпоинт, поэтому прерванная миграция продолжается с места остановки.
+    Запись только идемпотентными upsert через bulk_write. В фоне бот пишет
+    в те же коллекции параллельно: шаги, переносящие данные в документы,
+    которые бот может создать раньше (players), сливают старые значения
+    с уже существующими, а операции, которым нужны ещё не перенесённые
+    данные, ждут своей версии через wait_for.
+    """
+
+    def __init__(self, db, migrations: List[Migration], batch_size: int = MIGRATION_BATCH_SIZE):
+        self.db = db
+        self.migrations = sorted(migrations, key=lambda m: m.version)
+        self.batch_size = batch_size
+        self.owner = uuid.uuid4().hex
+        self.running = False
+        self.applied_version: Optional[int] = None
+        self.error: Optional[str] = None
+
+    @property
+    def target_version(self) -> int:
+        return self.migrations[-1].version if self.migrations else 0
+
+    # --- Блокировка (аренда с продлением на каждом чекпоинте) ---
+
+    async def _acquire_lock(self) -> bool:
+        now = utcnow()
+        try:
+            await self.db[MIGRATIONS_COLLECTION].update_one(
+                {
+                    '_id': 'lock',
+                    '$or': [
+                        {'owner': None},
+                        {'owner': self.owner},
+                        {'expires_at': {'$lt': now}}
+                    ]
+                },
+                {'$set': {
+                    'owner': self.owner,
+                    'expires_at': now + timedelta(seconds=MIGRATION_LOCK_LEASE)
+                }},
+                upsert=True
+            )
+            return True
+        except DuplicateKeyError:
+            return False
+
+    async def _release_lock(self):
+        await self.db[MIGRATIONS_COLLECTION].update_one(
+            {'_id': 'lock', 'owner': self.owner},
+            {'$set': {'owner': None}}
+        )
+
+    # --- Состояние ---
+
+    async def current_version(self) -> int:
+        doc = await self.db[MIGRATIONS_COLLECTION].find_one({'_id': 'version'})
+        return doc.get('version', 0) if doc else 0
+
+    async def _load_state(self, migration: Migration) -> StepState:
+        doc = await self.db[MIGRATIONS_COLLECTION].find_one({'_id': f'step:{migration.version}'})
+        state = StepState(migration.version, migration.name)
+        if doc and doc.get('status') != 'done':
+            state.cursor = doc.get('cursor')
+            state.processed = doc.get('processed', 0)
+            state.total = doc.get('total')
+        return state
+
+    async def checkpoint(self, state: StepState):
+        """Сохраняет прогресс шага и продлевает блокировку"""
+        await self.db[MIGRATIONS_COLLECTION].update_one(
+            {'_id': f'step:{state.version}'},
+            {'$set': state.to_doc()},
+            upsert=True
+        )
+        if not await self._acquire_lock():
+            raise RuntimeError("Migration lock was taken over by another process")
+
+    async def wait_for(self, version: int, poll_interval: float = 1.0):
+        """
+        Ждёт, пока база дойдёт до version. Пока миграции идут в этом процессе,
+        проверка не ходит в базу; иначе версия перечитывается раз в poll_interval
+        (миграции может выполнять другой процесс).
+        """
+        if version > self.target_version:
+            return
+        while self.applied_version is None or self.applied_version < version:
+            if self.error is not None:
+                raise RuntimeError(f"Migration to v{version} failed: {self.error}")
+            if not self.running:
+                self.applied_version = await self.current_version()
+                if self.applied_version >= version:
+                    return
+            await asyncio.sleep(poll_interval)
+
+    async def status(self) -> dict:
+        steps = await self.db[MIGRATIONS_COLLECTION].find(
+            {'_id': {'$regex': '^step:'}}
+        ).to_list(None)
+        return {
+            'version': await self.current_version(),
+            'target': self.target_version,
+            'running': self.running,
+            'steps': sorted(
+                (
+                    {
+                        'version': int(doc['_id'].split(':', 1)[1]),
+                        'name': doc.get('name'),
+                        'status': doc.get('status'),
+                        'processed': doc.get('processed', 0),
+                        'total': doc.get('total'),
+                        'error': doc.get('error')
+                    }
+                    for doc in steps
+                ),
+                key=lambda step: step['version']
+            )
+        }
+
+    # --- Инструменты для шагов ---
+
+    async def scan(
+            self,
+            state: StepState,
+            collection: str,
+            query: Optional[dict] = None,
+            projection: Optional[dict] = None
+    ) -> AsyncIterator[list]:
+        """
+        Пачки документов по возрастанию _id, начиная после чекпоинта.
+        Чекпоинт сдвигается, когда вызывающий код обработал пачку и запросил следующую.
+        """
+        query = query or {}
+        if state.total is None:
+            state.total = await self.db[collection].count_documents(query)
+        while True:
+            page_query = dict(query)
+            if state.cursor is not None:
+                page_query['_id'] = {'$gt': state.cursor}
+            batch = await self.db[collection].find(page_query, projection).sort(
+                '_id', 1
+            ).limit(self.batch_size).to_list(self.batch_size)
+            if not batch:
+                return
+            yield batch
+            state.cursor = batch[-1]['_id']
+            state.processed += len(batch)
+            self.log_progress(state)
+            await self.checkpoint(state)
+
+    async def write(self, collection: str, operations: list) -> int:
+        """Неупорядоченный bulk_write пачками по batch_size"""
+        written = 0
+        for i in range(0, len(operations), self.batch_size):
+            chunk = operations[i:i + self.batch_size]
+            result = await self.db[collection].bulk_write(chunk, ordered=False)
+            written += result.upserted_count + result.modified_count
+        return written
+
+    @staticmethod
+    def log_progress(state: StepState):
+        if state.total:
+            percent = min(state.processed * 100 // state.total, 100)
+            logging.info(f"Migration v{state.version} ({state.name}): {state.processed}/{state.total} ({percent}%)")
+        else:
+            logging.info(f"Migration v{state.version} ({state.name}): {state.processed} processed")
+
+    # --- Запуск ---
+
+    async def run(self) -> int:
+        """Применяет недостающие миграции. Возвращает версию базы после запуска"""
+        if not await self._acquire_lock():
+            logging.info("Migration already running by another process")
+            return await self.current_version()
+
+        self.running = True
+        self.error = None
+        try:
+            version = await self.current_version()
+            self.applied_version = version
+            for migration in self.migrations:
+                if migration.version <= version:
+                    continue
+                state = await self._load_state(migration)
+                state.status = 'running'
+                await self.checkpoint(state)
+                started = time.perf_counter()
+                try:
+                    await migration.apply(self, state)
+                except Exception as e:
+                    state.status = 'failed'
+                    state.error = str(e)[:500]
+                    self.error = state.error
+                    await self.checkpoint(state)
+                    logging.error(f"Migration v{migration.version} ({migration.name}) failed: {e}")
+                    raise
+
+                state.status = 'done'
+                await self.checkpoint(state)
+                version = migration.version
+                await self.db[MIGRATIONS_COLLECTION].update_one(
+                    {'_id': 'version'},
+                    {'$set': {'version': version, 'migrated_at': datetime.now()}},
+                    upsert=True
+                )
+                self.applied_version = version
+                logging.info(
+                    f"Migration v{version} ({migration.name}) completed: "
+                    f"{state.processed} records in {time.perf_counter() - started:.1f}s"
+                )
+
+            logging.info(f"Database at version {version}")
+            return version
+        finally:
+            self.running = False
+            await self._release_lock()
+
+    def run_in_background(self) -> asyncio.Task:
+        async def _run():
+            try:
+                await self.run()
+            except Exception as e:
+                logging.error(f"Background migration stopped: {e}")
+
+        return asyncio.create_task(_run())
+
+
+def players_by_user_pipeline(match: Optional[dict] = None) -> list:
+    """Агрегация players по игроку: максимум, имя и карта чатов {chat_id: баланс}"""
+    stages = [{"$match": match}] if match else []
+    return stages + [
+        {"$group": {
+            "_id": "$user_id",
+            "max_gp5": {"$max": "$gp5"},
+            "username": {"$last": "$username"},
+            "chats": {"$push": {"k": {"$toString": "$chat_id"}, "v": {"$ifNull": ["$gp5", 0]}}}
+        }},
+        {"$set": {"chats": {"$arrayToObject": "$chats"}}}
+    ]
+
+
+def _parse_legacy_time(time_str: Optional[str]) -> Optional[datetime]:
+    """ISO-строка локального времени из старого формата -> naive UTC datetime"""
+    if not time_str:
+        return None
+    try:
+        parsed = datetime.fromisoformat(time_str.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    return parsed.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def _dig_key(user_id: str, chat_id: int) -> str:
+    return f"dig:{user_id}:{chat_id}"
+
+
+async def _migrate_v1_global_stats(runner: MigrationRunner, state: StepState):
+    """Заполнение global_stats из chat_data (максимум баланса по чатам)"""
+    async for batch in runner.scan(state, CHAT_DATA_COLLECTION):
+        best = {}
+        for doc in batch:
+            for user_id, data in doc.get('data', {}).items():
+                gp5 = data.get('gp5', 0)
+                if user_id not in best or gp5 > best[user_id][0]:
+                    best[user_id] = (gp5, data.get('username', 'Unknown'))
+        await runner.write(GLOBAL_STATS_COLLECTION, [
+            UpdateOne(
+                {'_id': user_id},
+                {'$max': {'max_gp5': gp5}, '$setOnInsert': {'username': username}},
+                upsert=True
+            )
+            for user_id, (gp5, username) in best.items()
+        ])
+
+
+async def _migrate_v2_total_gp5(runner: MigrationRunner, state: StepState):
+    """Старая миграция - теперь просто пропускаем"""
+
+
+async def _migrate_v3_max_gp5(runner: MigrationRunner, state: StepState):
+    """Пересчёт max_gp5 (максимум по одному чату) для всех пользователей"""
+    pipeline = [
+        {"$project": {"data": {"$objectToArray": "$data"}}},
+        {"$unwind": "$data"},
+        {"$group": {
+            "_id": "$data.k",  # user_id
+            "max_gp5": {"$max": "$data.v.gp5"},  # МАКСИМУМ, не сумма!
+            "username": {"$last": "$data.v.username"}
+        }},
+        {"$sort": {"_id": 1}}
+    ]
+    if state.cursor is not None:
+        pipeline.append({"$match": {"_id": {"$gt": state.cursor}}})
+
+    # $set поверх существующих записей: таблица не очищается, /gtop работает всё время
+    operations = []
+    async for doc in runner.db[CHAT_DATA_COLLECTION].aggregate(pipeline, allowDiskUse=True):
+        operations.append(UpdateOne(
+            {'_id': doc['_id']},
+            {'$set': {'max_gp5': doc.get('max_gp5', 0), 'username': doc.get('username', 'Unknown')}},
+            upsert=True
+        ))
+        if len(operations) >= runner.batch_size:
+            await runner.write(GLOBAL_STATS_COLLECTION, operations)
+            state.cursor = doc['_id']
+            state.processed += len(operations)
+            runner.log_progress(state)
+            await runner.checkpoint(state)
+            operations = []
+
+    if operations:
+        await runner.write(GLOBAL_STATS_COLLECTION, operations)
+        state.processed += len(operations)
+
+
+async def _migrate_v4_cooldown_documents(runner: MigrationRunner, state: StepState):
+    """Перенос кулдаунов из singleton-документа в отдельные документы (user, chat, kind)"""
+    doc = await runner.db[GLOBAL_COOLDOWN_COLLECTION].find_one({'_id': 'singleton'})
+    legacy_data = doc.get('data', {}) if doc else {}
+    expires_at = cooldown_expiry(utcnow())
+
+    user_ids = sorted(legacy_data)
+    if state.cursor is not None:
+        user_ids = [user_id for user_id in user_ids if user_id > state.cursor]
+    state.total = state.processed + len(user_ids)
+
+    for i in range(0, len(user_ids), runner.batch_size):
+        chunk = user_ids[i:i + runner.batch_size]
+        operations = []
+        for user_id in chunk:
+            user_data = legacy_data[user_id]
+            for chat_id_str, dig_data in user_data.get('dig', {}).items():
+                try:
+                    chat_id = int(chat_id_str)
+                except ValueError:
+                    continue
+                fields = {
+                    'user_id': user_id,
+                    'chat_id': chat_id,
+                    'kind': 'dig',
+                    'expires_at': expires_at
+                }
+                dig_time = _parse_legacy_time(dig_data.get('time'))
+                if dig_time:
+                    fields['time'] = dig_time
+                if dig_data.get('last_loot') is not None:
+                    fields['last_loot'] = dig_data['last_loot']
+                operations.append(UpdateOne(
+                    {'_id': _dig_key(user_id, chat_id)},
+                    {'$setOnInsert': fields},
+                    upsert=True
+                ))
+
+            box_data = user_data.get('box')
+            if box_data or user_data.get('box_mapping'):
+                box_data = box_data or {}
+                fields = {'user_id': user_id, 'chat_id': None, 'kind': 'box', 'expires_at': expires_at}
+                box_time = _parse_legacy_time(box_data.get('time'))
+                if box_time:
+                    fields['time'] = box_time
+                if box_data.get('pending'):
+                    fields['pending'] = True
+                if user_data.get('box_mapping'):
+                    # Кнопки старого формата открываются ещё одно окно кулдауна (claim_legacy_box)
+                    fields['legacy_mapping'] = user_data['box_mapping']
+                    fields['legacy_until'] = utcnow() + timedelta(hours=BOX_COOLDOWN_HOURS)
+                operations.append(UpdateOne(
+                    {'_id': box_key(user_id)},
+                    {'$setOnInsert': fields},
+                    upsert=True
+                ))
+
+        if operations:
+            await runner.write(COOLDOWNS_COLLECTION, operations)
+        state.cursor = chunk[-1]
+        state.processed += len(chunk)
+        runner.log_progress(state)
+        await runner.checkpoint(state)
+
+    # Старый singleton больше не используется — освобождаем документ
+    if doc:
+        await runner.db[GLOBAL_COOLDOWN_COLLECTION].update_one(
+            {'_id': 'singleton'},
+            {'$set': {'data': {}}}
+        )
+
+
+def legacy_player_merge(chat_id: int, user_id: str, user_data: dict) -> list:
+    """
+    Pipeline-обновление, сливающее запись игрока из chat_data с документом players.
+    Документ, который бот успел создать до переноса (вылазка, начисление),
+    получает старый баланс прибавкой к текущему; метка legacy_merged делает
+    повтор пачки после сбоя безопасным.
+    """
+    return [{'$set': {
+        'chat_id': {'$ifNull': ['$chat_id', chat_id]},
+        'user_id': {'$ifNull': ['$user_id', {'$literal': user_id}]},
+        'gp5': {'$cond': [
+            {'$eq': ['$legacy_merged', True]},
+            '$gp5',
+            {'$add': [{'$ifNull': ['$gp5', 0]}, user_data.get('gp5', 0)]}
+        ]},
+        'username': {'$ifNull': ['$username', {'$literal': user_data.get('username', 'Unknown')}]},
+        'last_loot_type': {'$ifNull': ['$last_loot_type', {'$literal': user_data.get('last_loot_type')}]},
+        'legacy_merged': True
+    }}]
+
+
+async def _migrate_v5_players(runner: MigrationRunner, state: StepState):
+    """Перенос игроков из chat_data (карта data.<user_id>) в коллекцию players"""
+    async for batch in runner.scan(state, CHAT_DATA_COLLECTION):
+        operations = []
+        for doc in batch:
+            chat_id = doc['_id']
+            for user_id, user_data in doc.get('data', {}).items():
+                operations.append(UpdateOne(
+                    {'_id': player_key(chat_id, user_id)},
+                    legacy_player_merge(chat_id, user_id, user_data),
+                    upsert=True
+                ))
+        if operations:
+            await runner.write(PLAYERS_COLLECTION, operations)
+
+
+async def _migrate_v6_promo_documents(runner: MigrationRunner, state: StepState):
+    """Перенос промокодов из singleton в отдельные документы + promo_usage"""
+    doc = await runner.db[PROMO_COLLECTION].find_one({'_id': 'singleton'})
+    promos = doc.get('data', {}) if doc else {}
+    promo_operations = []
+    usage_operations = []
+
+    for code, promo in promos.items():
+        used_by = promo.get('used_by', {})
+        uses = promo.get('uses', -1)
+        promo_operations.append(UpdateOne(
+            {'_id': code},
+            {'$setOnInsert': {
+                'amount': promo.get('amount', 0),
+                'uses': uses,
+                'remaining': -1 if uses == -1 else max(uses - len(used_by), 0),
+                'used_count': len(used_by),
+                'created_at': promo.get('created_at')
+            }},
+            upsert=True
+        ))
+        for user_id, used_at in used_by.items():
+            usage_operations.append(UpdateOne(
+                {'user_id': user_id, 'code': code},
+                {'$setOnInsert': {'used_at': used_at}},
+                upsert=True
+            ))
+
+    state.total = len(promo_operations) + len(usage_operations)
+    if promo_operations:
+        await runner.write(PROMO_CODES_COLLECTION, promo_operations)
+    if usage_operations:
+        await runner.write(PROMO_USAGE_COLLECTION, usage_operations)
+    state.processed = state.total
+
+
+async def _migrate_v7_dig_cooldowns_to_players(runner: MigrationRunner, state: StepState):
+    """Кулдаун /dig и last_loot переезжают в документ игрока (players)"""
+    async for batch in runner.scan(state, COOLDOWNS_COLLECTION, {'kind': 'dig'}):
+        operations = []
+        for doc in batch:
+            fields = {}
+            if doc.get('time'):
+                fields['dig_at'] = {'$max': ['$dig_at', doc['time']]}
+            if doc.get('last_loot') is not None:
+                fields['last_loot'] = {'$ifNull': ['$last_loot', doc['last_loot']]}
+            if fields:
+                # upsert: кулдаун не теряется, даже если строки игрока в players ещё нет
+                fields['chat_id'] = {'$ifNull': ['$chat_id', doc['chat_id']]}
+                fields['user_id'] = {'$ifNull': ['$user_id', {'$literal': doc['user_id']}]}
+                operations.append(UpdateOne(
+                    {'_id': player_key(doc['chat_id'], doc['user_id'])},
+                    [{'$set': fields}],
+                    upsert=True
+                ))
+        if operations:
+            await runner.write(PLAYERS_COLLECTION, operations)
+
+    await runner.db[COOLDOWNS_COLLECTION].delete_many({'kind': 'dig'})
+
+
+async def _migrate_v8_user_chat_index(runner: MigrationRunner, state: StepState):
+    """Карта чатов игрока (chats.<chat_id> = баланс) в global_stats для точечных админских запросов"""
+    pipeline = players_by_user_pipeline() + [{"$sort": {"_id": 1}}]
+    if state.cursor is not None:
+        pipeline.append({"$match": {"_id": {"$gt": state.cursor}}})
+
+    operations = []
+    async for doc in runner.db[PLAYERS_COLLECTION].aggregate(pipeline, allowDiskUse=True):
+        operations.append(UpdateOne(
+            {'_id': doc['_id']},
+            {
+                '$set': {'chats': doc['chats']},
+                '$max': {'max_gp5': doc.get('max_gp5', 0)},
+                '$setOnInsert': {'username': doc.get('username', 'Unknown')}
+            },
+            upsert=True
+        ))
+        if len(operations) >= runner.batch_size:
+            await runner.write(GLOBAL_STATS_COLLECTION, operations)
+            state.cursor = doc['_id']
+            state.processed += len(operations)
+            runner.log_progress(state)
+            await runner.checkpoint(state)
+            operations = []
+
+    if operations:
+        await runner.write(GLOBAL_STATS_COLLECTION, operations)
+        state.processed += len(operations)
+
+
+async def _migrate_v9_chat_registry(runner: MigrationRunner, state: StepState):
+    """Реестр чатов из singleton active_chats в отдельные документы коллекции chats"""
+    doc = await runner.db[CHATS_LIST_COLLECTION].find_one({'_id': 'singleton'})
+    chats = doc.get('data', {}) if doc else {}
+    state.total = len(chats)
+
+    operations = []
+    for chat_id_str, info in chats.items():
+        try:
+            chat_id = int(chat_id_str)
+        except ValueError:
+            continue
+        fields = {
+            'title': info.get('title', ''),
+            'type': info.get('type', ''),
+            'status': info.get('status', 'active'),
+            'last_active': _parse_legacy_time(info.get('last_active'))
+        }
+        if info.get('status') == 'inactive':
+            fields['error'] = info.get('error')
+            fields['error_at'] = _parse_legacy_time(info.get('error_at'))
+        # $setOnInsert: запись, уже сделанная новым кодом, свежее singleton
+        operations.append(UpdateOne({'_id': chat_id}, {'$setOnInsert': fields}, upsert=True))
+    if operations:
+        await runner.write(CHATS_COLLECTION, operations)
+    state.processed = state.total
+
+    # Старый singleton больше не используется — освобождаем документ
+    if doc:
+        await runner.db[CHATS_LIST_COLLECTION].update_one({'_id': 'singleton'}, {'$set': {'data': {}}})
+
+
+# Версии, до которых операции над перенесёнными данными ждут миграций (wait_for)
+COOLDOWN_DOCUMENTS_VERSION = 4
+PLAYERS_VERSION = 5
+PROMO_DOCUMENTS_VERSION = 6
+DIG_COOLDOWNS_VERSION = 7
+
+MIGRATIONS = [
+    Migration(1, 'global_stats', _migrate_v1_global_stats),
+    Migration(2, 'total_gp5', _migrate_v2_total_gp5),
+    Migration(3, 'max_gp5', _migrate_v3_max_gp5),
+    Migration(4, 'cooldown documents', _migrate_v4_cooldown_documents),
+    Migration(5, 'players', _migrate_v5_players),
+    Migration(6, 'promo documents', _migrate_v6_promo_documents),
+    Migration(7, 'dig cooldowns in players', _migrate_v7_dig_cooldowns_to_players),
+    Migration(8, 'user chat index', _migrate_v8_user_chat_index),
+    Migration(9, 'chat registry', _migrate_v9_chat_registry),
+]
@@ -0,0 +1,522 @@
+import os
+import time
+import asyncio
+import logging
+from abc import ABC, abstractmethod
+from datetime import date, datetime, timedelta, timezone
+from typing import Optional, Tuple
+
+from utils import (
+    DIG_COOLDOWN_HOURS, BOX_COOLDOWN_HOURS, COOLDOWN_RETENTION_DAYS,
+    GLOBAL_STATS_RECONCILE_INTERVAL, WRITE_BEHIND_FLUSH_INTERVAL, WRITE_BEHIND_MAX_PENDING,
+    STATS_CACHE_TTL, STATS_RECONCILE_INTERVAL, CHAT_TOP_LIMIT, CHAT_TOP_CACHE_SIZE
+)
+from write_behind import WriteBehindBuffer
+from top_cache import ChatTopCache
+
+_storage: Optional['Storage'] = None
+
+# Счётчики событий, которые копятся ещё и в дневных корзинах
+STATS_DAILY_FIELDS = ('digs', 'boxes', 'new_players')
+STATS_WEEK_DAYS = 7
+
+
+def player_key(chat_id: int, user_id: str) -> str:
+    return f"{chat_id}:{user_id}"
+
+
+def box_key(user_id: str) -> str:
+    return f"box:{user_id}"
+
+
+def utcnow() -> datetime:
+    """Текущее время в UTC без tzinfo (в таком виде Motor возвращает BSON datetime)"""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def cooldown_expiry(now: datetime) -> datetime:
+    """Момент удаления документа кулдауна TTL-индексом"""
+    return now + timedelta(days=COOLDOWN_RETENTION_DAYS)
+
+
+def stats_day_key(day: date) -> str:
+    """_id дневной корзины счётчиков"""
+    return f"day:{day.isoformat()}"
+
+
+def merge_stats_update(old: dict, new: dict) -> dict:
+    return {
+        'gp5': max(old['gp5'], new['gp5']),
+        'username': new['username'],
+        'decreased': old['decreased'] or new['decreased'],
+        'chats': {**old['chats'], **new['chats']}
+    }
+
+
+class Storage(ABC):
+    """
+    Хранилище данных бота. Реализации: MongoStorage (database.py) и
+    MemoryStorage (memory_storage.py). Отложенная запись активности чатов
+    и global_stats общая — бэкенд реализует только сброс пачек.
+    """
+
+    def __init__(self):
+        self.chat_activity_buffer = WriteBehindBuffer(
+            'chat_activity',
+            self.flush_chat_activity,
+            merge=lambda old, new: new,
+            flush_interval=WRITE_BEHIND_FLUSH_INTERVAL,
+            max_pending=WRITE_BEHIND_MAX_PENDING
+        )
+        self.global_stats_buffer = WriteBehindBuffer(
+            'global_stats',
+            self.flush_global_stats,
+            merge=merge_stats_update,
+            flush_interval=WRITE_BEHIND_FLUSH_INTERVAL,
+            max_pending=WRITE_BEHIND_MAX_PENDING
+        )
+        self.stats_buffer = WriteBehindBuffer(
+            'stats',
+            self.flush_stats,
+            merge=lambda old, new: old + new,
+            flush_interval=WRITE_BEHIND_FLUSH_INTERVAL,
+            max_pending=WRITE_BEHIND_MAX_PENDING
+        )
+        self.chat_top_cache = ChatTopCache(limit=CHAT_TOP_LIMIT, max_chats=CHAT_TOP_CACHE_SIZE)
+        self._background_tasks: list = []
+        self._stats_cache: Optional[Tuple[float, dict]] = None
+        self._stats_lock = asyncio.Lock()
+
+    # --- Жизненный цикл ---
+
+    async def prepare(self):
+        """Подготовка хранилища при старте (миграции, индексы)"""
+
+    async def close(self):
+        pass
+
+    async def get_migration_status(self) -> Optional[dict]:
+        """Версия схемы и прогресс шагов миграции (None, если миграций нет)"""
+        return None
+
+    def start_background(
+            self,
+            reconcile_interval: int = GLOBAL_STATS_RECONCILE_INTERVAL,
+            stats_interval: int = STATS_RECONCILE_INTERVAL
+    ):
+        self.chat_activity_buffer.start()
+        self.global_stats_buffer.start()
+        self.stats_buffer.start()
+        if not self._background_tasks:
+            self._background_tasks = [
+                asyncio.create_task(self._periodic('global stats', self.reconcile_global_stats, reconcile_interval)),
+                asyncio.create_task(self._periodic('statistics', self.reconcile_statistics, stats_interval))
+            ]
+
+    async def stop_background(self):
+        for task in self._background_tasks:
+            task.cancel()
+        self._background_tasks = []
+        await asyncio.gather(
+            self.chat_activity_buffer.close(),
+            self.global_stats_buffer.close(),
+            self.stats_buffer.close()
+        )
+
+    async def _periodic(self, name: str, job, interval: int):
+        """Фоновая периодическая сверка"""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await job()
+            except Exception as e:
+                logging.error(f"{name.capitalize()} reconciliation failed: {e}")
+
+    # --- Отложенная запись ---
+
+    def touch_chat(self, chat_id: int, chat_title: str, chat_type: str):
+        """Пометить чат активным (запись отложенная, сливается по chat_id)"""
+        self.chat_activity_buffer.put(chat_id, {
+            'title': chat_title,
+            'type': chat_type,
+            'last_active': utcnow()
+        })
+
+    def record_global_stats(
+            self,
+            user_id: int,
+            new_gp5_in_chat: int,
+            username: str,
+            decreased: bool = False,
+            chat_id: Optional[int] = None
+    ):
+        """
+        Отложенный вариант update_global_stats, сливается по user_id.
+        chat_id — обновить баланс этого чата в карте чатов игрока.
+        """
+        self.global_stats_buffer.put(str(user_id), {
+            'gp5': new_gp5_in_chat,
+            'username': username,
+            'decreased': decreased,
+            'chats': {str(chat_id): new_gp5_in_chat} if chat_id is not None else {}
+        })
+
+    async def update_global_stats(
+            self,
+            user_id: int,
+            new_gp5_in_chat: int,
+            username: str,
+            decreased: bool = False,
+            chat_id: Optional[int] = None
+    ):
+        """Немедленное обновление max_gp5 (передаётся НОВЫЙ БАЛАНС в чате, а не дельта)"""
+        await self.flush_global_stats({str(user_id): {
+            'gp5': new_gp5_in_chat,
+            'username': username,
+            'decreased': decreased,
+            'chats': {str(chat_id): new_gp5_in_chat} if chat_id is not None else {}
+        }})
+
+    def record_stats(self, daily: Optional[dict] = None, totals: Optional[dict] = None):
+        """
+        Отложенный $inc счётчиков статистики, сливается по полю.
+        daily — события в корзину текущего дня (digs, boxes, new_players),
+        totals — итоговые счётчики (unique_players, total_player_records).
+        """
+        day = stats_day_key(utcnow().date())
+        for field, amount in (daily or {}).items():
+            self.stats_buffer.put((day, field), amount)
+        for field, amount in (totals or {}).items():
+            if amount:
+                self.stats_buffer.put(('counters', field), amount)
+
+    def get_write_behind_metrics(self) -> list:
+        return [
+            self.chat_activity_buffer.metrics(),
+            self.global_stats_buffer.metrics(),
+            self.stats_buffer.metrics()
+        ]
+
+    @abstractmethod
+    async def flush_chat_activity(self, batch: dict):
+        """Сохранить пачку {chat_id: {title, type, last_active}}"""
+
+    @abstractmethod
+    async def flush_global_stats(self, batch: dict):
+        """Сохранить пачку {user_id: {gp5, username, decreased}}"""
+
+    @abstractmethod
+    async def flush_stats(self, batch: dict):
+        """Сохранить пачку приращений {(_id документа, поле): delta}"""
+
+    # --- Техработы ---
+
+    @abstractmethod
+    async def load_maintenance(self) -> bool: ...
+
+    @abstractmethod
+    async def set_maintenance(self, value: bool): ...
+
+    # --- Вылазки и ящики ---
+
+    @abstractmethod
+    async def apply_dig(
+            self,
+            chat_id: int,
+            user_id: str,
+            username: str,
+            *,
+            super_roll: bool,
+            success_roll: bool,
+            gain: int,
+            lost: int,
+            super_loot: int = 40,
+            cooldown_hours: int = DIG_COOLDOWN_HOURS,
+            bypass_cooldown: bool = False
+    ) -> Tuple[Optional[dict], Optional[int]]:
+        """
+        Вылазка одной атомарной операцией: захват кулдауна, выбор исхода, начисление.
+        Возвращает (результат, None) при успехе или (None, секунд_до_вылазки) если рано.
+        """
+
+    @abstractmethod
+    async def try_claim_box_cooldown(
+            self,
+            user_id: str,
+            nonce: str,
+            cooldown_hours: int = BOX_COOLDOWN_HOURS
+    ) -> Tuple[bool, Optional[int]]:
+        """Занимает кулдаун ящика и запоминает nonce выданного набора кнопок"""
+
+    @abstractmethod
+    async def save_box_nonce(self, user_id: str, nonce: str):
+        """Запоминает nonce ящика без проверки кулдауна (админский /box)"""
+
+    @abstractmethod
+    async def claim_box(self, user_id: str, nonce: str) -> bool:
+        """Одноразовое открытие ящика: True, только если nonce ещё не был использован"""
+
+    @abstractmethod
+    async def claim_legacy_box(self, user_id: str, button_id: str) -> Optional[str]:
+        """
+        Открытие ящика, выданного до подписанных кнопок: исход берётся из перенесённой
+        карты button_id → исход. None, если ящик уже открыт или окно старых кнопок прошло.
+        """
+
+    @abstractmethod
+    async def get_user_cooldown(self, user_id: str) -> Optional[dict]:
+        """Таймеры игрока в формате {'dig': {chat_id: {...}}, 'box': {...}}"""
+
+    @abstractmethod
+    async def delete_user_cooldowns(self, user_id: str): ...
+
+    # --- Игроки ---
+
+    @abstractmethod
+    async def atomic_add_gp5(self, chat_id: int, user_id: str, amount: int, username: str) -> int: ...
+
+    @abstractmethod
+    async def bulk_add_gp5(self, user_ids: list, amount: int, chat_id: Optional[int] = None) -> dict:
+        """
+        Начисление во все чаты каждого игрока (или только в chat_id) с обновлением global_stats.
+        Возвращает {user_id: {'chats', 'max_gp5', 'username'}} для найденных игроков.
+        """
+
+    @abstractmethod
+    async def get_player(self, chat_id: int, user_id: str) -> Optional[dict]: ...
+
+    @abstractmethod
+    async def load_chat_top(self, chat_id: int, limit: int) -> list:
+        """Топ чата из базы: [{'_id', 'user_id', 'username', 'gp5'}] по убыванию gp5"""
+
+    async def get_chat_top(self, chat_id: int, limit: int = CHAT_TOP_LIMIT) -> list:
+        """
+        Топ чата через кэш: повторные просмотры не ходят в базу. Вылазки и
+        начисления сами правят закэшированный топ (chat_top_cache.update).
+        """
+        cache = self.chat_top_cache
+        if limit > cache.limit:
+            return await self.load_chat_top(chat_id, limit)
+        top = cache.get(chat_id)
+        if top is None:
+            token = cache.begin_load(chat_id)
+            top = await self.load_chat_top(chat_id, cache.limit)
+            cache.store(chat_id, token, top)
+        return top[:limit]
+
+    def update_chat_tops(self, user_id: str, username: str, chats: dict):
+        """Новые балансы игрока {chat_id: gp5} — в закэшированные топы чатов"""
+        for chat_id, gp5 in chats.items():
+            chat_id = int(chat_id)
+            self.chat_top_cache.update(chat_id, user_id, username, gp5, player_key(chat_id, user_id))
+
+    # --- Глобальный рейтинг ---
+
+    @abstractmethod
+    async def get_global_stats(self, user_id: str) -> Optional[dict]:
+        """
+        Запись global_stats игрока: {'max_gp5', 'username', 'chats'}.
+        chats — обратный индекс {chat_id: баланс}, поддерживается на записи.
+        """
+
+    @abstractmethod
+    async def get_global_top(self, limit: int = 10) -> list: ...
+
+    @abstractmethod
+    async def get_user_chats(self, user_id: str) -> dict:
+        """Балансы игрока по чатам прямо из players: {chat_id (str): gp5}"""
+
+    async def check_user_stats(self, user_id: str) -> dict:
+        """
+        Сверка записи global_stats игрока с настоящими балансами в players (/check_user).
+        chats_mismatch — чаты, где карта chats расходится с players.
+        """
+        chats, stats = await asyncio.gather(self.get_user_chats(user_id), self.get_global_stats(user_id))
+        stats = stats or {}
+        stored_chats = stats.get('chats', {})
+        return {
+            'chats': chats,
+            'max_gp5': max(chats.values(), default=0),
+            'stored_max': stats.get('max_gp5', 0),
+            'stored_chats': stored_chats,
+            'chats_mismatch': sorted(
+                chat_id for chat_id in chats.keys() | stored_chats.keys()
+                if chats.get(chat_id) != stored_chats.get(chat_id)
+            )
+        }
+
+    @abstractmethod
+    async def recalculate_global_stats(self) -> dict:
+        """Полный пересчёт global_stats. Возвращает {'count', 'seconds', 'rows_per_sec'}"""
+
+    @abstractmethod
+    async def reconcile_global_stats(self, batch_size: int = 500) -> int: ...
+
+    # --- Чаты ---
+
+    @abstractmethod
+    async def get_broadcast_chat_ids(self) -> list:
+        """id чатов для рассылки: все, кроме помеченных неактивными, недавно активные первыми"""
+
+    @abstractmethod
+    async def mark_chat_inactive(self, chat_id: int, error_reason: str = None): ...
+
+    @abstractmethod
+    async def get_active_chats_stats(self) -> dict:
+        """
+        Счётчики реестра чатов: total, active_24h/7d/30d, inactive, groups, supergroups.
+        Окна активности — по last_active чатов, не помеченных неактивными.
+        """
+
+    # --- Промокоды ---
+
+    @abstractmethod
+    async def create_promo(self, code: str, amount: int, uses: int): ...
+
+    @abstractmethod
+    async def atomic_use_promo(self, code: str, user_id: str) -> Tuple[bool, str, int]:
+        """Активация промокода. Возвращает (успех, причина, награда)"""
+
+    @abstractmethod
+    async def list_promos(self) -> list: ...
+
+    @abstractmethod
+    async def delete_exhausted_promos(self) -> Tuple[int, int]:
+        """Удаляет исчерпанные промокоды. Возвращает (удалено, осталось)"""
+
+    # --- Профиль и статистика ---
+
+    @abstractmethod
+    async def get_user_profile_data(self, chat_id: int, user_id: str) -> dict: ...
+
+    async def get_admin_user_info(self, user_id: str) -> dict:
+        """Сводка по игроку для админа: точечные чтения записи global_stats и таймеров"""
+        stats, cooldown_data = await asyncio.gather(
+            self.get_global_stats(user_id),
+            self.get_user_cooldown(user_id)
+        )
+        stats = stats or {}
+        balances = list(stats.get('chats', {}).values())
+        return {
+            "global_gp5": stats.get("max_gp5", 0),  # МАКСИМУМ
+            "username": stats.get("username", "Unknown"),
+            "exists_globally": bool(balances),
+            "chats_count": len(balances),
+            "total_gp5_sum": sum(balances),  # Сумма для справки
+            "cooldown_data": cooldown_data or {}
+        }
+
+    @abstractmethod
+    async def get_bot_statistics(self) -> dict:
+        """Точная статистика полными агрегациями — только для сверки счётчиков"""
+
+    @abstractmethod
+    async def load_stats_documents(self, day_keys: list) -> Tuple[Optional[dict], dict]:
+        """Документ итоговых счётчиков (None, если ещё не собран) и дневные корзины {_id: doc}"""
+
+    @abstractmethod
+    async def save_stats_counters(self, counters: dict):
+        """Перезаписать итоговые счётчики значениями сверки"""
+
+    async def reconcile_statistics(self):
+        """Точный пересчёт итоговых счётчиков: исправляет дрейф инкрементов"""
+        await self.stats_buffer.flush()
+        exact = await self.get_bot_statistics()
+        await self.save_stats_counters({
+            'unique_players': exact['unique_players'],
+            'total_player_records': exact['total_player_records'],
+            'active_chats': exact['active_chats'],
+            'max_players_in_chat': exact['max_players_in_chat'],
+            'reconciled_at': utcnow()
+        })
+        self._stats_cache = None
+
+    async def get_statistics(self, max_age: float = STATS_CACHE_TTL) -> dict:
+        """
+        Статистика для /chatstats из готовых счётчиков: один документ, корзины
+        за неделю, лидер по индексу global_stats и окна активности по индексу
+        реестра чатов. Результат кэшируется на max_age секунд.
+        """
+        if self._stats_cache and time.monotonic() - self._stats_cache[0] < max_age:
+            return self._stats_cache[1]
+
+        today = utcnow().date()
+        day_keys = [stats_day_key(today - timedelta(days=i)) for i in range(STATS_WEEK_DAYS)]
+        (counters, days), top, chats = await asyncio.gather(
+            self.load_stats_documents(day_keys),
+            self.get_global_top(1),
+            self.get_active_chats_stats()
+        )
+        if counters is None:
+            # Первый запуск: счётчиков ещё нет, собираем их точной сверкой (один раз на всех)
+            async with self._stats_lock:
+                counters, days = await self.load_stats_documents(day_keys)
+                if counters is None:
+                    await self.reconcile_statistics()
+                    counters, days = await self.load_stats_documents(day_keys)
+
+        records = counters.get('total_player_records', 0)
+        active = counters.get('active_chats', 0)
+        stats = {
+            "unique_players": counters.get('unique_players', 0),
+            "active_chats": active,
+            "total_player_records": records,
+            "max_players_in_chat": counters.get('max_players_in_chat', 0),
+            "avg_players_per_chat": round(records / active, 1) if active else 0,
+            "top_player": {
+                'user_id': top[0]['_id'], 'gp5': top[0]['gp5'], 'username': top[0]['username']
+            } if top else None,
+            "chats": chats,
+            "today": {field: days.get(day_keys[0], {}).get(field, 0) for field in STATS_DAILY_FIELDS},
+            "week": {
+                field: sum(days.get(key, {}).get(field, 0) for key in day_keys)
+                for field in STATS_DAILY_FIELDS
+            },
+            "reconciled_at": counters.get('reconciled_at')
+        }
+        self._stats_cache = (time.monotonic(), stats)
+        return stats
+
+    # --- Кэш file_id ---
+
+    @abstractmethod
+    async def load_media_cache(self) -> list:
+        """Все записи кэша с хэшем содержимого: [{filename, hash, file_id}]"""
+
+    @abstractmethod
+    async def save_media_file_id(self, filename: str, digest: str, file_id: str): ...
+
+    @abstractmethod
+    async def save_media_file_ids(self, entries: list):
+        """Пакетная запись [(filename, hash, file_id)]"""
+
+    @abstractmethod
+    async def clear_media_cache(self) -> int: ...
+
+    @abstractmethod
+    async def count_media_cache(self) -> int: ...
+
+
+def create_storage(backend: Optional[str] = None) -> Storage:
+    """Создаёт хранилище по STORAGE_BACKEND (mongo по умолчанию или memory)"""
+    global _storage
+    backend = (backend or os.getenv('STORAGE_BACKEND', 'mongo')).lower()
+    if backend == 'memory':
+        from memory_storage import MemoryStorage
+        _storage = MemoryStorage()
+    elif backend == 'mongo':
+        from database import MongoStorage
+        mongodb_uri = os.getenv('MONGODB_URI')
+        if not mongodb_uri:
+            raise ValueError("MONGODB_URI not set in environment")
+        _storage = MongoStorage(mongodb_uri)
+    else:
+        raise ValueError(f"Unknown STORAGE_BACKEND: {backend}")
+    logging.info(f"Storage backend: {backend}")
+    return _storage
+
+
+def get_storage() -> Storage:
+    if _storage is None:
+        raise RuntimeError("Storage is not initialized, call create_storage() first")
+    return _storage
@@ -0,0 +1,109 @@
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Dict, Tuple
+
+from aiogram import Bot
+
+SUBSCRIBED_STATUSES = ("member", "administrator", "creator")
+
+
+class SubscriptionCache:
+    """
+    Кэш проверок подписки на канал: TTL для подписанных, короткий TTL для
+    неподписанных, вытеснение по LRU. Параллельные проверки одного игрока
+    ждут один общий запрос get_chat_member. Обновления chat_member канала
+    пишутся в кэш напрямую через set().
+    """
+
+    def __init__(self, ttl: float = 300, negative_ttl: float = 20, max_size: int = 50000):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self._entries: 'OrderedDict[int, Tuple[bool, float]]' = OrderedDict()
+        self._inflight: Dict[int, asyncio.Task] = {}
+
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.api_calls = 0
+        self.api_errors = 0
+        self.updates = 0
+        self.evictions = 0
+
+    def _store(self, user_id: int, is_subscribed: bool):
+        ttl = self.ttl if is_subscribed else self.negative_ttl
+        self._entries[user_id] = (is_subscribed, time.monotonic() + ttl)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    async def check(self, bot: Bot, channel_id: int, user_id: int) -> bool:
+        entry = self._entries.get(user_id)
+        if entry and entry[1] > time.monotonic():
+            self._entries.move_to_end(user_id)
+            if entry[0]:
+                self.hits += 1
+            else:
+                self.negative_hits += 1
+            return entry[0]
+
+        task = self._inflight.get(user_id)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            task = asyncio.create_task(self._fetch(bot, channel_id, user_id))
+            self._inflight[user_id] = task
+        # shield: отмена одного ожидающего не обрывает общий запрос
+        return await asyncio.shield(task)
+
+    async def _fetch(self, bot: Bot, channel_id: int, user_id: int) -> bool:
+        task = asyncio.current_task()
+        try:
+            self.api_calls += 1
+            try:
+                member = await bot.get_chat_member(channel_id, user_id)
+            except Exception as e:
+                self.api_errors += 1
+                logging.warning(f"Error checking subscription for {user_id}: {e}")
+                # При ошибке API доверяем прежней подписке, даже устаревшей
+                entry = self._entries.get(user_id)
+                return bool(entry and entry[0])
+            is_subscribed = member.status in SUBSCRIBED_STATUSES
+            # Если за время запроса пришло обновление chat_member, оно свежее ответа
+            if self._inflight.get(user_id) is task:
+                self._store(user_id, is_subscribed)
+            return is_subscribed
+        finally:
+            if self._inflight.get(user_id) is task:
+                del self._inflight[user_id]
+
+    def set(self, user_id: int, is_subscribed: bool):
+        """Статус из обновления chat_member канала"""
+        self.updates += 1
+        self._inflight.pop(user_id, None)
+        self._store(user_id, is_subscribed)
+
+    def invalidate(self, user_id: int):
+        self._inflight.pop(user_id, None)
+        self._entries.pop(user_id, None)
+
+    def metrics(self) -> dict:
+        lookups = self.hits + self.negative_hits + self.misses + self.coalesced
+        return {
+            "name": "subscription",
+            "size": len(self._entries),
+            "hits": self.hits,
+            "negative_hits": self.negative_hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "hit_rate": round((lookups - self.misses) / lookups * 100, 1) if lookups else 0.0,
+            "api_calls": self.api_calls,
+            "api_errors": self.api_errors,
+            "updates": self.updates,
+            "evictions": self.evictions
+        }
@@ -0,0 +1,39 @@
+import os
+import sys
+import uuid
+import asyncio
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(params=['memory', 'mongo'])
+def run_storage(request):
+    """
+    Запуск async-сценария scenario(storage) на каждом бэкенде.
+    mongo — во временной базе, только если задан MONGODB_URI.
+    """
+    backend = request.param
+    mongodb_uri = os.getenv('MONGODB_URI')
+    if backend == 'mongo' and not mongodb_uri:
+        pytest.skip("MONGODB_URI not set")
+
+    def run(scenario):
+        async def _run():
+            if backend == 'memory':
+                from memory_storage import MemoryStorage
+                await scenario(MemoryStorage())
+                return
+            from database import MongoStorage
+            storage = MongoStorage(mongodb_uri, db_name=f"bot_test_{uuid.uuid4().hex[:12]}")
+            try:
+                await storage.prepare()
+                await scenario(storage)
+            finally:
+                await storage.client.drop_database(storage.db.name)
+                await storage.close()
+
+        asyncio.run(_run())
+
+    return run
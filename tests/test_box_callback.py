@@ -0,0 +1,71 @@
+import uuid
+import asyncio
+from datetime import timedelta
+
+from memory_storage import MemoryStorage
+from storage import box_key, utcnow
+from utils import (
+    BOX_OUTCOMES, new_box_nonce, pack_box_callback, unpack_box_callback, unpack_legacy_box_callback
+)
+
+SECRET = b'test-secret'
+
+
+def test_round_trip_restores_every_outcome():
+    nonce = new_box_nonce()
+    for slot, outcome in enumerate(BOX_OUTCOMES):
+        data = pack_box_callback(SECRET, 'box', 123456789, nonce, slot, outcome)
+        assert unpack_box_callback(SECRET, data) == ('box', 123456789, nonce, outcome)
+
+
+def test_tampered_signature_is_rejected():
+    data = pack_box_callback(SECRET, 'box', 42, new_box_nonce(), 0, 'win')
+    payload, signature = data.rsplit('_', 1)
+    forged = signature[:-1] + ('0' if signature[-1] != '0' else '1')
+    assert unpack_box_callback(SECRET, f"{payload}_{forged}") is None
+    assert unpack_box_callback(b'other-secret', data) is None
+
+
+def test_other_user_id_breaks_signature():
+    data = pack_box_callback(SECRET, 'box', 42, new_box_nonce(), 1, 'lose')
+    prefix, _, rest = data.split('_', 2)
+    assert unpack_box_callback(SECRET, f"{prefix}_43_{rest}") is None
+
+
+def test_fits_telegram_callback_limit():
+    data = pack_box_callback(SECRET, 'abox', 2 ** 53, new_box_nonce(), 2, 'empty')
+    assert len(data.encode()) <= 64
+
+
+def test_old_format_is_recognised_only_as_legacy():
+    button_id = str(uuid.uuid4())
+    data = f"box_42_{button_id}"
+    assert unpack_box_callback(SECRET, data) is None
+    assert unpack_legacy_box_callback(data) == ('box', 42, button_id)
+    assert unpack_legacy_box_callback("box_42_not-a-uuid") is None
+    assert unpack_legacy_box_callback(pack_box_callback(SECRET, 'box', 42, new_box_nonce(), 0, 'win')) is None
+
+
+def test_legacy_box_opens_once_within_window():
+    async def scenario():
+        storage = MemoryStorage()
+        button_id = str(uuid.uuid4())
+        # Так документ ящика оставляет миграция v4
+        storage.cooldowns[box_key('42')] = {
+            'user_id': '42',
+            'pending': True,
+            'legacy_mapping': {button_id: 'win'},
+            'legacy_until': utcnow() + timedelta(hours=1)
+        }
+        assert await storage.claim_legacy_box('42', str(uuid.uuid4())) is None
+        assert await storage.claim_legacy_box('42', button_id) == 'win'
+        assert await storage.claim_legacy_box('42', button_id) is None
+
+        storage.cooldowns[box_key('7')] = {
+            'user_id': '7',
+            'legacy_mapping': {button_id: 'lose'},
+            'legacy_until': utcnow() - timedelta(seconds=1)
+        }
+        assert await storage.claim_legacy_box('7', button_id) is None
+
+    asyncio.run(scenario())
@@ -0,0 +1,101 @@
+import json
+
+import pytest
+
+from catalog import MessageCatalog, UNKNOWN_RANK
+from utils import MESSAGES_FILE
+
+
+def baseline_rank(gp5: int, messages: dict) -> dict:
+    """get_user_rank до перехода на MessageCatalog — эталон для сравнения"""
+    ranks = messages.get("ranks", [])
+    if not ranks:
+        return {"name": "Неизвестный", "emoji": "❓", "image": None, "min_gp5": 0, "next_rank": None, "progress": 0}
+    sorted_ranks = sorted(ranks, key=lambda x: x.get("min_gp5", 0), reverse=True)
+    current_rank = sorted_ranks[-1]
+    next_rank = None
+    for i, rank in enumerate(sorted_ranks):
+        if gp5 >= rank.get("min_gp5", 0):
+            current_rank = rank
+            if i > 0:
+                next_rank = sorted_ranks[i - 1]
+            break
+        next_rank = rank
+    progress = 100
+    if next_rank:
+        current_min = current_rank.get("min_gp5", 0)
+        next_min = next_rank.get("min_gp5", 0)
+        if next_min > current_min:
+            progress = int(((gp5 - current_min) / (next_min - current_min)) * 100)
+            progress = max(0, min(progress, 99))
+    return {
+        "name": current_rank.get("name", "Неизвестный"),
+        "emoji": current_rank.get("emoji", "❓"),
+        "image": current_rank.get("image"),
+        "min_gp5": current_rank.get("min_gp5", 0),
+        "next_rank": next_rank,
+        "progress": progress
+    }
+
+
+def rank(min_gp5, name):
+    return {"min_gp5": min_gp5, "name": name, "emoji": "*", "image": f"{name}.jpg"}
+
+
+def comparable(result: dict) -> dict:
+    return {key: value for key, value in result.items() if key != "name_md"}
+
+
+def balances(messages: dict) -> list:
+    thresholds = sorted({r["min_gp5"] for r in messages["ranks"]})
+    around = {t + delta for t in thresholds for delta in (-1, 0, 1)}
+    return sorted(around | {-50, thresholds[-1] * 10} | set(range(0, thresholds[-1] + 50, 7)))
+
+
+def test_rank_for_matches_baseline_on_shipped_messages():
+    with open(MESSAGES_FILE, encoding='utf-8') as f:
+        messages = json.load(f)
+    catalog = MessageCatalog.compile(messages)
+    for gp5 in balances(messages):
+        assert comparable(catalog.rank_for(gp5)) == baseline_rank(gp5, messages), gp5
+
+
+@pytest.mark.parametrize("gp5, name, next_name, progress", [
+    (-5, "first", "first", 100),    # ниже первого порога — младший ранг без прогресса
+    (0, "first", "second", 0),
+    (50, "first", "second", 50),
+    (99, "first", "second", 99),
+    (100, "second", "last", 0),
+    (199, "second", "last", 99),
+    (200, "last", None, 100),       # последний ранг
+    (10 ** 9, "last", None, 100),
+])
+def test_rank_for_boundaries(gp5, name, next_name, progress):
+    # Порядок в файле не важен: таблица сортируется при компиляции
+    messages = {"ranks": [rank(200, "last"), rank(0, "first"), rank(100, "second")]}
+    result = MessageCatalog.compile(messages).rank_for(gp5)
+    assert (result["name"], result["progress"]) == (name, progress)
+    assert (result["next_rank"] or {}).get("name") == next_name
+    assert comparable(result) == baseline_rank(gp5, messages)
+
+
+def test_rank_for_ties_keep_first_rank_in_file():
+    messages = {"ranks": [rank(0, "first"), rank(100, "tied_a"), rank(100, "tied_b"), rank(200, "last")]}
+    catalog = MessageCatalog.compile(messages)
+    assert [r.name for r in catalog.ranks] == ["first", "tied_a", "last"]
+
+    for gp5 in (100, 150, 199, 200, 500):
+        assert comparable(catalog.rank_for(gp5)) == baseline_rank(gp5, messages), gp5
+
+    # Ниже общего порога эталон обещает следующим tied_b, хотя на 100 выдаёт tied_a;
+    # каталог называет ранг, который игрок действительно получит
+    result, expected = catalog.rank_for(50), baseline_rank(50, messages)
+    assert result["next_rank"]["name"] == "tied_a"
+    assert expected["next_rank"]["name"] == "tied_b"
+    assert result["next_rank"]["min_gp5"] == expected["next_rank"]["min_gp5"]
+    assert result["progress"] == expected["progress"] == 50
+
+
+def test_rank_for_without_ranks():
+    assert MessageCatalog.compile({}).rank_for(100) == UNKNOWN_RANK
+    assert comparable(UNKNOWN_RANK) == baseline_rank(100, {})
@@ -0,0 +1,78 @@
+import os
+import uuid
+import asyncio
+
+import pytest
+
+from memory_storage import MemoryStorage
+from storage import player_key
+from utils import GLOBAL_STATS_COLLECTION, PLAYERS_COLLECTION
+
+MONGODB_URI = os.getenv('MONGODB_URI')
+
+
+def run_with_memory(scenario):
+    asyncio.run(scenario(MemoryStorage()))
+
+
+def test_recalculate_rebuilds_max_and_chat_map():
+    async def scenario(storage):
+        await storage.atomic_add_gp5(-1, '1', 30, 'alice')
+        await storage.atomic_add_gp5(-2, '1', 80, 'alice')
+        await storage.atomic_add_gp5(-1, '2', 10, 'bob')
+        storage.global_stats['stale'] = {'max_gp5': 999, 'username': 'ghost', 'chats': {}}
+
+        result = await storage.recalculate_global_stats()
+
+        assert result['count'] == 2
+        assert await storage.get_global_stats('1') == {
+            '_id': '1', 'max_gp5': 80, 'username': 'alice', 'chats': {'-1': 30, '-2': 80}
+        }
+        assert [row['_id'] for row in await storage.get_global_top()] == ['1', '2']
+
+    run_with_memory(scenario)
+
+
+def test_reconcile_fixes_drifted_max_and_chats():
+    async def scenario(storage):
+        await storage.atomic_add_gp5(-1, '1', 50, 'alice')
+        await storage.atomic_add_gp5(-2, '1', 20, 'alice')
+        await storage.recalculate_global_stats()
+
+        # Баланс упал мимо global_stats (как потерянное отложенное обновление)
+        storage.players[player_key(-1, '1')]['gp5'] = 5
+
+        assert await storage.reconcile_global_stats() == 1
+        stats = await storage.get_global_stats('1')
+        assert stats['max_gp5'] == 20
+        assert stats['chats'] == {'-1': 5, '-2': 20}
+        assert await storage.reconcile_global_stats() == 0
+
+    run_with_memory(scenario)
+
+
+@pytest.mark.skipif(not MONGODB_URI, reason="MONGODB_URI not set")
+def test_rebuild_restores_players_missing_after_swap():
+    from database import MongoStorage
+
+    async def scenario():
+        storage = MongoStorage(MONGODB_URI, db_name=f"bot_test_{uuid.uuid4().hex[:12]}")
+        try:
+            await storage.atomic_add_gp5(-1, '1', 40, 'alice')
+            await storage.recalculate_global_stats()
+
+            # Игрок появился, а его запись global_stats выбросила подмена коллекции
+            await storage.atomic_add_gp5(-1, '2', 15, 'bob')
+            assert await storage.db[GLOBAL_STATS_COLLECTION].find_one({'_id': '2'}) is None
+
+            assert await storage.restore_missing_global_stats() == 1
+            assert await storage.restore_missing_global_stats() == 0
+            stats = await storage.get_global_stats('2')
+            assert stats['max_gp5'] == 15
+            assert stats['chats'] == {'-1': 15}
+            assert await storage.db[PLAYERS_COLLECTION].count_documents({}) == 2
+        finally:
+            await storage.client.drop_database(storage.db.name)
+            await storage.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,51 @@
+import os
+import asyncio
+from types import SimpleNamespace
+
+os.environ.setdefault('STORAGE_BACKEND', 'memory')
+os.environ.setdefault('TOKEN', '123456:TEST')
+
+import launch  # noqa: E402
+from storage import player_key  # noqa: E402
+from utils import BotConfig, BotState  # noqa: E402
+
+ADMIN_ID = 1
+
+
+class FakeMessage:
+    def __init__(self, text: str, user_id: int = ADMIN_ID):
+        self.text = text
+        self.from_user = SimpleNamespace(id=user_id)
+        self.replies = []
+
+    async def reply(self, text: str, **kwargs):
+        self.replies.append(text)
+
+
+def admin_state() -> BotState:
+    return BotState(config=BotConfig(token='', admin_ids=[ADMIN_ID], channel_id=0, channel_link=''))
+
+
+def check_user(user_id: str) -> str:
+    message = FakeMessage(f"/check_user {user_id}")
+    asyncio.run(launch.cmd_check_user(message, admin_state()))
+    return message.replies[-1]
+
+
+def test_check_user_reports_drift_from_players():
+    storage = launch.storage
+
+    async def seed():
+        for chat_id, amount in ((-1, 40), (-2, 25)):
+            gp5 = await storage.atomic_add_gp5(chat_id, '77', amount, 'digger')
+            await storage.update_global_stats(77, gp5, 'digger', chat_id=chat_id)
+
+    asyncio.run(seed())
+    assert "✅ Данные корректны!" in check_user('77')
+
+    # Баланс изменился, а global_stats — нет
+    storage.players[player_key(-1, '77')]['gp5'] = 10
+    report = check_user('77')
+    assert "✅" not in report
+    assert "должно быть 25, хранится 40" in report
+    assert "Чат `-1`: в players 10, в global_stats.chats 40" in report
@@ -0,0 +1,70 @@
+import os
+import asyncio
+
+from media_cache import MediaCache
+from storage import create_storage
+
+
+def make_cache(tmp_path, **kwargs) -> MediaCache:
+    def resolve(filename):
+        path = os.path.join(tmp_path, filename)
+        return path if os.path.exists(path) else None
+
+    return MediaCache(resolve, **kwargs)
+
+
+def test_preupload_check_does_not_count_lookups(tmp_path):
+    (tmp_path / 'a.png').write_bytes(b'a')
+    cache = make_cache(str(tmp_path))
+
+    async def scenario():
+        create_storage('memory')
+        await cache.put('a.png', 'file-a')
+        report = await cache.preupload(bot=None, channel_id=0, filenames=['a.png'])
+        assert report['skipped'] == 1
+        assert (cache.hits, cache.misses) == (0, 0)
+        assert cache.get('a.png') == 'file-a'
+        assert (cache.hits, cache.misses) == (1, 0)
+
+    asyncio.run(scenario())
+
+
+def test_digest_is_not_rechecked_within_interval(tmp_path):
+    path = tmp_path / 'a.png'
+    path.write_bytes(b'a')
+    cache = make_cache(str(tmp_path), recheck_interval=60)
+    digest = cache.digest('a.png')
+
+    path.write_bytes(b'changed')
+    assert cache.digest('a.png') == digest
+
+    cache.recheck_interval = 0
+    assert cache.digest('a.png') != digest
+
+
+def test_preload_keys_file_ids_by_content_hash(tmp_path):
+    (tmp_path / 'a.png').write_bytes(b'a')
+    cache = make_cache(str(tmp_path), recheck_interval=0)
+
+    async def scenario():
+        storage = create_storage('memory')
+        await storage.save_media_file_ids([
+            ('a.png', cache.digest('a.png'), 'file-a'),
+            ('gone.png', 'deadbeef', 'file-gone')
+        ])
+        assert await cache.preload() == 2
+
+        assert cache.get('a.png') == 'file-a'
+        # Без локального файла — последний известный file_id по имени
+        assert cache.get('gone.png') == 'file-gone'
+
+        # Заменённый файл — новый хэш, старый file_id к нему не подходит
+        (tmp_path / 'a.png').write_bytes(b'replaced')
+        assert cache.get('a.png') is None
+        assert (cache.hits, cache.misses) == (2, 1)
+
+        await cache.put('a.png', 'file-a2')
+        assert cache.get('a.png') == 'file-a2'
+        assert len(await storage.load_media_cache()) == 3
+
+    asyncio.run(scenario())
@@ -0,0 +1,135 @@
+"""
+Миграции против настоящей MongoDB: MONGODB_URI=... python -m pytest tests.
+Каждый тест работает в своей временной базе и удаляет её после себя.
+"""
+import os
+import uuid
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from migrations import (
+    MIGRATIONS, PLAYERS_VERSION, PROMO_DOCUMENTS_VERSION, DIG_COOLDOWNS_VERSION,
+    MigrationRunner, StepState, _migrate_v5_players
+)
+from storage import player_key
+from utils import (
+    CHAT_DATA_COLLECTION, GLOBAL_COOLDOWN_COLLECTION, PLAYERS_COLLECTION, PROMO_COLLECTION, DIG_COOLDOWN_HOURS
+)
+
+MONGODB_URI = os.getenv('MONGODB_URI')
+requires_mongo = pytest.mark.skipif(not MONGODB_URI, reason="MONGODB_URI not set")
+
+
+def run_with_mongo(scenario, up_to: int):
+    from database import MongoStorage
+
+    async def _run():
+        storage = MongoStorage(MONGODB_URI, db_name=f"bot_test_{uuid.uuid4().hex[:12]}")
+        storage.migrations = MigrationRunner(
+            storage.db, [m for m in MIGRATIONS if m.version <= up_to], batch_size=2
+        )
+        try:
+            await scenario(storage)
+        finally:
+            await storage.client.drop_database(storage.db.name)
+            await storage.close()
+
+    asyncio.run(_run())
+
+
+@requires_mongo
+def test_v5_merges_legacy_balance_into_player_created_during_migration():
+    async def scenario(storage):
+        db = storage.db
+        await db[CHAT_DATA_COLLECTION].insert_one({'_id': -100, 'data': {
+            '1': {'gp5': 50, 'username': 'old', 'last_loot_type': 'super'},
+            '2': {'gp5': 7, 'username': 'two'}
+        }})
+
+        # Бот уже отвечает, а строки игроков ещё не перенесены
+        assert await storage.atomic_add_gp5(-100, '1', 5, 'new') == 5
+        assert await storage.atomic_add_gp5(-100, '2', 3, 'two') == 3
+
+        await storage.migrations.run()
+
+        first = await db[PLAYERS_COLLECTION].find_one({'_id': player_key(-100, '1')})
+        second = await db[PLAYERS_COLLECTION].find_one({'_id': player_key(-100, '2')})
+        assert first['gp5'] == 55
+        assert first['username'] == 'new'
+        assert first['last_loot_type'] == 'super'
+        assert second['gp5'] == 10
+
+        # Повтор пачки после сбоя не начисляет старый баланс второй раз
+        await _migrate_v5_players(storage.migrations, StepState(PLAYERS_VERSION, 'players'))
+        first = await db[PLAYERS_COLLECTION].find_one({'_id': player_key(-100, '1')})
+        assert first['gp5'] == 55
+
+    run_with_mongo(scenario, up_to=PLAYERS_VERSION)
+
+
+@requires_mongo
+def test_dig_waits_for_cooldowns_migration():
+    async def scenario(storage):
+        dug_at = (datetime.now(timezone.utc) - timedelta(hours=1)).isoformat()
+        await storage.db[CHAT_DATA_COLLECTION].insert_one({'_id': -100, 'data': {'1': {'gp5': 50}}})
+        await storage.db[GLOBAL_COOLDOWN_COLLECTION].insert_one({'_id': 'singleton', 'data': {
+            '1': {'dig': {'-100': {'time': dug_at, 'last_loot': 4}}},
+            # Кулдаун без строки в chat_data: v7 создаёт документ игрока сам
+            '2': {'dig': {'-200': {'time': dug_at}}}
+        }})
+        migration = storage.migrations.run_in_background()
+
+        result, wait = await storage.apply_dig(-100, '1', 'one', super_roll=False, success_roll=True, gain=5, lost=1)
+        assert result is None
+        assert 0 < wait <= DIG_COOLDOWN_HOURS * 3600
+        await migration
+
+        first = await storage.db[PLAYERS_COLLECTION].find_one({'_id': player_key(-100, '1')})
+        assert (first['gp5'], first['last_loot']) == (50, 4)
+        second = await storage.db[PLAYERS_COLLECTION].find_one({'_id': player_key(-200, '2')})
+        assert (second['chat_id'], second['user_id']) == (-200, '2')
+        assert second['dig_at'] is not None
+
+    run_with_mongo(scenario, up_to=DIG_COOLDOWNS_VERSION)
+
+
+@requires_mongo
+def test_promo_waits_for_promo_documents_migration():
+    async def scenario(storage):
+        await storage.db[PROMO_COLLECTION].insert_one({'_id': 'singleton', 'data': {
+            'LEGACY': {'amount': 25, 'uses': 2, 'used_by': {'9': '2024-01-01T00:00:00'}}
+        }})
+        migration = storage.migrations.run_in_background()
+
+        assert await storage.atomic_use_promo('LEGACY', '1') == (True, "success", 25)
+        assert await storage.atomic_use_promo('LEGACY', '9') == (False, "already_used", 0)
+        assert await storage.atomic_use_promo('LEGACY', '2') == (False, "exhausted", 0)
+        await migration
+
+    run_with_mongo(scenario, up_to=PROMO_DOCUMENTS_VERSION)
+
+
+def test_wait_for_raises_after_failed_migration():
+    runner = MigrationRunner(db=None, migrations=MIGRATIONS)
+    runner.running = True
+    runner.applied_version = PLAYERS_VERSION - 1
+    runner.error = "boom"
+    with pytest.raises(RuntimeError):
+        asyncio.run(runner.wait_for(PLAYERS_VERSION))
+
+
+def test_wait_for_returns_once_version_applied():
+    runner = MigrationRunner(db=None, migrations=MIGRATIONS)
+    runner.running = True
+    runner.applied_version = PLAYERS_VERSION - 1
+
+    async def scenario():
+        waiter = asyncio.create_task(runner.wait_for(PLAYERS_VERSION, poll_interval=0.01))
+        await asyncio.sleep(0.05)
+        assert not waiter.done()
+        runner.applied_version = PLAYERS_VERSION
+        await asyncio.wait_for(waiter, 1)
+
+    asyncio.run(scenario())
@@ -0,0 +1,56 @@
+import asyncio
+from types import SimpleNamespace
+
+from catalog import MessageCatalog
+from utils import PrefilterMiddleware
+
+
+def make_prefilter(triggers=("хабарить",)):
+    return PrefilterMiddleware(SimpleNamespace(messages=MessageCatalog.compile({"triggers": list(triggers)})))
+
+
+def passes(prefilter, text=None, caption=None):
+    """message_kind, с которым сообщение дошло до хэндлера, или None, если отброшено"""
+    seen = []
+
+    async def handler(event, data):
+        seen.append(data['message_kind'])
+
+    message = SimpleNamespace(text=text, caption=caption)
+    asyncio.run(prefilter(handler, message, {}))
+    return seen[0] if seen else None
+
+
+def test_commands_pass():
+    prefilter = make_prefilter()
+    assert passes(prefilter, "/dig") == 'command'
+    assert passes(prefilter, "/give@bot 5") == 'command'
+    # Команда подписью к файлу
+    assert passes(prefilter, caption="/give 100") == 'command'
+    assert prefilter.commands == 3
+
+
+def test_trigger_words_pass():
+    prefilter = make_prefilter(("хабарить", "копать"))
+    assert passes(prefilter, "Пойду ХАБАРИТЬ") == 'trigger'
+    assert passes(prefilter, "копать") == 'trigger'
+    assert prefilter.triggers == 2
+
+
+def test_other_messages_are_dropped_and_counted():
+    prefilter = make_prefilter()
+    assert passes(prefilter, "привет всем") is None
+    assert passes(prefilter, caption="подпись к фото") is None
+    # Триггер в подписи не считается: без команды подписи отбрасываются
+    assert passes(prefilter, caption="хабарить") is None
+    assert passes(prefilter) is None
+    assert prefilter.metrics() == {
+        "name": "prefilter", "commands": 0, "triggers": 0, "dropped": 4, "drop_rate": 100.0
+    }
+
+
+def test_no_catalog_passes_only_commands():
+    prefilter = PrefilterMiddleware(SimpleNamespace(messages=None))
+    assert passes(prefilter, "хабарить") is None
+    assert passes(prefilter, "/start") == 'command'
+    assert prefilter.metrics()["drop_rate"] == 50.0
@@ -0,0 +1,79 @@
+from utils import DIG_COOLDOWN_HOURS, PROMO_USAGE_COLLECTION
+
+
+def dig(storage, user_id='1', **rolls):
+    rolls = {'super_roll': False, 'success_roll': True, 'gain': 5, 'lost': 2, **rolls}
+    return storage.apply_dig(-100, user_id, f"user{user_id}", **rolls)
+
+
+async def promo_usages(storage, user_id: str) -> int:
+    if hasattr(storage, 'promo_usage'):
+        return sum(1 for used_by, _ in storage.promo_usage if used_by == user_id)
+    return await storage.db[PROMO_USAGE_COLLECTION].count_documents({'user_id': user_id})
+
+
+def test_apply_dig_claims_cooldown_once(run_storage):
+    async def scenario(storage):
+        result, wait = await dig(storage)
+        assert wait is None
+        assert result == {'loot': 5, 'loot_type': 'normal', 'old_balance': 0, 'new_balance': 5}
+
+        result, wait = await dig(storage, gain=100)
+        assert result is None
+        assert 0 < wait <= DIG_COOLDOWN_HOURS * 3600
+        assert (await storage.get_player(-100, '1'))['gp5'] == 5
+
+        result, wait = await dig(storage, bypass_cooldown=True, success_roll=False)
+        assert wait is None
+        assert result['loot'] == -2
+        assert (await storage.get_player(-100, '1'))['gp5'] == 3
+
+        # Снятый кулдаун снова пускает на вылазку
+        await storage.delete_user_cooldowns('1')
+        result, wait = await dig(storage, super_roll=True)
+        assert result['loot_type'] == 'super'
+        await storage.delete_user_cooldowns('1')
+        result, wait = await dig(storage, super_roll=True)
+        assert result['loot_type'] == 'normal'
+
+    run_storage(scenario)
+
+
+def test_apply_dig_newcomer_never_fails(run_storage):
+    async def scenario(storage):
+        result, _ = await dig(storage, user_id='2', success_roll=False)
+        assert result['loot_type'] == 'normal'
+        assert result['new_balance'] == 5
+
+    run_storage(scenario)
+
+
+def test_promo_failed_activation_leaves_no_usage(run_storage):
+    async def scenario(storage):
+        assert await storage.atomic_use_promo('LATER', '1') == (False, "not_found", 0)
+        assert await promo_usages(storage, '1') == 0
+
+        await storage.create_promo('LATER', 10, 1)
+        assert await storage.atomic_use_promo('LATER', '1') == (True, "success", 10)
+        assert await storage.atomic_use_promo('LATER', '1') == (False, "already_used", 0)
+        assert await storage.atomic_use_promo('LATER', '2') == (False, "exhausted", 0)
+        assert await promo_usages(storage, '2') == 0
+
+        await storage.create_promo('LATER', 10, 1)
+        assert await storage.atomic_use_promo('LATER', '2') == (True, "success", 10)
+        promos = await storage.list_promos()
+        assert [(p['remaining'], p['used_count']) for p in promos] == [(0, 1)]
+
+    run_storage(scenario)
+
+
+def test_unlimited_promo_keeps_remaining(run_storage):
+    async def scenario(storage):
+        await storage.create_promo('FOREVER', 3, -1)
+        for user_id in ('1', '2', '3'):
+            assert await storage.atomic_use_promo('FOREVER', user_id) == (True, "success", 3)
+        assert await storage.delete_exhausted_promos() == (0, 1)
+        promos = await storage.list_promos()
+        assert (promos[0]['remaining'], promos[0]['used_count']) == (-1, 3)
+
+    run_storage(scenario)
@@ -0,0 +1,95 @@
+import asyncio
+from types import SimpleNamespace
+
+from subscription_cache import SubscriptionCache
+
+
+class FakeBot:
+    """get_chat_member с задержкой и счётчиком вызовов"""
+
+    def __init__(self, status='member', delay=0.01):
+        self.status = status
+        self.delay = delay
+        self.calls = 0
+        self.fail = False
+
+    async def get_chat_member(self, chat_id, user_id):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        if self.fail:
+            raise RuntimeError("api down")
+        return SimpleNamespace(status=self.status)
+
+
+def test_concurrent_checks_share_one_request():
+    async def scenario():
+        cache, bot = SubscriptionCache(), FakeBot()
+        results = await asyncio.gather(*(cache.check(bot, -1, 1) for _ in range(5)))
+        assert results == [True] * 5
+        assert bot.calls == 1
+        assert (cache.misses, cache.coalesced) == (1, 4)
+
+        assert await cache.check(bot, -1, 1) is True
+        assert bot.calls == 1
+        assert cache.hits == 1
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_waiter_does_not_cancel_shared_request():
+    async def scenario():
+        cache, bot = SubscriptionCache(), FakeBot(delay=0.05)
+        first = asyncio.create_task(cache.check(bot, -1, 1))
+        second = asyncio.create_task(cache.check(bot, -1, 1))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        assert await second is True
+        assert bot.calls == 1
+
+    asyncio.run(scenario())
+
+
+def test_negative_result_expires_sooner():
+    async def scenario():
+        cache, bot = SubscriptionCache(ttl=60, negative_ttl=0.05), FakeBot(status='left', delay=0)
+        assert await cache.check(bot, -1, 1) is False
+        assert await cache.check(bot, -1, 1) is False
+        assert (bot.calls, cache.negative_hits) == (1, 1)
+
+        bot.status = 'member'
+        await asyncio.sleep(0.06)
+        assert await cache.check(bot, -1, 1) is True
+        assert bot.calls == 2
+
+        # Положительный ответ живёт полный TTL
+        await asyncio.sleep(0.06)
+        assert await cache.check(bot, -1, 1) is True
+        assert bot.calls == 2
+
+    asyncio.run(scenario())
+
+
+def test_chat_member_update_wins_over_inflight_answer():
+    async def scenario():
+        cache, bot = SubscriptionCache(), FakeBot(status='member', delay=0.02)
+        pending = asyncio.create_task(cache.check(bot, -1, 1))
+        await asyncio.sleep(0)
+        cache.set(1, False)
+        await pending
+        assert await cache.check(bot, -1, 1) is False
+        assert bot.calls == 1
+
+    asyncio.run(scenario())
+
+
+def test_api_error_keeps_previous_status():
+    async def scenario():
+        cache, bot = SubscriptionCache(ttl=0.01), FakeBot(delay=0)
+        assert await cache.check(bot, -1, 1) is True
+        await asyncio.sleep(0.02)
+        bot.fail = True
+        assert await cache.check(bot, -1, 1) is True
+        assert await cache.check(bot, -1, 2) is False
+        assert cache.api_errors == 2
+
+    asyncio.run(scenario())
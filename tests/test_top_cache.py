@@ -0,0 +1,85 @@
+from top_cache import ChatTopCache
+
+
+def player(user_id, gp5):
+    return {'_id': f"-100_{user_id}", 'user_id': user_id, 'username': f"user{user_id}", 'gp5': gp5}
+
+
+def loaded(cache, chat_id, top):
+    cache.store(chat_id, cache.begin_load(chat_id), top)
+
+
+def balances(cache, chat_id):
+    return [(entry['user_id'], entry['gp5']) for entry in cache.get(chat_id)]
+
+
+def test_update_patches_cached_top():
+    cache = ChatTopCache(limit=3)
+    loaded(cache, -100, [player('1', 30), player('2', 20), player('3', 10)])
+
+    cache.update(-100, '3', 'user3', 40)
+    assert balances(cache, -100) == [('3', 40), ('1', 30), ('2', 20)]
+
+    # Новичок выше нижней границы вытесняет последнего
+    cache.update(-100, '4', 'user4', 25, key='-100_4')
+    assert balances(cache, -100) == [('3', 40), ('1', 30), ('4', 25)]
+
+    # Игрок ниже топа список не трогает
+    cache.update(-100, '5', 'user5', 1)
+    assert balances(cache, -100) == [('3', 40), ('1', 30), ('4', 25)]
+    assert cache.patched == 2
+
+
+def test_update_incomplete_top_adds_anyone():
+    cache = ChatTopCache(limit=3)
+    loaded(cache, -100, [player('1', 30)])
+    cache.update(-100, '2', 'user2', 1)
+    assert balances(cache, -100) == [('1', 30), ('2', 1)]
+
+
+def test_falling_below_top_invalidates():
+    cache = ChatTopCache(limit=2)
+    loaded(cache, -100, [player('1', 30), player('2', 20)])
+    cache.update(-100, '1', 'user1', 5)
+    assert cache.get(-100) is None
+    assert cache.invalidations == 1
+
+
+def test_returned_top_is_a_copy():
+    cache = ChatTopCache(limit=2)
+    loaded(cache, -100, [player('1', 30)])
+    cache.get(-100)[0]['gp5'] = 0
+    assert balances(cache, -100) == [('1', 30)]
+
+
+def test_stale_load_is_not_stored():
+    cache = ChatTopCache(limit=3)
+    token = cache.begin_load(-100)
+    # Баланс изменился, пока топ читался из базы
+    cache.update(-100, '1', 'user1', 50)
+    cache.store(-100, token, [player('1', 30)])
+    assert cache.get(-100) is None
+
+    token = cache.begin_load(-100)
+    cache.invalidate(-100)
+    cache.store(-100, token, [player('1', 30)])
+    assert cache.get(-100) is None
+
+    # Более поздняя загрузка отменяет предыдущую
+    first = cache.begin_load(-100)
+    second = cache.begin_load(-100)
+    cache.store(-100, first, [player('1', 30)])
+    assert cache.get(-100) is None
+    cache.store(-100, second, [player('1', 50)])
+    assert balances(cache, -100) == [('1', 50)]
+
+
+def test_lru_eviction():
+    cache = ChatTopCache(limit=3, max_chats=2)
+    loaded(cache, -1, [player('1', 1)])
+    loaded(cache, -2, [player('1', 2)])
+    cache.get(-1)
+    loaded(cache, -3, [player('1', 3)])
+    assert cache.get(-2) is None
+    assert cache.get(-1) is not None
+    assert cache.evictions == 1
@@ -0,0 +1,95 @@
+import asyncio
+
+from write_behind import WriteBehindBuffer
+
+
+def make_buffer(handler=None, **kwargs):
+    flushed = []
+
+    async def record(batch):
+        flushed.append(dict(batch))
+
+    buffer = WriteBehindBuffer('test', handler or record, merge=lambda old, new: old + new, **kwargs)
+    return buffer, flushed
+
+
+def test_put_coalesces_repeated_keys():
+    async def scenario():
+        buffer, flushed = make_buffer()
+        buffer.put('a', 1)
+        buffer.put('a', 2)
+        buffer.put('b', 5)
+        assert await buffer.flush() == 2
+        assert flushed == [{'a': 3, 'b': 5}]
+        assert await buffer.flush() == 0
+        metrics = buffer.metrics()
+        assert (metrics['received'], metrics['coalesced'], metrics['flushes']) == (3, 1, 1)
+
+    asyncio.run(scenario())
+
+
+def test_full_buffer_drops_new_keys_but_merges_known():
+    async def scenario():
+        buffer, flushed = make_buffer(max_pending=2)
+        buffer.put('a', 1)
+        buffer.put('b', 1)
+        assert buffer._wakeup.is_set()
+        buffer.put('c', 1)
+        buffer.put('a', 1)
+        assert buffer.dropped == 1
+        await buffer.flush()
+        assert flushed == [{'a': 2, 'b': 1}]
+
+    asyncio.run(scenario())
+
+
+def test_failed_flush_requeues_batch():
+    async def scenario():
+        calls = []
+
+        async def flaky(batch):
+            calls.append(dict(batch))
+            if len(calls) == 1:
+                # Обновление, пришедшее во время неудачной записи, не должно потеряться
+                buffer.put('a', 10)
+                raise RuntimeError("db down")
+
+        buffer, _ = make_buffer(flaky, max_pending=2)
+        buffer.put('a', 1)
+        buffer.put('b', 2)
+        assert await buffer.flush() == 0
+        assert buffer.failed_flushes == 1
+        assert buffer.metrics()['pending'] == 2
+
+        assert await buffer.flush() == 2
+        assert calls[1] == {'a': 11, 'b': 2}
+        assert buffer.metrics()['pending'] == 0
+
+    asyncio.run(scenario())
+
+
+def test_requeue_drops_overflow():
+    async def scenario():
+        async def failing(batch):
+            buffer.put('c', 1)
+            raise RuntimeError("db down")
+
+        buffer, _ = make_buffer(failing, max_pending=2)
+        buffer.put('a', 1)
+        buffer.put('b', 1)
+        await buffer.flush()
+        assert buffer.metrics()['pending'] == 2
+        assert buffer.dropped == 1
+
+    asyncio.run(scenario())
+
+
+def test_close_flushes_remaining():
+    async def scenario():
+        buffer, flushed = make_buffer(flush_interval=60)
+        buffer.start()
+        buffer.put('a', 1)
+        await buffer.close()
+        assert flushed == [{'a': 1}]
+
+    asyncio.run(scenario())
@@ -0,0 +1,90 @@
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+
+class ChatTopCache:
+    """
+    Кэш топов чатов в памяти процесса: read-through с вытеснением по LRU.
+    Изменения баланса патчат закэшированный список на месте, а если по
+    нему нельзя понять новый состав топа — запись чата сбрасывается.
+    """
+
+    def __init__(self, limit: int = 10, max_chats: int = 5000):
+        self.limit = limit
+        self.max_chats = max_chats
+        self._tops: 'OrderedDict[int, List[dict]]' = OrderedDict()
+        # Незавершённые загрузки: изменение чата отменяет запись устаревшего результата
+        self._loading: Dict[int, object] = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.patched = 0
+        self.invalidations = 0
+        self.evictions = 0
+
+    def get(self, chat_id: int) -> Optional[List[dict]]:
+        top = self._tops.get(chat_id)
+        if top is None:
+            self.misses += 1
+            return None
+        self._tops.move_to_end(chat_id)
+        self.hits += 1
+        return [dict(entry) for entry in top]
+
+    def begin_load(self, chat_id: int) -> object:
+        token = object()
+        self._loading[chat_id] = token
+        return token
+
+    def store(self, chat_id: int, token: object, top: List[dict]):
+        """Сохраняет загруженный топ, если чат не менялся с begin_load"""
+        if self._loading.get(chat_id) is not token:
+            return
+        del self._loading[chat_id]
+        self._tops[chat_id] = [dict(entry) for entry in top[:self.limit]]
+        self._tops.move_to_end(chat_id)
+        while len(self._tops) > self.max_chats:
+            self._tops.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, chat_id: int):
+        self._loading.pop(chat_id, None)
+        if self._tops.pop(chat_id, None) is not None:
+            self.invalidations += 1
+
+    def update(self, chat_id: int, user_id: str, username: str, gp5: int, key: Optional[str] = None):
+        """Новый баланс игрока в чате: правка списка на месте или сброс записи"""
+        self._loading.pop(chat_id, None)
+        top = self._tops.get(chat_id)
+        if top is None:
+            return
+        # Неполный список — в чате меньше limit игроков, состав известен целиком
+        complete = len(top) < self.limit
+        entry = next((e for e in top if e['user_id'] == user_id), None)
+        if entry is None:
+            if not complete and gp5 <= top[-1].get('gp5', 0):
+                return  # Игрок по-прежнему ниже топа
+            entry = {'_id': key, 'user_id': user_id}
+            top.append(entry)
+        elif not complete and gp5 < top[-1].get('gp5', 0):
+            # Игрок выпал на границу топа — кто займёт его место, известно только базе
+            self.invalidate(chat_id)
+            return
+        entry['username'] = username
+        entry['gp5'] = gp5
+        top.sort(key=lambda e: e.get('gp5', 0), reverse=True)
+        del top[self.limit:]
+        self.patched += 1
+
+    def metrics(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "name": "chat_top",
+            "size": len(self._tops),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups * 100, 1) if lookups else 0.0,
+            "patched": self.patched,
+            "invalidations": self.invalidations,
+            "evictions": self.evictions
+        }
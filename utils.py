@@ -1,17 +1,30 @@
 import os
+import re
+import hmac
 import time
 import json
+import hashlib
+import secrets
+import uuid
 import logging
 import aiofiles
 import asyncio
-from dataclasses import dataclass, field
-from typing import Optional, Dict, Tuple, Callable, Any, Awaitable
+from dataclasses import dataclass
+from typing import Optional, Dict, Tuple, Callable, Any, Awaitable, TYPE_CHECKING
 from aiogram import Bot, types, BaseMiddleware
 from aiogram.types import InlineKeyboardMarkup
 from aiogram.types import FSInputFile
+from aiogram.exceptions import TelegramBadRequest
 from dotenv import load_dotenv
 from asyncio import Lock
 
+from media_cache import MediaCache, file_digest
+from subscription_cache import SubscriptionCache
+from view_cache import ViewCache, render_digest
+
+if TYPE_CHECKING:
+    from catalog import MessageCatalog
+
 load_dotenv(dotenv_path='config.txt')
 
 logging.basicConfig(
@@ -29,27 +42,66 @@ logger.setLevel(logging.INFO)
 MESSAGES_FILE = 'messages.json'
 IMG_DIR = 'IMG'
 os.makedirs(IMG_DIR, exist_ok=True)
+# Оптимизированные картинки от build_assets.py
+ASSETS_BUILD_DIR = 'IMG_BUILD'
+ASSETS_MANIFEST = os.path.join(ASSETS_BUILD_DIR, 'manifest.json')
+TELEGRAM_PHOTO_MAX_SIDE = 1280
+ASSETS_JPEG_QUALITY = 85
 
 GLOBAL_DATA_COLLECTION = 'global_loot'
 CHATS_LIST_COLLECTION = 'active_chats'
+CHATS_COLLECTION = 'chats'
 PROMO_COLLECTION = 'promocodes'
+PROMO_CODES_COLLECTION = 'promo_codes'
+PROMO_USAGE_COLLECTION = 'promo_usage'
 GLOBAL_COOLDOWN_COLLECTION = 'cooldowns'
+COOLDOWNS_COLLECTION = 'user_cooldowns'
 CHAT_DATA_COLLECTION = 'chat_data'
+PLAYERS_COLLECTION = 'players'
 MEDIA_CACHE_COLLECTION = 'media_cache'
+GLOBAL_STATS_COLLECTION = 'global_stats'
+GLOBAL_STATS_REBUILD_COLLECTION = 'global_stats_rebuild'
+STATS_COLLECTION = 'bot_stats'
 
 DIG_COOLDOWN_HOURS = 4
 BOX_COOLDOWN_HOURS = 12
-MIGRATION_VERSION = 3
+COOLDOWN_RETENTION_DAYS = 30
+MIGRATION_BATCH_SIZE = 1000
+MIGRATION_LOCK_LEASE = 300
 SUBSCRIPTION_CACHE_TTL = 300
+SUBSCRIPTION_NEGATIVE_TTL = 20
+SUBSCRIPTION_CACHE_SIZE = 50000
+MEDIA_UPLOAD_BATCH = 10  # Максимум фото в одном альбоме Telegram
+MEDIA_UPLOAD_CONCURRENCY = 3
+MEDIA_UPLOAD_RETRIES = 3
+MEDIA_DIGEST_RECHECK_INTERVAL = 5.0
+VIEW_CACHE_SIZE = 20000
+GLOBAL_STATS_RECONCILE_INTERVAL = 3600
+GLOBAL_STATS_REBUILD_BATCH = 5000
+BULK_GIVE_BATCH = 1000
+BULK_GIVE_MAX_FILE_SIZE = 1024 * 1024
+WRITE_BEHIND_FLUSH_INTERVAL = 5.0
+WRITE_BEHIND_MAX_PENDING = 10000
+MESSAGES_WATCH_INTERVAL = 5.0
+STATS_CACHE_TTL = 30
+STATS_RECONCILE_INTERVAL = 600
+STATS_DAYS_RETENTION = 35
+CHAT_TOP_LIMIT = 10
+CHAT_TOP_CACHE_SIZE = 5000
 
 _dig_locks: Dict[str, Lock] = {}
 _box_locks: Dict[str, Lock] = {}
 _lock_cleanup_time = 0.0
 
-_subscription_cache: Dict[int, Tuple[bool, float]] = {}
+view_cache = ViewCache(max_size=VIEW_CACHE_SIZE)
 
-# Кэш file_id в памяти
-_file_id_cache: Dict[str, str] = {}
+_optimized_assets: Dict[str, str] = {}
+
+subscription_cache = SubscriptionCache(
+    ttl=SUBSCRIPTION_CACHE_TTL,
+    negative_ttl=SUBSCRIPTION_NEGATIVE_TTL,
+    max_size=SUBSCRIPTION_CACHE_SIZE
+)
 
 
 @dataclass
@@ -59,23 +111,30 @@ class BotConfig:
     channel_id: int
     channel_link: str
     media_channel_id: Optional[int] = None
+    callback_secret: bytes = b''
+    watch_messages: bool = False
 
 
 @dataclass
 class BotState:
     maintenance: bool = False
-    messages: dict = field(default_factory=dict)
+    messages: Optional['MessageCatalog'] = None
     config: Optional[BotConfig] = None
 
 
 def load_config() -> BotConfig:
     media_channel = os.getenv('MEDIA_CHANNEL_ID', '')
+    token = os.getenv('TOKEN', '')
+    # Ключ подписи callback_data; без CALLBACK_SECRET выводится из токена
+    callback_secret = os.getenv('CALLBACK_SECRET') or hashlib.sha256(f"callback:{token}".encode()).hexdigest()
     return BotConfig(
-        token=os.getenv('TOKEN', ''),
+        token=token,
         admin_ids=[int(id.strip()) for id in os.getenv('ADMIN_IDS', '').split(',') if id.strip()],
         channel_id=int(os.getenv('CHANNEL_ID', '0')),
         channel_link=os.getenv('CHANNEL_LINK', ''),
-        media_channel_id=int(media_channel) if media_channel else None
+        media_channel_id=int(media_channel) if media_channel else None,
+        callback_secret=callback_secret.encode(),
+        watch_messages=os.getenv('MESSAGES_WATCH', '0') == '1'
     )
 
 
@@ -88,7 +147,63 @@ def safe_image_path(filename: str) -> Optional[str]:
     if not full_path.startswith(base):
         logging.warning(f"Path traversal attempt blocked: {filename}")
         return None
-    return full_path if os.path.exists(full_path) else None
+    if not os.path.exists(full_path):
+        return None
+    return optimized_assets().get(filename, full_path)
+
+
+def optimized_assets() -> Dict[str, str]:
+    """Имя файла → путь к оптимизированному варианту (заполняет load_optimized_assets)"""
+    return _optimized_assets
+
+
+def _read_assets_manifest() -> Dict[str, str]:
+    """
+    Манифест build_assets.py с проверкой исходников: вариант, исходник
+    которого поменялся после сборки, не используется.
+    """
+    if not os.path.exists(ASSETS_MANIFEST):
+        return {}
+    assets, entries, entries_kept = {}, {}, 0
+    try:
+        with open(ASSETS_MANIFEST, encoding='utf-8') as f:
+            entries = json.load(f)['assets']
+        for filename, entry in entries.items():
+            if entry.get('hash') is None:
+                # Исходник оказался не больше оптимизированного варианта
+                entries_kept += 1
+                continue
+            source = os.path.join(IMG_DIR, filename)
+            output = os.path.realpath(os.path.join(ASSETS_BUILD_DIR, entry.get('output', filename)))
+            if os.path.exists(source) and os.path.exists(output) and file_digest(source) == entry.get('source_hash'):
+                assets[filename] = output
+    except (OSError, ValueError, KeyError, AttributeError) as e:
+        logging.warning(f"Assets manifest ignored: {e}")
+    stale = len(entries) - entries_kept - len(assets)
+    if stale:
+        logging.warning(f"Assets manifest: {stale} stale entries, run build_assets.py")
+    return assets
+
+
+async def load_optimized_assets() -> int:
+    """
+    Загрузка манифеста при старте и в /cache_images. Хэши исходников
+    считаются в отдельном потоке, отправка картинок только смотрит в словарь.
+    """
+    global _optimized_assets
+    _optimized_assets = await asyncio.to_thread(_read_assets_manifest)
+    logging.info(f"Optimized assets loaded: {len(_optimized_assets)}")
+    return len(_optimized_assets)
+
+
+# Кэш file_id по имени и хэшу файла, заполняется из БД при старте
+media_cache = MediaCache(
+    safe_image_path,
+    batch_size=MEDIA_UPLOAD_BATCH,
+    concurrency=MEDIA_UPLOAD_CONCURRENCY,
+    retries=MEDIA_UPLOAD_RETRIES,
+    recheck_interval=MEDIA_DIGEST_RECHECK_INTERVAL
+)
 
 
 def escape_markdown_v2(text: str) -> str:
@@ -142,15 +257,71 @@ def get_box_lock(user_id: str) -> Lock:
     return _box_locks[key]
 
 
+BOX_OUTCOMES = ("win", "empty", "lose")
+
+
+def new_box_nonce() -> str:
+    return secrets.token_hex(4)
+
+
+def _box_mask(secret: bytes, user_id: int, nonce: str, slot: int) -> int:
+    """Маска, скрывающая исход ящика в callback_data от клиента"""
+    digest = hmac.new(secret, f"mask:{user_id}:{nonce}:{slot}".encode(), hashlib.sha256).digest()
+    return digest[0] % len(BOX_OUTCOMES)
+
+
+def _box_signature(secret: bytes, payload: str) -> str:
+    return hmac.new(secret, payload.encode(), hashlib.sha256).hexdigest()[:16]
+
+
+def pack_box_callback(secret: bytes, prefix: str, user_id: int, nonce: str, slot: int, outcome: str) -> str:
+    """
+    callback_data ящика: <prefix>_<user_id>_<nonce>_<slot><исход под маской>_<подпись>.
+    Укладывается в лимит Telegram 64 байта.
+    """
+    masked = (BOX_OUTCOMES.index(outcome) + _box_mask(secret, user_id, nonce, slot)) % len(BOX_OUTCOMES)
+    payload = f"{prefix}_{user_id}_{nonce}_{slot}{masked}"
+    return f"{payload}_{_box_signature(secret, payload)}"
+
+
+def unpack_box_callback(secret: bytes, data: str) -> Optional[Tuple[str, int, str, str]]:
+    """Проверяет подпись и возвращает (prefix, user_id, nonce, outcome) или None"""
+    try:
+        payload, signature = data.rsplit("_", 1)
+        prefix, user_id_str, nonce, slot_code = payload.split("_")
+        user_id = int(user_id_str)
+        slot, masked = int(slot_code[0]), int(slot_code[1])
+    except (ValueError, IndexError):
+        return None
+    if len(slot_code) != 2 or not hmac.compare_digest(signature, _box_signature(secret, payload)):
+        return None
+    outcome = BOX_OUTCOMES[(masked - _box_mask(secret, user_id, nonce, slot)) % len(BOX_OUTCOMES)]
+    return prefix, user_id, nonce, outcome
+
+
+def unpack_legacy_box_callback(data: str) -> Optional[Tuple[str, int, str]]:
+    """
+    Кнопка ящика старого формата <prefix>_<user_id>_<uuid> — (prefix, user_id, button_id) или None.
+    Исход такой кнопки хранится в базе (Storage.claim_legacy_box).
+    """
+    parts = data.split("_")
+    if len(parts) != 3:
+        return None
+    try:
+        user_id = int(parts[1])
+        uuid.UUID(parts[2])
+    except ValueError:
+        return None
+    return parts[0], user_id, parts[2]
+
+
 def format_dig_result(
-        event_text: str,
+        event_md: str,
         loot: int,
         loot_type: str,
         old_balance: int = None,
         new_balance: int = None
 ) -> str:
-    escaped_event = escape_markdown_v2(event_text)
-
     balance_line = ""
     if old_balance is not None and new_balance is not None:
         balance_line = f"\n{format_balance_change(old_balance, new_balance)} ГП\\-5"
@@ -158,7 +329,7 @@ def format_dig_result(
     if loot_type == "super":
         return (
             f"⚡ *СВЕРХРЕДКАЯ НАХОДКА\\!* ⚡\n\n"
-            f"{escaped_event}\n"
+            f"{event_md}\n"
             f"*☢️\\+40 ГП\\-5*"
             f"{balance_line}"
         )
@@ -166,7 +337,7 @@ def format_dig_result(
     change = f"\\+{loot}" if loot > 0 else f"\\-{-loot}"
     return (
         f"*📻 Вылазка завершена*\n\n"
-        f"{escaped_event}\n"
+        f"{event_md}\n"
         f"*☢️{change} ГП\\-5*"
         f"{balance_line}\n"
     )
@@ -197,97 +368,33 @@ async def send_temporary_message(
 
 
 async def check_subscription(bot: Bot, channel_id: int, user_id: int) -> bool:
-    now = time.time()
-    cached = _subscription_cache.get(user_id)
-
-    # Доверяем кэшу ТОЛЬКО если пользователь БЫЛ подписан
-    # Если не подписан — всегда проверяем заново
-    if cached:
-        is_subscribed, cached_time = cached
-        if is_subscribed and now - cached_time < SUBSCRIPTION_CACHE_TTL:
-            return True
-
-    # Проверяем реальный статус подписки
-    try:
-        member = await bot.get_chat_member(channel_id, user_id)
-        is_subscribed = member.status in ["member", "administrator", "creator"]
-    except Exception as e:
-        logging.warning(f"Error checking subscription for {user_id}: {e}")
-        # При ошибке API — если был кэш с подпиской, доверяем ему
-        if cached and cached[0]:
-            return True
-        return False
-
-    # Кэшируем ТОЛЬКО положительный статус подписки
-    if is_subscribed:
-        _subscription_cache[user_id] = (True, now)
-    else:
-        # Если не подписан — удаляем из кэша (мог отписаться)
-        _subscription_cache.pop(user_id, None)
-
-    # Очистка старых записей
-    if len(_subscription_cache) > 1000:
-        cutoff = now - SUBSCRIPTION_CACHE_TTL
-        keys_to_remove = [k for k, v in _subscription_cache.items() if v[1] < cutoff]
-        for k in keys_to_remove[:500]:
-            _subscription_cache.pop(k, None)
-
-    return is_subscribed
+    return await subscription_cache.check(bot, channel_id, user_id)
 
 
 def invalidate_subscription_cache(user_id: int):
-    _subscription_cache.pop(user_id, None)
+    subscription_cache.invalidate(user_id)
 
 
-async def load_messages() -> dict:
+async def load_messages(strict: bool = False) -> dict:
+    """strict=True — ошибки чтения и разбора пробрасываются (горячая перезагрузка)"""
     try:
         async with aiofiles.open(MESSAGES_FILE, 'r', encoding='utf-8') as f:
             content = await f.read()
             return json.loads(content)
     except FileNotFoundError:
+        if strict:
+            raise
         logging.error(f"Messages file not found: {MESSAGES_FILE}")
         return {}
     except json.JSONDecodeError as e:
+        if strict:
+            raise
         logging.error(f"Invalid JSON in messages file: {e}")
         return {}
 
 
-def get_user_rank(gp5: int, messages: dict) -> dict:
-    ranks = messages.get("ranks", [])
-    if not ranks:
-        return {
-            "name": "Неизвестный",
-            "emoji": "❓",
-            "image": None,
-            "min_gp5": 0,
-            "next_rank": None,
-            "progress": 0
-        }
-    sorted_ranks = sorted(ranks, key=lambda x: x.get("min_gp5", 0), reverse=True)
-    current_rank = sorted_ranks[-1]
-    next_rank = None
-    for i, rank in enumerate(sorted_ranks):
-        if gp5 >= rank.get("min_gp5", 0):
-            current_rank = rank
-            if i > 0:
-                next_rank = sorted_ranks[i - 1]
-            break
-        next_rank = rank
-    progress = 100
-    if next_rank:
-        current_min = current_rank.get("min_gp5", 0)
-        next_min = next_rank.get("min_gp5", 0)
-        if next_min > current_min:
-            progress = int(((gp5 - current_min) / (next_min - current_min)) * 100)
-            progress = max(0, min(progress, 99))
-    return {
-        "name": current_rank.get("name", "Неизвестный"),
-        "emoji": current_rank.get("emoji", "❓"),
-        "image": current_rank.get("image"),
-        "min_gp5": current_rank.get("min_gp5", 0),
-        "next_rank": next_rank,
-        "progress": progress
-    }
+def get_user_rank(gp5: int, messages: 'MessageCatalog') -> dict:
+    return messages.rank_for(gp5)
 
 
 def format_progress_bar(progress: int, length: int = 10) -> str:
@@ -296,35 +403,16 @@ def format_progress_bar(progress: int, length: int = 10) -> str:
     return "▓" * filled + "░" * empty
 
 
-async def get_cached_file_id(filename: str) -> Optional[str]:
-    """Получить file_id из кэша (память + БД)"""
+def get_cached_file_id(filename: str) -> Optional[str]:
+    """file_id из кэша в памяти (коллекция загружается целиком при старте)"""
     if not filename:
         return None
-
-    # Сначала проверяем память
-    if filename in _file_id_cache:
-        return _file_id_cache[filename]
-
-    # Затем проверяем БД
-    from database import db
-    doc = await db[MEDIA_CACHE_COLLECTION].find_one({'_id': filename})
-    if doc and 'file_id' in doc:
-        _file_id_cache[filename] = doc['file_id']
-        return doc['file_id']
-
-    return None
+    return media_cache.get(filename)
 
 
 async def save_file_id(filename: str, file_id: str):
     """Сохранить file_id в кэш (память + БД)"""
-    _file_id_cache[filename] = file_id
-
-    from database import db
-    await db[MEDIA_CACHE_COLLECTION].update_one(
-        {'_id': filename},
-        {'$set': {'file_id': file_id, 'updated_at': time.time()}},
-        upsert=True
-    )
+    await media_cache.put(filename, file_id)
 
 
 async def send_photo_cached(
@@ -344,7 +432,7 @@ async def send_photo_cached(
         return None
 
     # Пробуем получить file_id из кэша
-    file_id = await get_cached_file_id(filename)
+    file_id = get_cached_file_id(filename)
 
     if file_id:
         # Отправляем по file_id (мгновенно)
@@ -361,7 +449,7 @@ async def send_photo_cached(
         except Exception as e:
             # file_id мог устареть, пробуем загрузить заново
             logging.warning(f"Cached file_id failed for {filename}: {e}")
-            _file_id_cache.pop(filename, None)
+            media_cache.drop(filename)
 
     # Загружаем файл локально
     image_path = safe_image_path(filename)
@@ -421,6 +509,102 @@ async def send_response(
     return await message.reply(text, parse_mode=parse_mode, reply_markup=keyboard)
 
 
+async def send_view(
+        message: types.Message,
+        text: str,
+        image: Optional[str] = None,
+        keyboard: Optional[InlineKeyboardMarkup] = None,
+        parse_mode: str = "MarkdownV2"
+) -> types.Message:
+    """send_response для экранов с навигацией: запоминает отрисовку для edit_view"""
+    sent = await send_response(message, text, image=image, keyboard=keyboard, parse_mode=parse_mode)
+    if sent:
+        view_cache.set(sent.chat.id, sent.message_id, render_digest(text, keyboard, image), image)
+    return sent
+
+
+async def edit_view(
+        query: types.CallbackQuery,
+        text: str,
+        image: Optional[str] = None,
+        keyboard: Optional[InlineKeyboardMarkup] = None,
+        parse_mode: str = "MarkdownV2"
+) -> bool:
+    """
+    Перерисовывает сообщение с навигацией на месте. Если отрисовка совпадает
+    с прошлой, запрос не отправляется и возвращается False.
+    Сообщение с фото меняет картинку, только когда она другая; у текстового
+    сообщения картинка не появляется.
+    """
+    message = query.message
+    digest = render_digest(text, keyboard, image)
+    previous = view_cache.get(message.chat.id, message.message_id)
+    if previous and previous[0] == digest:
+        view_cache.unchanged += 1
+        return False
+
+    try:
+        if not message.photo:
+            await message.edit_text(text, parse_mode=parse_mode, reply_markup=keyboard)
+        elif not image or (previous and previous[1] == image) \
+                or not await _edit_view_media(message, text, image, keyboard, parse_mode):
+            await message.edit_caption(caption=text, parse_mode=parse_mode, reply_markup=keyboard)
+    except TelegramBadRequest as e:
+        if "message is not modified" not in str(e):
+            # Сообщение удалено, устарело или не подходит под экран — шлём новое
+            logging.warning(f"Edit view failed, sending new message: {e}")
+            view_cache.fallbacks += 1
+            await send_view(message, text, image=image, keyboard=keyboard, parse_mode=parse_mode)
+            return True
+        # Отрисовка совпала, но её не было в кэше (например, после перезапуска)
+        view_cache.set(message.chat.id, message.message_id, digest, image)
+        view_cache.unchanged += 1
+        return False
+
+    view_cache.edits += 1
+    view_cache.set(message.chat.id, message.message_id, digest, image)
+    return True
+
+
+async def _edit_view_media(
+        message: types.Message,
+        text: str,
+        image: str,
+        keyboard: Optional[InlineKeyboardMarkup],
+        parse_mode: str
+) -> bool:
+    """Смена картинки вместе с подписью: по file_id, иначе загрузкой файла"""
+    file_id = get_cached_file_id(image)
+    if file_id:
+        try:
+            await message.edit_media(
+                media=types.InputMediaPhoto(media=file_id, caption=text, parse_mode=parse_mode),
+                reply_markup=keyboard
+            )
+            return True
+        except TelegramBadRequest as e:
+            if "message is not modified" in str(e):
+                raise
+            logging.warning(f"Cached file_id failed for {image}: {e}")
+            media_cache.drop(image)
+
+    image_path = safe_image_path(image)
+    if not image_path:
+        return False
+    edited = await message.edit_media(
+        media=types.InputMediaPhoto(media=FSInputFile(image_path), caption=text, parse_mode=parse_mode),
+        reply_markup=keyboard
+    )
+    if isinstance(edited, types.Message) and edited.photo:
+        await save_file_id(image, edited.photo[-1].file_id)
+    return True
+
+
+def parse_user_ids(text: str) -> list[str]:
+    """ID пользователей из текста (через запятую, пробелы или построчно), без повторов"""
+    return list(dict.fromkeys(re.findall(r'\d+', text)))
+
+
 def is_admin(user_id: int, bot_state: BotState) -> bool:
     return user_id in (bot_state.config.admin_ids if bot_state.config else [])
 
@@ -492,6 +676,55 @@ class MaintenanceMiddleware(BaseMiddleware):
         return await handler(event, data)
 
 
+class PrefilterMiddleware(BaseMiddleware):
+    """
+    Внешняя мидлварь сообщений: срабатывает до фильтров хэндлеров и остальных
+    мидлварей. Команды и слова-триггеры из messages.json проходят дальше с
+    пометкой message_kind, прочая переписка группы отбрасывается сразу.
+    """
+
+    def __init__(self, bot_state: BotState):
+        self.bot_state = bot_state
+        self.commands = 0
+        self.triggers = 0
+        self.dropped = 0
+        super().__init__()
+
+    async def __call__(
+            self,
+            handler: Callable[[types.Message, Dict[str, Any]], Awaitable[Any]],
+            event: types.Message,
+            data: Dict[str, Any]
+    ) -> Any:
+        text = event.text
+        if text is None:
+            # Команда может прийти подписью к файлу (/give с файлом ID)
+            text = event.caption
+            if text is None or not text.startswith('/'):
+                self.dropped += 1
+                return
+        if text.startswith('/'):
+            self.commands += 1
+            data['message_kind'] = 'command'
+        elif self.bot_state.messages is not None and self.bot_state.messages.match_trigger(text):
+            self.triggers += 1
+            data['message_kind'] = 'trigger'
+        else:
+            self.dropped += 1
+            return
+        return await handler(event, data)
+
+    def metrics(self) -> dict:
+        total = self.commands + self.triggers + self.dropped
+        return {
+            "name": "prefilter",
+            "commands": self.commands,
+            "triggers": self.triggers,
+            "dropped": self.dropped,
+            "drop_rate": round(self.dropped / total * 100, 1) if total else 0.0
+        }
+
+
 class StateMiddleware(BaseMiddleware):
     def __init__(self, bot_state: BotState):
         self.bot_state = bot_state
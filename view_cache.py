@@ -0,0 +1,56 @@
+import hashlib
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from aiogram.types import InlineKeyboardMarkup
+
+
+def render_digest(text: str, keyboard: Optional[InlineKeyboardMarkup], image: Optional[str]) -> str:
+    """Хэш отрисованного экрана: текст, клавиатура и картинка"""
+    sha = hashlib.sha1(text.encode())
+    sha.update(b'\0')
+    if keyboard is not None:
+        sha.update(keyboard.model_dump_json(exclude_none=True).encode())
+    sha.update(b'\0')
+    sha.update((image or '').encode())
+    return sha.hexdigest()
+
+
+class ViewCache:
+    """
+    Последний отрисованный экран для сообщений с навигацией (топы, профиль).
+    Нажатие, после которого экран не изменился, не тратит запрос на
+    редактирование и не ловит ошибку "message is not modified".
+    """
+
+    def __init__(self, max_size: int = 20000):
+        self.max_size = max_size
+        self._views: 'OrderedDict[Tuple[int, int], Tuple[str, Optional[str]]]' = OrderedDict()
+
+        self.unchanged = 0
+        self.edits = 0
+        self.fallbacks = 0
+
+    def get(self, chat_id: int, message_id: int) -> Optional[Tuple[str, Optional[str]]]:
+        """(хэш, картинка) последнего экрана сообщения"""
+        view = self._views.get((chat_id, message_id))
+        if view is not None:
+            self._views.move_to_end((chat_id, message_id))
+        return view
+
+    def set(self, chat_id: int, message_id: int, digest: str, image: Optional[str]):
+        self._views[(chat_id, message_id)] = (digest, image)
+        self._views.move_to_end((chat_id, message_id))
+        while len(self._views) > self.max_size:
+            self._views.popitem(last=False)
+
+    def metrics(self) -> dict:
+        presses = self.unchanged + self.edits + self.fallbacks
+        return {
+            "name": "views",
+            "size": len(self._views),
+            "unchanged": self.unchanged,
+            "edits": self.edits,
+            "fallbacks": self.fallbacks,
+            "skip_rate": round(self.unchanged / presses * 100, 1) if presses else 0.0
+        }
@@ -0,0 +1,126 @@
+import time
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional
+
+
+class WriteBehindBuffer:
+    """
+    Буфер отложенной записи: обновления копятся в памяти по ключу (повторные
+    сливаются через merge) и сбрасываются одной пачкой по таймеру, при
+    переполнении или при остановке бота.
+    """
+
+    def __init__(
+            self,
+            name: str,
+            flush_handler: Callable[[Dict[Hashable, Any]], Awaitable[None]],
+            merge: Callable[[Any, Any], Any],
+            flush_interval: float = 5.0,
+            max_pending: int = 10000
+    ):
+        self.name = name
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._flush_handler = flush_handler
+        self._merge = merge
+        self._pending: Dict[Hashable, Any] = {}
+        self._flush_lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+        self.received = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.flushes = 0
+        self.failed_flushes = 0
+        self.flushed_items = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self.total_flush_ms = 0.0
+
+    def put(self, key: Hashable, value: Any):
+        self.received += 1
+        if key in self._pending:
+            self._pending[key] = self._merge(self._pending[key], value)
+            self.coalesced += 1
+            return
+        if len(self._pending) >= self.max_pending:
+            # Очередь ограничена: новый ключ теряется, сброс запрашивается немедленно
+            self.dropped += 1
+            self._wakeup.set()
+            return
+        self._pending[key] = value
+        if len(self._pending) >= self.max_pending:
+            self._wakeup.set()
+
+    def _requeue(self, batch: Dict[Hashable, Any]):
+        """Возвращает несохранённую пачку, не затирая более свежие обновления"""
+        for key, value in batch.items():
+            if key in self._pending:
+                self._pending[key] = self._merge(value, self._pending[key])
+            elif len(self._pending) < self.max_pending:
+                self._pending[key] = value
+            else:
+                self.dropped += 1
+
+    async def flush(self) -> int:
+        async with self._flush_lock:
+            if not self._pending:
+                return 0
+            batch, self._pending = self._pending, {}
+            started = time.perf_counter()
+            try:
+                await self._flush_handler(batch)
+            except Exception as e:
+                self.failed_flushes += 1
+                self._requeue(batch)
+                logging.error(f"Write-behind flush '{self.name}' failed ({len(batch)} items): {e}")
+                return 0
+
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            self.flushes += 1
+            self.flushed_items += len(batch)
+            self.last_flush_ms = elapsed_ms
+            self.max_flush_ms = max(self.max_flush_ms, elapsed_ms)
+            self.total_flush_ms += elapsed_ms
+            return len(batch)
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        """Останавливает фоновый сброс и записывает всё, что осталось"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    def metrics(self) -> dict:
+        return {
+            "name": self.name,
+            "pending": len(self._pending),
+            "received": self.received,
+            "coalesced": self.coalesced,
+            "dropped": self.dropped,
+            "flushes": self.flushes,
+            "failed_flushes": self.failed_flushes,
+            "flushed_items": self.flushed_items,
+            "last_flush_ms": round(self.last_flush_ms, 1),
+            "max_flush_ms": round(self.max_flush_ms, 1),
+            "avg_flush_ms": round(self.total_flush_ms / self.flushes, 1) if self.flushes else 0.0
+        }